@@ -1,36 +1,24 @@
 
 import logging
-import time
 import sys
 import enrich_internal_persons_with_ids as ipersons
 import pure_researchoutputs
 import pure_datasets as puda
-from config import PURE_BASE_URL, PURE_API_KEY, PURE_HEADERS
+import pure_persons
+import pure_client
+from config import PURE_BASE_URL, PURE_API_KEY
 from logging_config import setup_logging
 from datetime import datetime
 import json
 import pandas as pd
 import os
-import requests
-
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
 import urllib3
 #Setup logger
 
 logger = setup_logging('btp', level=logging.INFO)
 logger.handlers[0].stream.flush = lambda: sys.stdout.flush()
 datetimetoday = datetime.now().strftime('%Y%m%d')
-# Set up a single session for all requests
-session = requests.Session()
-retry_strategy = Retry(
-    total=5,
-    status_forcelist=[429, 500, 502, 503, 504],
-    allowed_methods=["HEAD", "GET", "OPTIONS", "PUT", "POST"],
-    backoff_factor=1
-)
-adapter = HTTPAdapter(max_retries=retry_strategy)
-session.mount("https://", adapter)
+# All requests go through pure_client.client, which limits the concurrency and the rate
 # Disable only the single InsecureRequestWarning from urllib3 needed to use the InsecureRequestWarning
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 headers = {
@@ -38,6 +26,23 @@ headers = {
     'api-key': PURE_API_KEY,
 }
 
+def map_rows(func, items):
+    """
+    Runs func over the rows in parallel through pure_client.client.
+
+    A row that raises is logged and returns None (not updated), so the rows that were
+    updated before it are still marked in the CSV and not sent again by the next run.
+    """
+    def run(item):
+        try:
+            return func(item)
+        except Exception as e:
+            logger.error(f"Error processing {item[0]}: {e}")
+            return None
+
+    return pure_client.client.map(run, items)
+
+
 def get_csv_files(directory):
     """
     Reads all CSV files from the given directory that contain 'update' in the filename and returns a list of DataFrames.
@@ -120,7 +125,9 @@ def process_internal_persons(filename, csv_file, json_data):
 
     # Grouping the DataFrame by 'PURE_UUID_PERS' to collect updates for the same person
     grouped = filtered_csv.groupby('PURE_UUID_PERS')
-    for person_uuid, group in grouped:
+
+    def update_person(item):
+        person_uuid, group = item
         # Retrieve the corresponding entry from the JSON data
         entry = next((item for item in json_data if item['uuid'] == person_uuid), None)
 
@@ -142,16 +149,20 @@ def process_internal_persons(filename, csv_file, json_data):
 
             # After processing all updates for the person, call the API once
             api_url = PURE_BASE_URL + 'persons/' + person_uuid
-            response = requests.put(api_url, headers=PURE_HEADERS, json=entry)
+            response = pure_client.client.put(api_url, json=entry)
 
-            # If the API call is successful, mark all rows for the person as updated and clear 'to_be_updated'
+            # If the API call is successful, all rows for the person are marked as updated
             if response.status_code == 200:  # Assuming 200 indicates a successful update
-                csv_file.loc[group.index, 'updated'] = 'X'
-                csv_file.loc[group.index, 'to_be_updated'] = ''  # Clear 'to_be_updated' for successfully updated rows
-            else:
-                print(f'Failed to update person UUID: {person_uuid}, Response: {response.text}')
+                return group.index
+            print(f'Failed to update person UUID: {person_uuid}, Response: {response.text}')
         else:
             print(f'Not found for person UUID: {person_uuid}')
+        return None
+
+    for updated_index in map_rows(update_person, grouped):
+        if updated_index is not None:
+            csv_file.loc[updated_index, 'updated'] = 'X'
+            csv_file.loc[updated_index, 'to_be_updated'] = ''  # Clear 'to_be_updated' for successfully updated rows
 
     # Reorder the columns to make 'updated' the second column
     cols = list(csv_file.columns)
@@ -178,23 +189,29 @@ def find_json_by_uuid(pure_uuid, json_data):
 def process_external_persons(filename, csv_file, big_json_data):
     # Filter the DataFrame to only consider rows where 'to_be_updated' is 'X'
     filtered_csv = csv_file[csv_file['to_be_updated'] == 'X']
-    for index, row in filtered_csv.iterrows():
+
+    def update_external_person(item):
+        index, row = item
         uuid = row['Pure_UUID']
         matched_record = find_json_by_uuid(uuid, big_json_data)
         if matched_record:
 
             url = PURE_BASE_URL + 'external-persons/' + row['Pure_UUID']
             try:
-                response = session.put(url, headers=headers, json=matched_record, verify=False)
+                response = pure_client.client.put(url, headers=headers, json=matched_record, verify=False)
                 if response.status_code != 200:
                     logger.debug(f"Failed to update data for UUID {uuid}: {response.text}")
                 else:
-                    csv_file.loc[index, 'updated'] = 'X'
-                    csv_file.loc[index, 'to_be_updated'] = ''  # Clear 'to_be_updated' for successfully updated rows
                     logger.debug(f"Successfully updated data for UUID {uuid}")
+                    return index
             except Exception as e:
                 logger.error(f"Error updating UUID {uuid}: {e}")
-            time.sleep(0.1)  # Adjust the sleep time based on rate limits
+        return None
+
+    for index in map_rows(update_external_person, filtered_csv.iterrows()):
+        if index is not None:
+            csv_file.loc[index, 'updated'] = 'X'
+            csv_file.loc[index, 'to_be_updated'] = ''  # Clear 'to_be_updated' for successfully updated rows
 
     # Reorder the columns to make 'updated' the second column
     cols = list(csv_file.columns)
@@ -211,19 +228,23 @@ def process_external_persons(filename, csv_file, big_json_data):
 def process_research_output(filename, csv_file, big_json_data):
     filtered_csv = csv_file[csv_file['to_be_updated'] == 'x']
 
-    for index, row in filtered_csv.iterrows():
+    def create_research_output(item):
+        index, row = item
         doi_item = next((item for item in big_json_data if any(
             version.get("doi", "").endswith(row['doi']) for version in item.get("electronicVersions", []))), None)
 
         # Output the result
         if doi_item:
-
-            pure_researchoutputs.create_research_output(doi_item)
+            if pure_researchoutputs.create_research_output(doi_item):
+                return index
+            return None
+        print(f"No item found with DOI: {row['doi']}")
+        return None
+
+    for index in map_rows(create_research_output, filtered_csv.iterrows()):
+        if index is not None:
             csv_file.loc[index, 'updated'] = 'x'
             csv_file.loc[index, 'to_be_updated'] = ''  # Clear 'to_be_updated' for successfully updated rows
-        else:
-            print(f"No item found with DOI: {row['doi']}")
-            time.sleep(0.1)  # Adjust the sleep time based on rate limits
 
         # Reorder the columns to make 'updated' the second column
     cols = list(csv_file.columns)
@@ -242,19 +263,26 @@ def process_datasets(filename, csv_file, big_json_data):
     # Create a lookup dictionary for faster DOI-based access
     doi_to_dataset = {dataset.get("doi", {}).get("doi"): dataset for dataset in big_json_data}
 
-    for index, row in filtered_csv.iterrows():
-
+    def create_dataset(item):
+        index, row = item
         dataset = doi_to_dataset.get(row['doi'])
 
         # Output the result
         if dataset:
-
-            puda.create_dataset(dataset)
+            if puda.create_dataset(dataset) != 'error':
+                return index
+            return None
+        print(f"No item found with DOI: {row['doi']}")
+        return None
+
+    created = []
+    for index in map_rows(create_dataset, filtered_csv.iterrows()):
+        if index is not None:
             csv_file.loc[index, 'updated'] = 'x'
             csv_file.loc[index, 'to_be_updated'] = ''  # Clear 'to_be_updated' for successfully updated rows
-        else:
-            print(f"No item found with DOI: {row['doi']}")
-            time.sleep(0.1)  # Adjust the sleep time based on rate limits
+            created.append(csv_file.loc[index, 'doi'])
+    # the bloom filter of the next import has to know these datasets are in Pure now
+    puda.add_to_dataset_bloom(created)
 
         # Reorder the columns to make 'updated' the second column
     cols = list(csv_file.columns)
@@ -274,28 +302,33 @@ def process_external_orgs(filename, csv_file, big_json_data):
     filtered_csv = csv_file[csv_file['to_be_updated'] == 'X']
 
 
-    for index, row in filtered_csv.iterrows():
+    def update_external_org(item):
+        index, row = item
         uuid = row['uuid']
 
-        # print(big_json_data)
         matched_record = find_json_by_uuid(uuid, big_json_data)
-        # print('test', matched_record)
         if matched_record:
 
             url = PURE_BASE_URL + 'external-organizations/' + row['uuid']
 
             try:
-                response = session.put(url, headers=headers, json=matched_record, verify=False)
+                response = pure_client.client.put(url, headers=headers, json=matched_record, verify=False)
 
                 if response.status_code != 200:
                     logger.info(f"Failed to update data for UUID {uuid}: {response.text}")
                 else:
-                    csv_file.loc[index, 'updated'] = 'X'
-                    csv_file.loc[index, 'to_be_updated'] = ''  # Clear 'to_be_updated' for successfully updated rows
                     logger.debug(f"Successfully updated data for UUID {uuid}")
+                    # the organization now has the ROR, an earlier lookup of the ROR is outdated
+                    pure_persons.forget_external_org(row.get('ror'))
+                    return index
             except Exception as e:
                 logger.error(f"Error updating UUID {uuid}: {e}")
-            time.sleep(0.1)  # Adjust the sleep time based on rate limits
+        return None
+
+    for index in map_rows(update_external_org, filtered_csv.iterrows()):
+        if index is not None:
+            csv_file.loc[index, 'updated'] = 'X'
+            csv_file.loc[index, 'to_be_updated'] = ''  # Clear 'to_be_updated' for successfully updated rows
 
     # Reorder the columns to make 'updated' the second column
     cols = list(csv_file.columns)
@@ -343,4 +376,5 @@ if __name__ == "__main__":
                 process_datasets(filename, csv_file, big_json_data)
             elif 'enrich_external_orgs' in referer_page:
                 process_external_orgs(filename, csv_file, big_json_data)
+    pure_client.client.log_stats()
     logger.info(f"script to update Pure has ended")
@@ -0,0 +1,182 @@
+# ########################################################################
+# Script: benchmark_harvest.py
+#
+# Description:
+# This script compares the two ways of harvesting the research outputs of a
+# faculty that are not yet in Pure: one organization/enrich request for the
+# whole faculty (bulk) and the walk over all person-roots of the faculty
+# (personroot).
+#
+# For each strategy the script reports:
+# - The number of requests sent to Ricgraph, per endpoint and in total.
+# - The wall-clock time of the harvest.
+# - The number of unique DOIs and duplicates found.
+# And at the end the number of DOIs that only one of the strategies found.
+#
+# With --pipelines the harvest step of every existing script (external persons
+# and organizations, research output import, dataset import, internal persons)
+# is timed as well, and reported as requests and DOIs per second.
+#
+# Important:
+# Everything is run with the cache switched off, so every run goes
+# to Ricgraph and the numbers can be compared. Use --mock to run against a
+# local mock of Ricgraph (mock_ricgraph.py) instead of the real one.
+#
+# Dependencies:
+# - ricgraph_utils, mock_ricgraph, argparse, logging, time
+#
+# Author: David Grote Beverborg
+# Created: 2024
+#
+# License:
+# MIT License
+#
+# Copyright (c) 2024 David Grote Beverborg
+# ########################################################################
+
+import argparse
+import logging
+import time
+import ricgraph_utils
+import mock_ricgraph
+from config import RESEARCH_CATEGORIES
+from logging_config import setup_logging
+
+logger = setup_logging('btp', level=logging.INFO)
+
+
+def run_strategy(faculty, category, strategy):
+    """
+    Harvests the faculty with one strategy and measures it.
+
+    Parameters:
+    faculty (str): The faculty key.
+    category (str): The Ricgraph category to harvest.
+    strategy (str): 'bulk' or 'personroot'.
+
+    Returns:
+    dict: The collector, the failures, the wall-clock seconds and the request stats per endpoint.
+    """
+    ricgraph_utils.client.stats = {}
+    collector = ricgraph_utils.DoiCollector(f"{strategy} {category}")
+    start = time.perf_counter()
+    failures = ricgraph_utils.collect_faculty_dois(faculty, collector, category, not_in_pure=True,
+                                                   strategy=strategy)
+    seconds = time.perf_counter() - start
+    return {
+        'collector': collector,
+        'failures': failures,
+        'seconds': seconds,
+        'stats': ricgraph_utils.client.stats,
+    }
+
+
+def report(strategy, result):
+    requests_total = sum(stat['requests'] for stat in result['stats'].values())
+    logger.info(f"{strategy}: {requests_total} requests in {result['seconds']:.1f}s, "
+                f"{len(result['collector'])} unique DOIs, {result['collector'].duplicates} duplicates, "
+                f"{len(result['failures'])} failures")
+    for endpoint, stat in sorted(result['stats'].items()):
+        logger.info(f"{strategy}:   {endpoint}: {stat['requests']} requests, {stat['errors']} errors, "
+                    f"{stat['seconds']:.1f}s")
+
+
+def harvest_researchoutput_dois(faculties):
+    """
+    The harvest of enrich_pure_external_persons and enrich_pure_external_orgs without the
+    Pure and OpenAlex fetching that stream_researchoutputs overlaps with it: all DOIs of
+    the research output categories of the faculties.
+    """
+    collector = ricgraph_utils.DoiCollector('research outputs')
+    for faculty in faculties:
+        ricgraph_utils.collect_faculty_dois(faculty, collector, RESEARCH_CATEGORIES)
+    collector.log_report()
+    return collector.dois()
+
+
+def benchmark_pipelines(faculties):
+    """
+    Times the harvest step of the existing scripts for the faculties.
+
+    Parameters:
+    faculties (list): The faculty keys to harvest.
+
+    Returns:
+    dict: Per script the wall-clock seconds, the number of requests and the number of items harvested.
+    """
+    # imported here, the scripts pull in pandas and the Pure modules
+    import update_researchoutput_from_ricgraph
+    import update_datasets_from_ricgraph
+    import enrich_internal_persons_with_ids
+
+    harvests = {
+        'external persons and organizations':
+            lambda: harvest_researchoutput_dois(faculties),
+        'research output import':
+            lambda: update_researchoutput_from_ricgraph.select_persons_researchoutput(faculties)[0],
+        'dataset import':
+            lambda: update_datasets_from_ricgraph.select_persons_datasets(faculties, 'faculties'),
+        'internal persons':
+            lambda: enrich_internal_persons_with_ids.select_persons(faculties, 'faculties'),
+    }
+
+    results = {}
+    for name, harvest in harvests.items():
+        ricgraph_utils.client.stats = {}
+        start = time.perf_counter()
+        items = harvest()
+        seconds = time.perf_counter() - start
+        requests_total = sum(stat['requests'] for stat in ricgraph_utils.client.stats.values())
+        results[name] = {'seconds': seconds, 'requests': requests_total, 'items': len(items)}
+        logger.info(f"{name}: {len(items)} items, {requests_total} requests in {seconds:.1f}s "
+                    f"({requests_total / seconds if seconds else 0:.1f} requests/s, "
+                    f"{len(items) / seconds if seconds else 0:.1f} items/s)")
+    return results
+
+
+def main(faculty, category, pipelines=False):
+    logger.info(f"Benchmarking the harvest of {category} for faculty {faculty}")
+    # no cache: nothing is read from it, and the benchmark answers are not written to it
+    ricgraph_utils.client.cache = None
+
+    results = {}
+    for strategy in ('bulk', 'personroot'):
+        results[strategy] = run_strategy(faculty, category, strategy)
+        report(strategy, results[strategy])
+
+    bulk = set(results['bulk']['collector'].dois())
+    personroot = set(results['personroot']['collector'].dois())
+    logger.info(f"{len(bulk & personroot)} DOIs found by both, {len(bulk - personroot)} only by bulk, "
+                f"{len(personroot - bulk)} only by personroot")
+
+    if pipelines:
+        results['pipelines'] = benchmark_pipelines([faculty])
+    return results
+
+
+# ########################################################################
+# MAIN
+# ########################################################################
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the bulk and person-root harvest of a faculty')
+    parser.add_argument('faculty', type=str, nargs='?',
+                        default='uu faculty: information & technology services|organization_name',
+                        help='Faculty key to harvest (with --mock the first mock faculty is used by default)')
+    parser.add_argument('--category', type=str, default='journal article', help='Ricgraph category to harvest')
+    parser.add_argument('--pipelines', action='store_true', help='Also time the harvest step of every script')
+    parser.add_argument('--mock', action='store_true', help='Run against a local mock of Ricgraph')
+    parser.add_argument('--persons', type=int, default=200, help='With --mock: person-roots per faculty')
+    parser.add_argument('--outputs', type=int, default=20, help='With --mock: research outputs per person-root')
+    parser.add_argument('--latency', type=float, default=0.05, help='With --mock: seconds added to every response')
+
+    args = parser.parse_args()
+    faculty = args.faculty
+    if args.mock:
+        server = mock_ricgraph.start(latency=args.latency, faculties=1, persons=args.persons, outputs=args.outputs)
+        ricgraph_utils.client.base_url = server.base_url
+        if faculty == parser.get_default('faculty'):
+            faculty = server.graph.faculties[0]['_key']
+        logger.info(f"Using mock Ricgraph on {server.base_url}")
+
+    main(faculty, args.category, args.pipelines)
@@ -0,0 +1,235 @@
+# ########################################################################
+# Script: cache_utils.py
+#
+# Description:
+# This script provides a small persistent cache that keeps API responses
+# between runs of the BackToPure scripts. It is meant to be imported as a
+# module and should not be executed standalone.
+#
+# Functions include:
+# - Storing JSON values on disk in a SQLite file per cache.
+# - Expiring entries after a configurable time to live.
+# - Removing the least recently used entries when the cache grows too big.
+# - A LookupCache that remembers the answers of lookups in Pure for the run
+#   and, through a PersistentCache, between runs.
+# - A BloomFilter that can be saved to and loaded from a file.
+#
+# Important:
+# The caches are stored in the directory set by Directory in the [CACHE]
+# section of config.ini (src/cache by default). Removing that directory
+# clears all caches.
+#
+# Dependencies:
+# - sqlite3, json, threading, etc.
+#
+# Author: David Grote Beverborg
+# Created: 2024
+#
+# License:
+# MIT License
+#
+# Copyright (c) 2024 David Grote Beverborg
+# ########################################################################
+
+
+import hashlib
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+from config import CACHE_DIR
+
+# returned by PersistentCache.get when a key is not (or no longer) in the cache,
+# so a cached None can be told apart from a miss
+MISSING = object()
+
+
+class PersistentCache:
+    """
+    On-disk key/value cache with a time to live and a maximum size.
+
+    Values are stored as JSON in a SQLite file. Entries older than ttl seconds
+    are treated as missing, and when the total size passes max_bytes the least
+    recently used entries are removed. The cache can be shared between threads.
+    """
+
+    def __init__(self, name, ttl, max_bytes, directory=CACHE_DIR):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f'{name}.sqlite')
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache "
+            "(key TEXT PRIMARY KEY, value TEXT, size INTEGER, created REAL, accessed REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)")
+        self._conn.commit()
+        self._total_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+
+    def get(self, key):
+        """Return the cached value for key, or MISSING if it is not cached or has expired."""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT value, size, created FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return MISSING
+            value, size, created = row
+            if now - created > self.ttl:
+                self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                self._conn.commit()
+                self._total_bytes -= size
+                return MISSING
+            self._conn.execute("UPDATE cache SET accessed = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+        return json.loads(value)
+
+    def set(self, key, value):
+        """Store a JSON serializable value under key."""
+        now = time.time()
+        data = json.dumps(value)
+        size = len(data)
+        with self._lock:
+            row = self._conn.execute("SELECT size FROM cache WHERE key = ?", (key,)).fetchone()
+            if row:
+                self._total_bytes -= row[0]
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                (key, data, size, now, now)
+            )
+            self._total_bytes += size
+            if self._total_bytes > self.max_bytes:
+                self._evict(now)
+            self._conn.commit()
+
+    def delete(self, key):
+        """Remove key from the cache."""
+        with self._lock:
+            row = self._conn.execute("SELECT size FROM cache WHERE key = ?", (key,)).fetchone()
+            if row:
+                self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                self._conn.commit()
+                self._total_bytes -= row[0]
+
+    def clear(self):
+        """Remove all entries from the cache."""
+        with self._lock:
+            self._conn.execute("DELETE FROM cache")
+            self._conn.commit()
+            self._total_bytes = 0
+
+    def _evict(self, now):
+        # first drop what has expired anyway, then the least recently used entries
+        self._conn.execute("DELETE FROM cache WHERE created < ?", (now - self.ttl,))
+        self._total_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+        if self._total_bytes <= self.max_bytes:
+            return
+        rows = self._conn.execute("SELECT key, size FROM cache ORDER BY accessed").fetchall()
+        to_delete = []
+        for key, size in rows:
+            if self._total_bytes <= self.max_bytes:
+                break
+            to_delete.append((key,))
+            self._total_bytes -= size
+        self._conn.executemany("DELETE FROM cache WHERE key = ?", to_delete)
+
+
+class LookupCache:
+    """
+    The answers of a lookup in Pure, e.g. ISSN -> journal uuid, remembered for the run
+    and, when ttl is above 0, in a PersistentCache between runs.
+
+    None is a valid answer (Pure has no match), get returns MISSING for a key that
+    was never looked up. Failed lookups should not be remembered.
+    """
+
+    def __init__(self, name, ttl, max_bytes, directory=CACHE_DIR):
+        self.cache = PersistentCache(name, ttl, max_bytes, directory) if ttl > 0 else None
+        self._values = {}
+
+    def get(self, key):
+        """Return the answer for key from this run or the persistent cache, or MISSING."""
+        if key in self._values:
+            return self._values[key]
+        if self.cache is not None:
+            value = self.cache.get(key)
+            if value is not MISSING:
+                self._values[key] = value
+                return value
+        return MISSING
+
+    def remember(self, key, value):
+        self._values[key] = value
+        if self.cache is not None:
+            self.cache.set(key, value)
+
+    def forget(self, key):
+        """Drop the answer for key, so the next lookup asks Pure again."""
+        self._values.pop(key, None)
+        if self.cache is not None:
+            self.cache.delete(key)
+
+
+class BloomFilter:
+    """
+    Set of strings that answers "certainly not in the set" or "probably in the set".
+
+    A string that was added is always found; a string that was not added is found
+    with a chance of about error_rate, as long as no more than capacity strings are
+    added. Saved as a small JSON header line followed by the bits.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(capacity, 1)
+        self.size = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+        self.created = time.time()
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], 'big'), int.from_bytes(digest[8:], 'big') | 1
+        return ((first + i * second) % self.size for i in range(self.hashes))
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position // 8] |= 1 << (position % 8)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[position // 8] & (1 << (position % 8)) for position in self._positions(key))
+
+    def __len__(self):
+        return self.count
+
+    def age_hours(self):
+        return (time.time() - self.created) / 3600
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        header = {'size': self.size, 'hashes': self.hashes, 'count': self.count, 'created': self.created}
+        with open(path + '.tmp', 'wb') as f:
+            f.write(json.dumps(header).encode('utf-8') + b'\n')
+            f.write(self.bits)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path):
+        """Return the filter saved in path, or None if there is none (or it cannot be read)."""
+        try:
+            with open(path, 'rb') as f:
+                header = json.loads(f.readline())
+                bits = bytearray(f.read())
+        except (OSError, ValueError):
+            return None
+        bloom = cls.__new__(cls)
+        bloom.size, bloom.hashes = header['size'], header['hashes']
+        bloom.count, bloom.created = header['count'], header['created']
+        bloom.bits = bits
+        if len(bits) != (bloom.size + 7) // 8:
+            return None
+        return bloom
@@ -1,7 +1,8 @@
 import configparser
 import os
 
-config_path = os.path.join(os.path.dirname(__file__), 'config.ini')
+# BTP_CONFIG points to another configuration file, e.g. for the tests
+config_path = os.environ.get('BTP_CONFIG', os.path.join(os.path.dirname(__file__), 'config.ini'))
 
 if not os.path.exists(config_path):
     raise FileNotFoundError(f"The configuration file {config_path} does not exist.")
@@ -11,8 +12,16 @@ config.read(config_path)
 
 PURE_BASE_URL = config['PURE-API']['BaseURL']
 PURE_API_KEY = config['PURE-API']['APIKey']
+PURE_MAX_CONCURRENCY = config['PURE-API'].getint('MaxConcurrency', fallback=8)
+PURE_RATE_LIMIT = config['PURE-API'].getfloat('RateLimit', fallback=10)
+PURE_TIMEOUT = config['PURE-API'].getint('Timeout', fallback=100)
+PURE_MIN_RATE_LIMIT = config['PURE-API'].getfloat('MinRateLimit', fallback=1)
+PURE_THROTTLE_RETRIES = config['PURE-API'].getint('ThrottleRetries', fallback=5)
 RIC_BASE_URL = config['RICGRAPH-API']['BaseURL']
 FACULTY_PREFIX = config['RICGRAPH-API']['FacultyPrefix']
+RIC_MAX_WORKERS = config['RICGRAPH-API'].getint('MaxWorkers', fallback=10)
+RIC_TIMEOUT = config['RICGRAPH-API'].getint('Timeout', fallback=120)
+RIC_HARVEST_STRATEGY = config['RICGRAPH-API'].get('HarvestStrategy', fallback='auto').strip().lower()
 OPENALEX_BASE_URL = config['OPENALEX_PURE']['BaseURL']
 EMAIL = config['OPENALEX_PURE']['email']
 OPENALEX_ID_URI = config['ID_URI']['OPENALEX']
@@ -23,6 +32,20 @@ ROR_ID_URI = config['ID_URI']['ROR_ID_URI']
 ID_URI = config['ID_URI']
 TYPE_URI = config['URI']
 CATEGORIES = config['RICGRAPH-API']['rescat']
+RESEARCH_CATEGORIES = [category.strip() for category in CATEGORIES.split(',') if category.strip()]
+RIC_COMBINED_CATEGORIES = config['RICGRAPH-API'].getboolean('CombinedCategories', fallback=True)
+
+# relative directories are relative to src, not to the directory the scripts are started from
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), config.get('CACHE', 'Directory', fallback='cache'))
+RIC_CACHE_TTL = config.getint('CACHE', 'RicgraphTTL', fallback=86400)
+RIC_CACHE_MAX_BYTES = config.getint('CACHE', 'RicgraphMaxSizeMB', fallback=500) * 1024 * 1024
+PERSON_INDEX_MAX_AGE = config.getint('CACHE', 'PersonIndexMaxAge', fallback=24)
+PURE_LOOKUP_TTL = config.getint('CACHE', 'PureLookupTTL', fallback=604800)
+PURE_LOOKUP_MAX_BYTES = config.getint('CACHE', 'PureLookupMaxSizeMB', fallback=50) * 1024 * 1024
+DATASET_BLOOM_MAX_AGE = config.getint('CACHE', 'DatasetBloomMaxAge', fallback=24)
+RESEARCH_OUTPUT_SNAPSHOT_MAX_AGE = config.getint('CACHE', 'ResearchOutputSnapshotMaxAge', fallback=24)
+STATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), config.get('STATE', 'Directory', fallback='state'))
+STATE_RETRY_REJECTED_DAYS = config.getint('STATE', 'RetryRejectedDays', fallback=30)
 
 DEFAULTS = config['DEFAULTS']
 
@@ -39,7 +39,10 @@ import json
 import csv
 import sys
 import btp
-from config import PURE_BASE_URL, PURE_API_KEY, PURE_HEADERS, RIC_BASE_URL, ID_URI, FACULTY_PREFIX
+import pure_client
+import ricgraph_utils
+import ricgraph_dump
+from config import PURE_BASE_URL, PURE_API_KEY, ID_URI, FACULTY_PREFIX
 from logging_config import setup_logging
 
 import os
@@ -56,38 +59,10 @@ def is_nan(value):
     """
     return value is None or (isinstance(value, float) and math.isnan(value))
 
-def fetch_personroots(faculty_key):
-
-    try:
-        params = {'key': faculty_key, 'max_nr_items': '0'}
-        url = RIC_BASE_URL + 'get_all_personroot_nodes'
-        response = requests.get(url, params=params)
-        # print(response, faculty_key)
-        # response.raise_for_status()
-        return response.json().get("results", [])
-    except requests.RequestException as e:
-        logger.error(f"Error fetching person-roots for faculty {faculty_key}: {e}")
-        return []
-
-def fetch_person_ids(persoonroot_key):
-    try:
-        params = {'key': persoonroot_key, 'category_want': 'person'}
-        url = RIC_BASE_URL + 'get_all_neighbor_nodes'
-        response = requests.get(url, params=params)
-        # response.raise_for_status()
-        return response.json().get("results", [])
-    except requests.RequestException as e:
-        logger.error(f"Error fetching person IDs for person-root {persoonroot_key}: {e}")
-        return []
-
 def checkenrichement(persoonroot_key):
     try:
-        params = {'key': persoonroot_key, 'source_system': 'pure uu', 'max_nr_items': 0}
-        url = RIC_BASE_URL + 'person/enrich'
-        response = requests.get(url, params=params)
-        # response.raise_for_status()
-        return response.json().get("results", [])
-    except requests.RequestException as e:
+        return ricgraph_utils.client.enrich_person(persoonroot_key, 'pure uu')
+    except (requests.RequestException, ValueError) as e:
         logger.error(f"Error fetching person IDs for person-root {persoonroot_key}: {e}")
         return []
 
@@ -100,14 +75,14 @@ def select_persons(faculties, faculty_choice):
         logger.info(f"Processing faculty: {faculty}")
 
 
-        personroots = fetch_personroots(faculty)
+        personroots = ricgraph_utils.fetch_personroots(faculty)
         logger.info(f"Processing {str(len(personroots))} persons in ricgraph, this can be slow...")
 
         for personroot in personroots:
             count += 1
             if count % 250 == 0:
                 logger.debug(f"Processed {str(count)} persons in ricgraph")
-            personids = fetch_person_ids(personroot['_key'])
+            personids = ricgraph_utils.fetch_person_ids(personroot['_key'])
             persons.extend([
                 [personroot['_key'], personid['name'], personid['value']]
                 for personid in personids
@@ -137,7 +112,7 @@ def update_person(new_ids, data, api_url):
             data['identifiers'].append(new_identifier)
         else:
             data['identifiers'] = [new_identifier]
-    response2 = requests.put(api_url, headers=PURE_HEADERS, json=data)
+    response2 = pure_client.client.put(api_url, json=data)
 
 
 def check_new_ids(row, data):
@@ -208,7 +183,7 @@ def fetch_person_data(person_df, batch_size):
         url = PURE_BASE_URL + 'persons/search/'
 
         try:
-            response = requests.post(url, headers=PURE_HEADERS, json=json_data)
+            response = pure_client.client.post(url, json=json_data)
             response.raise_for_status()
             response_data = response.json()
             batch_data = response_data.get('items', [])
@@ -324,6 +299,8 @@ def main(faculty_choice):
     if not person_df.empty:
        datatotal = fetch_person_data(person_df, 100)
        update_persons(person_df, datatotal)
+    ricgraph_utils.client.log_stats()
+    pure_client.client.log_stats()
     logger.info(f"Script enrich persons part 1 has ended")
 
 
@@ -339,8 +316,14 @@ if __name__ == '__main__':
                         # default='all',
                         help='Faculty choice or "all"')
     parser.add_argument('test_choice', type=str, nargs='?', default='yes', help='Run in test mode ("yes" or "no")')
+    parser.add_argument('--refresh', action='store_true', help='Ignore cached Ricgraph responses and fetch them again')
+    parser.add_argument('--dump', type=str, metavar='FILE',
+                        help='Answer the Ricgraph requests from a Ricgraph export (CSV, JSON or ingested .sqlite)')
 
     args = parser.parse_args()
+    ricgraph_utils.client.refresh = args.refresh
+    if args.dump:
+        ricgraph_dump.use_dump(args.dump)
 
     main(args.faculty_choice)
 
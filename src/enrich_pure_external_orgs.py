@@ -29,20 +29,23 @@
 # ########################################################################
 
 
-import time
 import csv
 import pandas as pd
 import logging
 from logging_config import setup_logging
 import requests
+import pure_client
 import enrich_pure_external_persons as enrich
+import ricgraph_utils
+import ricgraph_dump
+import harvest_state
+import pure_snapshot
 import json
+import copy
 import argparse
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
 import urllib3
 import os
-from config import PURE_BASE_URL, PURE_API_KEY, PURE_HEADERS, RIC_BASE_URL, ROR_ID_URI, ORCID_ID_URI, OPENALEX_HEADERS
+from config import PURE_BASE_URL, PURE_API_KEY, PURE_HEADERS, ROR_ID_URI, ORCID_ID_URI, OPENALEX_HEADERS, RESEARCH_CATEGORIES
 
 logger = setup_logging('btp', level=logging.INFO)
 
@@ -51,16 +54,7 @@ headers = {
     'Accept': 'application/json',
     'api-key': PURE_API_KEY,
 }
-# Set up a single session for all requests
-session = requests.Session()
-retry_strategy = Retry(
-    total=5,
-    status_forcelist=[429, 500, 502, 503, 504],
-    allowed_methods=["HEAD", "GET", "OPTIONS", "PUT", "POST"],
-    backoff_factor=1
-)
-adapter = HTTPAdapter(max_retries=retry_strategy)
-session.mount("https://", adapter)
+# The Pure requests go through pure_client, which limits the concurrency and the rate
 # Disable only the single InsecureRequestWarning from urllib3 needed to use the InsecureRequestWarning
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
@@ -170,19 +164,24 @@ def identifier_exists(identifiers, new_id, id_type_uri):
         if 'type' in identifier and identifier['type']['uri'] == id_type_uri and identifier['id'] == new_id:
             return True
     return False
-def update_externalorg_pure(orgs, test_choice, update):
-    # Set up retry strategy
-    retry_strategy = Retry(
-        total=5,
-        status_forcelist=[429, 500, 502, 503, 504],
-        allowed_methods=["HEAD", "GET", "OPTIONS", "PUT"],
-        backoff_factor=1
-    )
-
-    adapter = HTTPAdapter(max_retries=retry_strategy)
-
-
+def update_externalorg_pure(orgs, test_choice, update, pure_orgs=None):
+    """
+    Prepares the update of the external organizations with their new ROR.
+
+    The records are taken from pure_orgs (as fetched by fetch_pure_extorgs) and only
+    fetched from Pure when they are not in there. The records in pure_orgs are not changed.
+
+    Parameters:
+    orgs (list): The matched organizations with their uuid and ror, every uuid once.
+    test_choice (str): "yes" for a test run.
+    update (int): The number of updates so far.
+    pure_orgs (dict, optional): The external organizations by UUID.
+
+    Returns:
+    tuple: update, whether an organization already had the ROR, the rows and the JSON objects to update.
+    """
     inpure = False
+    pure_orgs = pure_orgs or {}
     # Initialize a list to store rows for the DataFrame
     rows_to_update = []
 
@@ -190,18 +189,13 @@ def update_externalorg_pure(orgs, test_choice, update):
     json_updates = []
 
     for row in orgs:
-        session = requests.Session()
-        session.mount("https://", adapter)
-
-        headers = {
-            'Accept': 'application/json',
-            'api-key': PURE_API_KEY,
-        }
-
-        url = PURE_BASE_URL + 'external-organizations/' + row['uuid']
-        response = session.get(url, headers=headers, verify=False)
-        logging.debug(f"get org data {row['uuid']}. responsecode = {response.status_code}")
-        data = response.json()  # Parse JSON response
+        if row['uuid'] in pure_orgs:
+            data = copy.deepcopy(pure_orgs[row['uuid']])
+        else:
+            url = PURE_BASE_URL + 'external-organizations/' + row['uuid']
+            response = pure_client.client.get(url, headers=headers, verify=False)
+            logging.debug(f"get org data {row['uuid']}. responsecode = {response.status_code}")
+            data = response.json()  # Parse JSON response
         new_ror = None
 
         if row['ror']:
@@ -235,8 +229,6 @@ def update_externalorg_pure(orgs, test_choice, update):
         else:
             inpure = True
 
-        session.close()
-
 
     # for row in orgs:
     #     session = requests.Session()
@@ -287,73 +279,19 @@ def update_externalorg_pure(orgs, test_choice, update):
 def select_faculties(faculty_choice, test_choice):
     logging.info(f"start fetching person-roots for {faculty_choice}")
     logging.info(f"Test run =  {test_choice}")
-    params = {
-        'value': 'uu faculty',
-    }
-    url = RIC_BASE_URL + 'organization/search'
-    response = requests.get(url, params=params)
-    data = response.json()
-    if faculty_choice.lower() == 'all':
-        selected_faculties = [item['_key'] for item in data["results"]]
-    else:
-        selected_faculties = [faculty_choice]
-
-    return selected_faculties
-
-def fetch_personroots(faculty_key):
-    """Fetch person-root nodes for a given faculty."""
-    try:
-        params = {'key': faculty_key, 'max_nr_items': '0'}
-        url = RIC_BASE_URL + 'get_all_personroot_nodes'
-        response = requests.get(url, params=params)
-        # response.raise_for_status()
-        return response.json().get("results", [])
-    except requests.RequestException as e:
-        logging.error(f"Error fetching person-roots for faculty {faculty_key}: {e}")
-        return []
-
-def select_researchoutputs(persoonroot_key):
-    """Fetch person IDs for a given person-ro    ot."""
-    try:
-        params = {'key': persoonroot_key, 'category_want': 'journal article'}
-        url = RIC_BASE_URL + 'get_all_neighbor_nodes'
-        response = requests.get(url, params=params)
-
-        # response.raise_for_status()
-
-        return response.json().get("results", [])
-
-    except requests.RequestException as e:
-        logging.error(f"Error fetching person IDs for person-root {persoonroot_key}: {e}")
-        return []
+    return ricgraph_utils.select_faculties(faculty_choice)
 
 
 def select_persons_researchoutput(selected_faculties):
-    persons = []
-    new_data = []
+    collector = ricgraph_utils.DoiCollector('research outputs')
 
     for faculty in selected_faculties:
         logging.info(f"Processing faculty: {faculty}")
-        personroots = fetch_personroots(faculty)
-        for personroot in personroots:
-            if not personroot['_key'] == None:
-                personroot_key = personroot['_key']
-                outputs = select_researchoutputs(personroot_key)
-                for output in outputs:
-                    doi = output["_key"].split("|")[0]
-
-                    new_data.append(doi)
-                    # print(doi)
-                    # if 'Pure-uu' in output["_source"] and 'OpenAlex-uu' in output["_source"]:
-                    #     new_data.append(doi)
-                    #
-                    # else:
-                    #     print(output["_key"], 'not in both systems')
-
+        ricgraph_utils.collect_faculty_dois(faculty, collector, RESEARCH_CATEGORIES)
 
-    num_elements = len(new_data)
-    logging.info(f"total research output with external persons selected:  {num_elements}")
-    return new_data
+    collector.log_report()
+    logging.info(f"total research output with external persons selected:  {len(collector)}")
+    return collector.dois()
 
 
 def mainproces(doi, pure, open_alex, article_orgs, uuids, oa_ids):
@@ -391,85 +329,49 @@ def fetch_openalex_rors(rors, chunk_size=20):
     return all_results
 
 
-def fetch_pure_extorgs(uuids):
+def fetch_pure_extorgs(uuids, batch_size=500, page_size=500):
+    """
+    Fetches the external organizations with the UUIDs from Pure.
+
+    The UUIDs are sent in the uuids filter of external-organizations/search, batch_size
+    at a time; the batches run in parallel and are paged until all organizations are fetched.
+
+    Parameters:
+    uuids (iterable): The UUIDs of the external organizations.
+    batch_size (int): The number of UUIDs per search.
+    page_size (int): The number of organizations per page.
+
+    Returns:
+    dict: The external organizations by UUID.
+    """
     logger.info(f"start fetching external orgs from pure")
     url = PURE_BASE_URL + 'external-organizations/search'
+    uuids = list(dict.fromkeys(uuid for uuid in uuids if uuid))
+    batches = [uuids[i:i + batch_size] for i in range(0, len(uuids), batch_size)]
 
-    # Function to split the list into batches of size n
-    def split_into_batches(lst, n):
-        for i in range(0, len(lst), n):
-            yield lst[i:i + n]
-
-    # Define batch size for testing
-    batch_size = 10
-
-    # Split the uuids into batches
-    # logger.info(f"Total deduplicated items =  {str(len(deduplicated_dois))}")
-    uuids =  list(uuids)
-    batches = list(split_into_batches(uuids, batch_size))
-
-    # Initialize an empty list to hold all the research outputs
-    all_orgs = []
-    total_dois = set()  # Initialize a set to hold all DOIs
-    # Optional: set a delay between requests to avoid hitting rate limits
-    request_delay = 0.1  # seconds
-    total_items = 0
-    # Loop over each batch and make a request
-    for batch_index, batch in enumerate(batches):
-        pipe_separated_dois = "|".join(batch)
-        logger.info(
-            f"Finding ext orgs for batch {batch_index + 1}/{len(batches)}, {batch_size} DOIs per batch.")
-        json_data = {
-            'size': 100,  # Set size to batch size
-            'searchString': pipe_separated_dois,
-        }
+    def fetch(batch):
         try:
-            # Make the API request using the pre-configured session
-            response = session.post(
-                url,
-                headers=headers,
-                json=json_data,
-                timeout=100
-            )
-            response.raise_for_status()  # Raises an HTTPError for bad responses
-
-            # Parse the response JSON
-            data = response.json()
-            returned_items = data.get('count')
-            logger.debug(f"Total items found for batch {batch_index + 1}: {data.get('count', 0)}")
-            total_items += returned_items
-            orgs = data.get("items", [])  # Extract the list of items
-
-            # Add the retrieved works to the list
-            all_orgs.extend(orgs)
-            logger.debug(f"Batch {batch_index + 1}/{len(batches)}: Retrieved {len(orgs)} items.")
-
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Error occurred while processing batch {batch_index + 1}: {e}")
-   # logger.info(f"Total matching research outputs found: {len(pureworks['results'])}")
-        # Optional: Add a delay between requests to avoid hitting rate limits
-        time.sleep(request_delay)
-
-    # Combine all works into one JSON object
-    orgs = {"results": all_orgs}
-    logger.info(f"Total matching external orgs found: {str(total_items)}")
+            orgs, _ = pure_client.client.fetch_pages(url, page_size, {'uuids': batch}, headers=headers, timeout=100)
+            return orgs
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logger.error(f"Error occurred while fetching a batch of {len(batch)} external orgs: {e}")
+            return []
+
+    orgs = {}
+    for batch_orgs in pure_client.client.map(fetch, batches):
+        for org in batch_orgs:
+            orgs.setdefault(org['uuid'], org)
+    logger.info(f"Total matching external orgs found: {len(orgs)} of {len(uuids)}")
 
     return orgs
 
 
 def get_ext_orgdata_pure(external_organization_uuids, pure_org_data):
-    # List to store the results
-    def get_result_by_uuid(data, target_uuid):
-        # Iterate through all results
-        for result in data.get('results', []):
-            # Check if the uuid matches the target uuid
-            if result.get('uuid') == target_uuid:
-                return result
-        return None
+    # pure_org_data: the external organizations by UUID, see fetch_pure_extorgs
     organization_details = []
 
     for uuid in external_organization_uuids:
-        data = get_result_by_uuid(pure_org_data, uuid)
+        data = pure_org_data.get(uuid)
 
 
         if data:
@@ -539,13 +441,14 @@ def get_ext_orgdata_openalex(oa_unique_institutions, oa_orgsjsons):
     return organization_details
 
 
-def main(faculty_choice, test_choice):
+def main(faculty_choice, test_choice, since_last_run=False):
     logger.info("Script to update external organisations in pure from ricgraph has started")
 
     faculties = select_faculties(faculty_choice, test_choice)
-    researchoutputs = select_persons_researchoutput(faculties)
-    purejsons = enrich.fetch_pure_researchoutputs(researchoutputs)
-    openalexjsons = enrich.fetch_openalex_works(researchoutputs)
+    state = harvest_state.HarvestState('external_orgs')
+    researchoutputs, purejsons, openalexjsons = enrich.stream_researchoutputs(faculties, state=state,
+                                                                             since_last_run=since_last_run,
+                                                                             snapshot=pure_snapshot.current_snapshot())
     rorsuiids =[]
     update = 0
     article_orgs = []
@@ -557,12 +460,10 @@ def main(faculty_choice, test_choice):
         article_orgs, uuids, oa_ids = mainproces(doi, purejsons, openalexjsons, article_orgs, uuids, oa_ids)
 
     pure_orgsjsons = fetch_pure_extorgs(uuids)
-    notupdate = 0
     openalex_orgjsons = fetch_openalex_rors(oa_ids)
-    all_rows_toupdate = []
-    all_jsons_update =[]
 
-    all_orgs_to_update = []
+    # the organizations to update by uuid, an organization found in more articles is updated once
+    all_orgs_to_update = {}
     orgs_with_ror_in_pure = []
     count = 0
     for article in article_orgs:
@@ -572,17 +473,18 @@ def main(faculty_choice, test_choice):
             logger.info(f"Processed {str(count)} batch")
          pure_org_details = get_ext_orgdata_pure(article['external_organization_uuids'], pure_orgsjsons)
          oa_org_details = get_ext_orgdata_openalex(article['unique_institutions'], openalex_orgjsons)
-         orgs_to_update , orgs_with_ror_in_pure = match_organizations(pure_org_details, oa_org_details, )
-         all_orgs_to_update.extend(orgs_to_update)
-
-         orgs_with_ror_in_pure.extend(orgs_with_ror_in_pure)
+         orgs_to_update, article_orgs_with_ror = match_organizations(pure_org_details, oa_org_details, )
+         for org in orgs_to_update:
+             if org['uuid'] not in all_orgs_to_update:
+                 all_orgs_to_update[org['uuid']] = org
+             elif all_orgs_to_update[org['uuid']]['ror'] != org['ror']:
+                 logger.debug(f"ext org {org['uuid']} also matches {org['ror']}, "
+                              f"keeping {all_orgs_to_update[org['uuid']]['ror']}")
 
-         update, inpure, rows_to_update, json_updates  = update_externalorg_pure(orgs_to_update, test_choice, update)
-         all_rows_toupdate.extend(rows_to_update)
-         all_jsons_update.extend(json_updates)
+         orgs_with_ror_in_pure.extend(article_orgs_with_ror)
 
-         if inpure == True:
-             notupdate = notupdate  +1
+    update, inpure, all_rows_toupdate, all_jsons_update = update_externalorg_pure(
+        list(all_orgs_to_update.values()), test_choice, update, pure_orgsjsons)
 
 
     # Save the DataFrame
@@ -597,6 +499,10 @@ def main(faculty_choice, test_choice):
         json.dump(all_jsons_update, json_file, indent=4)
     logger.info(f"nr of ext orgs that can be  updated: {len(all_orgs_to_update)}")
     logger.info(f"nr of ext orgs that already have a ror in pure: {len(orgs_with_ror_in_pure)}")
+    if test_choice != 'yes':
+        enrich.record_enrichment_state(state, researchoutputs, purejsons)
+    ricgraph_utils.client.log_stats()
+    pure_client.client.log_stats()
     unique_rorsuiids = list(set(rorsuiids))
     with open('output.csv', mode='w', newline='') as file:
         writer = csv.writer(file)
@@ -614,7 +520,15 @@ if __name__ == '__main__':
                         # default='uu faculty: information & technology services|organization_name',
                         help='Faculty choice or "all"')
     parser.add_argument('test_choice', type=str, nargs='?', default='no', help='Run in test mode ("yes" or "no")')
+    parser.add_argument('--refresh', action='store_true', help='Ignore cached Ricgraph responses and fetch them again')
+    parser.add_argument('--dump', type=str, metavar='FILE',
+                        help='Answer the Ricgraph requests from a Ricgraph export (CSV, JSON or ingested .sqlite)')
+    parser.add_argument('--since-last-run', action='store_true',
+                        help='Only process the DOIs that are new or changed since the last run')
 
     args = parser.parse_args()
+    ricgraph_utils.client.refresh = args.refresh
+    if args.dump:
+        ricgraph_dump.use_dump(args.dump)
 
-    main(args.faculty_choice, args.test_choice)
+    main(args.faculty_choice, args.test_choice, args.since_last_run)
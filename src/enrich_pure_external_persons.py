@@ -7,7 +7,8 @@
 # additional identifiers such as ORCID and OpenAlex IDs.
 #
 # The script includes:
-# - Fetching research outputs associated with external persons.
+# - Fetching research outputs associated with external persons, streaming the
+#   DOIs from Ricgraph to Pure and OpenAlex while the harvest is running.
 # - Matching authors between Pure and OpenAlex based on identifiers.
 # - Retrieving external person records from Pure and updating them with missing IDs.
 # - Logging and error handling.
@@ -32,18 +33,26 @@
 
 import re
 import os
-import time
+import itertools
+import queue
+import threading
 import pandas as pd
 import logging
 from logging_config import setup_logging
 import requests
+import pure_client
 import json
 import argparse
+import ricgraph_utils
+import ricgraph_dump
+import harvest_state
+import pure_snapshot
 from datetime import datetime
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 import urllib3
-from config import PURE_BASE_URL, PURE_API_KEY, EMAIL, RIC_BASE_URL, OPENALEXEX_ID_URI, ORCID_ID_URI, OPENALEX_HEADERS
+from config import PURE_BASE_URL, PURE_API_KEY, EMAIL, OPENALEXEX_ID_URI, ORCID_ID_URI, OPENALEX_HEADERS, RESEARCH_CATEGORIES
+from tenacity import retry, stop_after_attempt, wait_exponential, RetryError
 from typing import List, Dict
 import sys
 logger = setup_logging('btp', level=logging.INFO)
@@ -53,7 +62,7 @@ headers = {
     'api-key': PURE_API_KEY,
 }
 
-# Set up a single session for all requests
+# Set up a single session for the OpenAlex requests, the Pure requests go through pure_client
 session = requests.Session()
 retry_strategy = Retry(
     total=5,
@@ -158,6 +167,29 @@ def get_ro_from_pure(target_doi, pureworks):
     return None  # Return None if no match is found
 
 
+def record_enrichment_state(state, researchoutputs, pureworks):
+    """
+    Stores in the harvest state which DOIs were enriched, i.e. found in Pure.
+    The DOIs that are not (yet) in Pure are not stored, so the next run with
+    --since-last-run tries them again, e.g. after their research output was imported.
+
+    Parameters:
+    state (HarvestState): The harvest state of the pipeline.
+    researchoutputs (list): The DOIs processed in this run.
+    pureworks (dict): The combined JSON object containing the research outputs from Pure.
+    """
+    in_pure = set()
+    for work in pureworks.get("results", []):
+        for version in work.get('electronicVersions', []):
+            if 'doi' in version:
+                in_pure.add(ricgraph_utils.normalize_doi(version['doi']))
+        for link in work.get('additionalLinks', []):
+            if 'url' in link:
+                in_pure.add(ricgraph_utils.normalize_doi(link['url']))
+    enriched = [doi for doi in researchoutputs if ricgraph_utils.normalize_doi(doi) in in_pure]
+    state.record_many(enriched, harvest_state.ENRICHED)
+
+
 def check_name_match(alex_name, pure_authors):
     # Check for exact full name match
     if alex_name in pure_authors:
@@ -251,29 +283,13 @@ def identifier_exists(identifiers, new_id, id_type_uri):
             return True
     return False
 def update_externalpersons_pure(persons, matched_personsjson, test_choice):
-    def get_person_by_uuid(matched_personsjson, target_uuid):
-        """
-        Retrieves a specific person from the matched_personsjson list based on the provided uuid.
-
-        Parameters:
-        matched_personsjson (list): The list of persons from which to retrieve the specific person.
-        target_uuid (str): The UUID of the person to retrieve.
-
-        Returns:
-        dict: The dictionary of the person that matches the provided uuid. Returns None if no match is found.
-        """
-        for person in matched_personsjson:
-            if person['uuid'] == target_uuid:
-                return person
-        return None
-
     data_to_save = []  # List to store JSON objects for saving
     rows_to_update = []  # List to store rows for the DataFrame
     logger.info(f"start updating external persons from pure")
     ro, matched_persons, updated_persons, already_ids = 0, 0, 0, 0
     for row in persons:
         uuid = row['Pure_UUID']
-        matched_person = get_person_by_uuid(matched_personsjson, uuid)
+        matched_person = matched_personsjson.get(uuid)
 
         if matched_person is None:
             logger.debug(f"Matched person not found for UUID {uuid}")
@@ -402,65 +418,41 @@ def update_externalpersons_pure(persons, matched_personsjson, test_choice):
 
 
 
-def get_external_persons_data(persons):
+def get_external_persons_data(persons, batch_size=500, page_size=500):
     """
     Retrieves the data for all external persons based on their UUIDs using the POST /external-persons/search endpoint.
 
+    The UUIDs are searched once, in batches that run in parallel through the shared Pure
+    client (which paces the requests to what Pure allows); every batch is paged until
+    all its persons are fetched.
+
     Parameters:
-    persons (DataFrame): The DataFrame containing the persons with their UUIDs.
+    persons (list): The matched persons with their Pure_UUID.
+    batch_size (int): The number of UUIDs per search.
+    page_size (int): The number of persons per page.
 
     Returns:
-    list: A list of JSON objects, each representing an external person.
+    dict: The external persons as JSON objects, by UUID.
     """
     logger.info(f"start fetching external persons from pure")
-    all_person_data = []
-    page_size = 500 # Adjust based on Pure API's max page size
-
-    def split_into_batches(lst, n):
-        for i in range(0, len(lst), n):
-            yield lst[i:i + n]
-
-    # Split the UUIDs into batches
-    uids = [person['Pure_UUID'] for person in persons]
-    batches = list(split_into_batches(uids, page_size))
-    session = requests.Session()
-    count = 0
-    for batch in batches:
-        count += 1
-        logger.debug(f"start fetching external persons for batch {count}")
-        json_body = {
-            "uuids": batch,
-            "size": page_size,
-            "offset": 0  # Start with offset 0
-        }
+    uids = list(dict.fromkeys(person['Pure_UUID'] for person in persons if person.get('Pure_UUID')))
+    batches = [uids[i:i + batch_size] for i in range(0, len(uids), batch_size)]
 
+    def fetch(batch):
         try:
-            response = session.post(
-                PURE_BASE_URL + 'external-persons/search',
-                json=json_body,
-                headers=headers,
-                verify=False
-            )
-            time.sleep(0.5)
-            response.raise_for_status()
-            data = response.json()
-            persons_data = data.get("items", [])
-            all_person_data.extend(persons_data)
-
-        except requests.exceptions.RequestException as e:
-            logger.error(f"An error occurred while processing batch: {batch}\nError: {e}")
+            items, _ = pure_client.client.fetch_pages(PURE_BASE_URL + 'external-persons/search', page_size,
+                                                      {"uuids": batch}, headers=headers, verify=False)
+            return items
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logger.error(f"An error occurred while processing a batch of {len(batch)} external persons\nError: {e}")
+            return []
+
+    all_person_data = {}
+    for items in pure_client.client.map(fetch, batches):
+        for person in items:
+            all_person_data.setdefault(person['uuid'], person)
     logger.debug(f"end fetching pure")
-    logger.debug(f"Matching external persons found: {len(all_person_data)}")
-
-    #
-    # output_folder = 'output/external_persons'
-    # os.makedirs(output_folder, exist_ok=True)
-    # ext_perons_json = os.path.join(output_folder, f'ext_personstobeupdated_{datetimetoday}.csv')
-    #
-    # # Write the data to the JSON file
-    # with open(ext_perons_json, 'w') as json_file:
-    #     json.dump(all_person_data, json_file, indent=4)
-
+    logger.debug(f"Matching external persons found: {len(all_person_data)} of {len(uids)}")
 
     return all_person_data
 
@@ -468,73 +460,7 @@ def select_faculties(faculty_choice):
     # the text for logger is wrong, it actually gets person roots, then research output, then external persons. but seems to complicated to inform the user
     logger.info(f"start fetching external persons for {faculty_choice}")
 
-    params = {
-        'value': 'uu faculty',
-    }
-    url = RIC_BASE_URL + 'organization/search'
-    response = requests.get(url, params=params)
-    data = response.json()
-    if faculty_choice.lower() == 'all':
-        selected_faculties = [item['_key'] for item in data["results"]]
-    else:
-        selected_faculties = [faculty_choice]
-
-    return selected_faculties
-
-def fetch_personroots(faculty_key):
-    """Fetch person-root nodes for a given faculty."""
-
-    try:
-        params = {'key': faculty_key, 'max_nr_items': '0'}
-        url = RIC_BASE_URL + 'get_all_personroot_nodes'
-        response = requests.get(url, params=params)
-
-        response.raise_for_status()
-        return response.json().get("results", [])
-    except requests.RequestException as e:
-        logger.error(f"Error fetching person-roots for faculty {faculty_key}: {e}")
-        return []
-
-def select_researchoutputs(persoonroot_key):
-    """Fetch person IDs for a given person-ro    ot."""
-    # categories = CATEGORIES
-    categories =  ['journal article']
-    all_results = []
-
-    for categorie in categories:
-        logger.debug(f"fetching {categorie}")
-        try:
-            params = {'key': persoonroot_key, 'category_want': categorie}
-            url = RIC_BASE_URL + 'get_all_neighbor_nodes'
-            response = requests.get(url, params=params)
-
-            # response.raise_for_status()
-            results = response.json().get("results", [])
-            all_results.extend(results)
-        except requests.RequestException as e:
-            logger.error(f"Error fetching person IDs for person-root {persoonroot_key}: {e}")
-
-    return all_results
-
-
-
-def select_persons_researchoutput(selected_faculties):
-    all_data = []
-    for faculty in selected_faculties:
-        logging.info(f"Processing faculty: {faculty}")
-        personroots = fetch_personroots(faculty)
-        for personroot in personroots:
-            if not personroot['_key'] == None:
-                personroot_key = personroot['_key']
-                outputs = select_researchoutputs(personroot_key)
-                for output in outputs:
-                    doi = output["_key"].split("|")[0]
-
-                    all_data.append(doi)
-
-        all_data.extend(all_data)
-    logger.debug(f"total pubs found in Ricgraph: {len(all_data)}")
-    return all_data
+    return ricgraph_utils.select_faculties(faculty_choice)
 
 
 def match_persons(doi, openalexjsons, purejsons):
@@ -554,55 +480,55 @@ def split_into_batches(lst: List[str], n: int) -> List[List[str]]:
     for i in range(0, len(lst), n):
         yield lst[i:i + n]
 
-def fetch_batch(batch: List[str], url: str, headers: Dict[str, str], timeout: int) -> List[Dict]:
-    """Fetch a single batch of research outputs from the Pure API."""
+def fetch_batch(batch: List[str], url: str, headers: Dict[str, str], timeout: int, page_size: int = 100) -> List[Dict]:
+    """
+    Fetch a single batch of research outputs from the Pure API.
+
+    When Pure finds more research outputs than fit on a page (count is larger than
+    the items returned), the next pages are fetched as well. A batch that fails is
+    logged and returns no research outputs.
+    """
     pipe_separated_dois = "|".join(batch)
-    json_data = {
-        'size': 100,  # Set size to batch size
-        'searchString': pipe_separated_dois,
-    }
     try:
-        response = session.post(url, headers=headers, json=json_data, timeout=timeout)
-        response.raise_for_status()  # Raises HTTPError for bad responses
-        return response.json().get("items", [])
-    except requests.exceptions.RequestException as e:
+        items, count = pure_client.client.fetch_pages(url, page_size, {'searchString': pipe_separated_dois},
+                                                      headers=headers, timeout=timeout)
+        if count > page_size:
+            logger.debug(f"Batch starting with {batch[0]}: {count} research outputs, fetched in several pages")
+        return items
+    except (requests.exceptions.RequestException, ValueError) as e:
         logger.error(f"Error occurred while fetching batch: {e}")
         return []
 
-def fetch_pure_researchoutputs(dois: List[str]) -> Dict:
-    """
-    Fetches research outputs from the Pure API for a given list of DOIs and returns a combined JSON object.
+# Regex to match valid DOI format
+doi_pattern = re.compile(r'^10\.\d{4,9}/[-._;()/:A-Z0-9]+$', re.IGNORECASE)
 
-    Parameters:
-    dois (List[str]): List of DOIs.
 
-    Returns:
-    Dict: Combined JSON object containing all research outputs.
-    """
-    logger.debug("Start fetching research outputs from Pure API")
-    url = PURE_BASE_URL + 'research-outputs/search'
-    # headers = {"Authorization": f"Bearer {PURE_API_KEY}"}  # Replace with your API key logic
-    timeout = 100
-    batch_size = 50
-    request_delay = 0.1
+@retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
+def fetch_openalex_page(url):
+    response = session.get(url)
+    response.raise_for_status()
+    return response.json()
 
-    deduplicated_dois = list(set(dois))
-    batches = list(split_into_batches(deduplicated_dois, batch_size))
-    all_works = []
-    total_items = 0
 
-    for batch_index, batch in enumerate(batches):
-        logger.debug(f"Processing batch {batch_index + 1}/{len(batches)}")
+def fetch_openalex_batch(batch: List[str]) -> List[Dict]:
+    """Fetch a single batch of works (at most 50 DOIs) from the OpenAlex API."""
+    pipe_separated_dois = "|".join(batch)
+    url = f"https://api.openalex.org/works?filter=doi:{pipe_separated_dois}&per-page=50&mailto={EMAIL}"
+    all_works = []
+    try:
+        response_data = fetch_openalex_page(url)
+        all_works.extend(response_data.get("results", []))
 
-        works = fetch_batch(batch, url, headers, timeout)
-        total_items += len(works)
-        all_works.extend(works)
+        # Check if there are more pages of results
+        while 'next' in response_data.get('meta', {}):
+            next_url = response_data['meta']['next']
+            response_data = fetch_openalex_page(next_url)
+            all_works.extend(response_data.get("results", []))
 
-        logger.debug(f"Batch {batch_index + 1}/{len(batches)}: Retrieved {len(works)} items.")
-        time.sleep(request_delay)  # Avoid hitting API rate limits
+    except (requests.exceptions.RequestException, RetryError) as e:
+        logger.error(f"An error occurred while processing batch starting with DOI: {batch[0]}\nError: {e}")
+    return all_works
 
-    logger.debug(f"Total matching research outputs found: {total_items}")
-    return {"results": all_works}
 
 def fetch_openalex_works(dois):
     """
@@ -614,52 +540,13 @@ def fetch_openalex_works(dois):
     Returns:
     dict: Combined JSON object containing all works.
     """
-    openalexworks = {}
-    # Function to split the list into batches of size n
-    def split_into_batches(lst, n):
-        for i in range(0, len(lst), n):
-            yield lst[i:i + n]
-
-    # Regex to match valid DOI format
-    doi_pattern = re.compile(r'^10\.\d{4,9}/[-._;()/:A-Z0-9]+$', re.IGNORECASE)
-
     # Filter valid DOIs
     dois = [doi for doi in dois if doi_pattern.match(doi)]
 
-    from tenacity import retry, stop_after_attempt, wait_exponential
-
     # Split the DOIs into batches of 40 (consistent with the code)
-    batches = list(split_into_batches(dois, 40))
-
-    # Initialize an empty list to hold all the works
     all_works = []
-
-    # Define a retry decorator for making requests
-    @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
-    def fetch_batch(url):
-        response = session.get(url)
-        response.raise_for_status()
-        return response.json()
-
-    # Loop over each batch and make a request
-    for batch in batches:
-        pipe_separated_dois = "|".join(batch)
-        url = f"https://api.openalex.org/works?filter=doi:{pipe_separated_dois}&per-page=50&mailto={EMAIL}"
-
-        try:
-            response_data = fetch_batch(url)
-            works = response_data.get("results", [])
-            all_works.extend(works)
-
-            # Check if there are more pages of results
-            while 'next' in response_data.get('meta', {}):
-                next_url = response_data['meta']['next']
-                response_data = fetch_batch(next_url)
-                works = response_data.get("results", [])
-                all_works.extend(works)
-
-        except requests.exceptions.RequestException as e:
-            logger.error(f"An error occurred while processing batch starting with DOI: {batch[0]}\nError: {e}")
+    for batch in split_into_batches(dois, 40):
+        all_works.extend(fetch_openalex_batch(batch))
 
     # Combine all works into one JSON object
     openalexworks = {"results": all_works} if all_works else {}
@@ -670,6 +557,129 @@ def fetch_openalex_works(dois):
 
     return openalexworks
 
+def stream_researchoutputs(faculties, pure_batch_size=50, openalex_batch_size=40, queue_size=1000,
+                           state=None, since_last_run=False, snapshot=None, workers=None):
+    """
+    Harvests the DOIs of the faculties from Ricgraph and fetches them from Pure and
+    OpenAlex while the harvest is still running.
+
+    The harvest is a generator that feeds every new DOI into two bounded queues.
+    A dispatcher thread per service takes the DOIs from its queue and sends a batch
+    as soon as it is full, so the waits on Ricgraph, Pure and OpenAlex overlap. The
+    Pure batches are fetched in parallel through pure_client.client.map; the OpenAlex
+    batches one at a time.
+    With a snapshot of the Pure research outputs (pure_snapshot.current_snapshot)
+    Pure is not searched, the research outputs of the DOIs are taken from the snapshot.
+
+    Parameters:
+    faculties (list): The faculty keys to harvest.
+    pure_batch_size (int): Number of DOIs per request to Pure.
+    openalex_batch_size (int): Number of DOIs per request to OpenAlex.
+    queue_size (int): Maximum number of DOIs waiting per service.
+    state (HarvestState, optional): Remembers the fingerprints of the DOIs for recording their outcome.
+    since_last_run (bool): Skip the DOIs that the state has as processed and unchanged.
+    snapshot (ResearchOutputSnapshot, optional): Up to date research outputs of Pure.
+    workers (int, optional): The number of Pure batches fetched at the same time, at most MaxConcurrency of [PURE-API].
+
+    Returns:
+    tuple: The list of unique DOIs (that still have to be processed), the combined Pure JSON ({"results": [...]})
+           and the combined OpenAlex JSON, in the same form as fetch_openalex_works.
+    """
+    url = PURE_BASE_URL + 'research-outputs/search'
+    timeout = 100
+    pure_queue = queue.Queue(maxsize=queue_size)
+    openalex_queue = queue.Queue(maxsize=queue_size)
+    pure_works = []
+    openalex_works = []
+
+    def batches(doi_queue, batch_size):
+        # the DOIs of the queue in batches, until the None that ends the harvest
+        batch = []
+        while True:
+            doi = doi_queue.get()
+            if doi is not None:
+                batch.append(doi)
+            if batch and (len(batch) == batch_size or doi is None):
+                yield batch
+                batch = []
+            if doi is None:
+                return
+
+    def fetcher(fetch, service):
+        batch_count = itertools.count(1)
+
+        def fetch_logged(batch):
+            # a failing batch must not stop the dispatcher: nothing else empties its queue,
+            # and the harvest would block on put() forever
+            try:
+                works = fetch(batch)
+            except Exception as e:
+                logger.error(f"Error fetching a batch of {len(batch)} DOIs from {service}, "
+                             f"starting with {batch[0]}: {e}")
+                works = []
+            count = next(batch_count)
+            if count % 10 == 1:
+                logger.info(f"Fetched {count} batches from {service}")
+            return works
+        return fetch_logged
+
+    def dispatch_openalex():
+        fetch = fetcher(fetch_openalex_batch, 'OpenAlex')
+        for batch in batches(openalex_queue, openalex_batch_size):
+            openalex_works.extend(fetch(batch))
+
+    def dispatch_pure():
+        # map takes the batches as they come and runs up to workers of them at the same
+        # time; the results are combined in the order of the batches
+        fetch = fetcher(lambda batch: fetch_batch(batch, url, headers, timeout), 'Pure')
+        for works in pure_client.client.map(fetch, batches(pure_queue, pure_batch_size), workers):
+            pure_works.extend(works)
+
+    dispatchers = [threading.Thread(target=dispatch_openalex)]
+    if snapshot is None:
+        dispatchers.append(threading.Thread(target=dispatch_pure))
+    snapshot_uuids = set()
+    for dispatcher in dispatchers:
+        dispatcher.start()
+
+    collector = ricgraph_utils.DoiCollector('research outputs')
+    dois = []
+    try:
+        for doi, faculty, personroot, sources in ricgraph_utils.iter_researchoutput_dois(faculties,
+                                                                                          RESEARCH_CATEGORIES):
+            doi = collector.add(doi, faculty, personroot, sources)
+            if doi is None:
+                continue
+            if state is not None:
+                fingerprint = ricgraph_utils.source_fingerprint(sources)
+                if since_last_run and not state.is_pending(doi, fingerprint):
+                    continue
+                state.fingerprints[doi] = fingerprint
+            dois.append(doi)
+            if snapshot is None:
+                pure_queue.put(doi)
+            else:
+                for work in snapshot.find_by_doi(doi):
+                    if work['uuid'] not in snapshot_uuids:
+                        snapshot_uuids.add(work['uuid'])
+                        pure_works.append(work)
+            if doi_pattern.match(doi):
+                openalex_queue.put(doi)
+    finally:
+        # tell the dispatchers to send their last batch and stop
+        pure_queue.put(None)
+        openalex_queue.put(None)
+        for dispatcher in dispatchers:
+            dispatcher.join()
+
+    collector.log_report()
+    if since_last_run:
+        logger.info(f"{len(dois)} of {len(collector)} research outputs are new or changed since the last run")
+    logger.debug(f"total pubs found in Ricgraph: {len(collector)}")
+    logger.debug(f"Total matching research outputs found: {len(pure_works)}")
+    logger.debug(f"Total number of works fetched from Open Alex: {len(openalex_works)}")
+    return dois, {"results": pure_works}, ({"results": openalex_works} if openalex_works else {})
+
 def match_all_persons(researchoutputs, openalexjsons, purejsons):
     all_persons = []
 
@@ -682,7 +692,7 @@ def match_all_persons(researchoutputs, openalexjsons, purejsons):
     logger.info(f"total external persons found: {len(all_persons)}")
     return all_persons
 
-def main(faculty_choice, test_choice):
+def main(faculty_choice, test_choice, since_last_run=False):
     logger.info("Script to update external persons in pure from ricgraph has started")
 
     logger.info("The script performs the following steps:\n"
@@ -693,13 +703,18 @@ def main(faculty_choice, test_choice):
                  "**Note:** The process may take a while before log items appear on the screen, especially if a large faculty is chosen.")
     faculties = select_faculties(faculty_choice)
 
-    researchoutputs = select_persons_researchoutput(faculties)
-    purejsons = fetch_pure_researchoutputs(researchoutputs)
-    openalexjsons = fetch_openalex_works(researchoutputs)
+    state = harvest_state.HarvestState('external_persons')
+    researchoutputs, purejsons, openalexjsons = stream_researchoutputs(faculties, state=state,
+                                                                       since_last_run=since_last_run,
+                                                                       snapshot=pure_snapshot.current_snapshot())
     all_persons = match_all_persons(researchoutputs, openalexjsons, purejsons)
     matched_personsjson = get_external_persons_data(all_persons)
 
     update_externalpersons_pure(all_persons, matched_personsjson, test_choice)
+    if test_choice != 'yes':
+        record_enrichment_state(state, researchoutputs, purejsons)
+    ricgraph_utils.client.log_stats()
+    pure_client.client.log_stats()
     logger.info(f"Script import research output part 1 has ended, ")
 
 # ########################################################################
@@ -714,5 +729,13 @@ if __name__ == '__main__':
                         # default='uu faculty: faculteit geowetenschappen|organization_name',
                         help='Faculty choice or "all"')
     parser.add_argument('test_choice', type=str, nargs='?', default='yes', help='Run in test mode ("yes" or "no")')
+    parser.add_argument('--refresh', action='store_true', help='Ignore cached Ricgraph responses and fetch them again')
+    parser.add_argument('--dump', type=str, metavar='FILE',
+                        help='Answer the Ricgraph requests from a Ricgraph export (CSV, JSON or ingested .sqlite)')
+    parser.add_argument('--since-last-run', action='store_true',
+                        help='Only process the DOIs that are new or changed since the last run')
     args = parser.parse_args()
-    main(args.faculty_choice, args.test_choice)
+    ricgraph_utils.client.refresh = args.refresh
+    if args.dump:
+        ricgraph_dump.use_dump(args.dump)
+    main(args.faculty_choice, args.test_choice, args.since_last_run)
@@ -0,0 +1,146 @@
+# ########################################################################
+# Script: harvest_state.py
+#
+# Description:
+# This script keeps track of the DOIs that earlier runs of the import and
+# enrichment scripts have processed, so a run with --since-last-run only
+# handles the DOIs that are new or changed since then. It is meant to be
+# imported as a module and should not be executed standalone.
+#
+# Functions include:
+# - Storing per pipeline the outcome of every processed DOI (imported, already
+#   in Pure, enriched or rejected), a fingerprint of the DOI in Ricgraph and
+#   the time it was processed, in a SQLite file.
+# - Selecting the DOIs of a harvest that still have to be processed.
+#
+# Important:
+# A DOI is processed again when its fingerprint (the source systems Ricgraph
+# has it from) changes, and a rejected DOI is tried again after
+# RetryRejectedDays. "imported" means the DOI was written to the import file;
+# whether it was applied to Pure is decided later in Apply Updates to Pure.
+# Removing the state directory (src/state by default) makes the next run
+# start from zero.
+#
+# Dependencies:
+# - sqlite3, ricgraph_utils, logging, etc.
+#
+# Author: David Grote Beverborg
+# Created: 2024
+#
+# License:
+# MIT License
+#
+# Copyright (c) 2024 David Grote Beverborg
+# ########################################################################
+
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+from config import STATE_DIR, STATE_RETRY_REJECTED_DAYS
+from logging_config import setup_logging
+from ricgraph_utils import normalize_doi
+
+logger = setup_logging('btp', level=logging.INFO)
+
+IMPORTED = 'imported'
+IN_PURE = 'already_in_pure'
+ENRICHED = 'enriched'
+REJECTED = 'rejected'
+
+
+class HarvestState:
+    """
+    The outcome of every DOI a pipeline has processed.
+
+    The fingerprints of the DOIs that are handed out by pending() are remembered,
+    so record() only needs the DOI and the outcome.
+    """
+
+    def __init__(self, pipeline, directory=STATE_DIR, retry_rejected_days=STATE_RETRY_REJECTED_DAYS):
+        self.pipeline = pipeline
+        self.retry_rejected_seconds = retry_rejected_days * 86400
+        self.fingerprints = {}
+        self.recorded = set()
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, 'harvest_state.sqlite')
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS outcomes "
+            "(pipeline TEXT, doi TEXT, outcome TEXT, fingerprint TEXT, updated REAL, PRIMARY KEY (pipeline, doi))"
+        )
+        self._conn.commit()
+
+    def get(self, doi):
+        """Return (outcome, fingerprint, updated) of the last run that processed the DOI, or None."""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT outcome, fingerprint, updated FROM outcomes WHERE pipeline = ? AND doi = ?",
+                (self.pipeline, normalize_doi(doi))
+            ).fetchone()
+
+    def is_pending(self, doi, fingerprint=None):
+        """
+        Checks if a DOI still has to be processed, and remembers its fingerprint for record().
+
+        Parameters:
+        doi (str): The DOI.
+        fingerprint (str, optional): The fingerprint of the DOI in this harvest.
+
+        Returns:
+        bool: True if the DOI is new, changed, or rejected longer than RetryRejectedDays ago.
+        """
+        doi = normalize_doi(doi)
+        self.fingerprints[doi] = fingerprint
+        row = self.get(doi)
+        if row is None:
+            return True
+        outcome, last_fingerprint, updated = row
+        if fingerprint is not None and fingerprint != last_fingerprint:
+            return True
+        return outcome == REJECTED and time.time() - updated > self.retry_rejected_seconds
+
+    def pending(self, collector):
+        """
+        Returns the DOIs of a DoiCollector that still have to be processed.
+
+        Parameters:
+        collector (DoiCollector): The harvested DOIs.
+
+        Returns:
+        list: The new and changed DOIs, in the order of the collector.
+        """
+        dois = [doi for doi in collector.dois() if self.is_pending(doi, collector.fingerprint(doi))]
+        logger.info(f"{len(dois)} of {len(collector)} {collector.name} are new or changed since the last run")
+        return dois
+
+    def remember(self, collector):
+        """Remembers the fingerprints of all DOIs of a collector, for a run that processes them all."""
+        for doi in collector.dois():
+            self.fingerprints[doi] = collector.fingerprint(doi)
+
+    def record(self, doi, outcome):
+        """Store the outcome of a processed DOI."""
+        self.record_many([doi], outcome)
+
+    def record_many(self, dois, outcome):
+        """Store the same outcome for several processed DOIs."""
+        now = time.time()
+        rows = []
+        for doi in dois:
+            doi = normalize_doi(doi)
+            self.recorded.add(doi)
+            rows.append((self.pipeline, doi, outcome, self.fingerprints.get(doi), now))
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO outcomes (pipeline, doi, outcome, fingerprint, updated) VALUES (?, ?, ?, ?, ?)",
+                rows
+            )
+            self._conn.commit()
+
+    def record_unrecorded(self, dois, outcome):
+        """Store an outcome for the DOIs that got no outcome in this run, e.g. the ones OpenAlex did not return."""
+        self.record_many([doi for doi in dois if normalize_doi(doi) not in self.recorded], outcome)
@@ -6,11 +6,11 @@ import requests
 import csv
 import json
 import argparse
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
 import urllib3
-from config import PURE_BASE_URL, PURE_API_KEY, PURE_HEADERS, RIC_BASE_URL, ROR_ID_URI, ORCID_ID_URI, OPENALEX_HEADERS
+from config import PURE_BASE_URL, PURE_API_KEY, RIC_BASE_URL, ROR_ID_URI, ORCID_ID_URI, OPENALEX_HEADERS
 import enrich_pure_external_orgs as org
+import pure_client
+import pure_persons
 logger = setup_logging('btp', level=logging.INFO)
 
 
@@ -18,16 +18,6 @@ headers = {
     'Accept': 'application/json',
     'api-key': PURE_API_KEY,
 }
-# Set up a single session for all requests
-session = requests.Session()
-retry_strategy = Retry(
-    total=5,
-    status_forcelist=[429, 500, 502, 503, 504],
-    allowed_methods=["HEAD", "GET", "OPTIONS", "PUT", "POST"],
-    backoff_factor=1
-)
-adapter = HTTPAdapter(max_retries=retry_strategy)
-session.mount("https://", adapter)
 # Disable only the single InsecureRequestWarning from urllib3 needed to use the InsecureRequestWarning
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
@@ -55,9 +45,13 @@ def merge_external_orgs(final_result):
         "content-type": "application/json"
     }
 
-    response = requests.post(url, headers=headers, json=payload)
+    response = pure_client.client.post(url, headers=headers, json=payload, retry=False)
     print(response.status_code)
     print(response.text)
+    if response.status_code == 200:
+        # the RORs were ambiguous before the merge
+        for ror_url in final_result:
+            pure_persons.forget_external_org(ror_url)
 def fetch_org_data(rors, batch_size):
     """
     Fetch person data from the Pure API in batches and combine the results.
@@ -86,7 +80,7 @@ def fetch_org_data(rors, batch_size):
         url = PURE_BASE_URL + 'external-organizations/search/'
 
         try:
-            response = requests.post(url, headers=PURE_HEADERS, json=json_data)
+            response = pure_client.client.post(url, json=json_data)
             response.raise_for_status()
             response_data = response.json()
             batch_data = response_data.get('items', [])
@@ -0,0 +1,258 @@
+# ########################################################################
+# Script: mock_ricgraph.py
+#
+# Description:
+# This script runs a local stand-in for the Ricgraph REST API, so harvesting
+# can be tested and benchmarked without putting load on the real Ricgraph.
+# It can be imported (see start()) or executed standalone.
+#
+# Functions include:
+# - Generating synthetic faculties with person-roots, person ids, research
+#   outputs of all rescat categories and datasets. Outputs are shared between
+#   persons of a faculty, and part of them is marked as coming from Pure.
+# - Answering organization/search, get_all_personroot_nodes,
+#   get_all_neighbor_nodes, organization/enrich, person/enrich and
+#   advanced_search in the same form as Ricgraph.
+# - Adding latency to every response and counting the requests per endpoint.
+#
+# Important:
+# The generated graph only depends on the size options and the seed, so two
+# runs with the same options serve the same data.
+# Point RIC_BASE_URL (or ricgraph_utils.client.base_url) to the url that is
+# printed at the start, e.g. http://127.0.0.1:3030/api/
+# The Ricgraph cache is keyed by that url, so the mock answers are cached apart
+# from those of the real Ricgraph.
+#
+# Dependencies:
+# - http.server, json, random, threading, argparse, ricgraph_utils, etc.
+#
+# Author: David Grote Beverborg
+# Created: 2024
+#
+# License:
+# MIT License
+#
+# Copyright (c) 2024 David Grote Beverborg
+# ########################################################################
+
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from config import RESEARCH_CATEGORIES, FACULTY_PREFIX
+# the same source names as the client, so the mock answers what ricgraph_utils asks for
+from ricgraph_utils import PURE_SOURCE, PURE_SOURCE_SYSTEM
+
+
+def node(value, name, category, sources):
+    return {
+        '_key': f"{value}|{name}",
+        'name': name,
+        'value': value,
+        'category': category,
+        '_source': list(sources),
+    }
+
+
+class MockGraph:
+    """
+    A synthetic Ricgraph graph: faculties, their person-roots, and the neighbor
+    nodes (person ids, research outputs and datasets) of every person-root.
+    """
+
+    def __init__(self, faculties=3, persons=50, outputs=20, datasets=2, shared=0.3, in_pure=0.5,
+                 categories=RESEARCH_CATEGORIES, seed=1):
+        rng = random.Random(seed)
+        self.faculties = []
+        self.personroots = {}
+        self.neighbors = {}
+        self.nodes_by_category = {}
+        doi_count = 0
+
+        for f in range(faculties):
+            faculty = node(f"{FACULTY_PREFIX}: mock faculty {f + 1}", 'organization_name', 'organization', [PURE_SOURCE])
+            self.faculties.append(faculty)
+            roots = []
+            faculty_outputs = []
+            for p in range(persons):
+                root = node(f"mock-{f + 1}-{p + 1}", 'person-root', 'person', [])
+                roots.append(root)
+                person_nodes = [
+                    node(f"0000-0001-{f + 1:04d}-{p + 1:04d}", 'ORCID', 'person', ['OpenAlex-uu']),
+                    node(f"Mock, Person {f + 1}.{p + 1}", 'FULL_NAME', 'person', [PURE_SOURCE]),
+                    node(f"00000000-0000-4000-{f + 1:04d}-{p + 1:012d}", 'PURE_UUID_PERS', 'person', [PURE_SOURCE]),
+                ]
+                output_nodes = []
+                for _ in range(outputs):
+                    if faculty_outputs and rng.random() < shared:
+                        # an output of a colleague, so the harvest sees duplicates
+                        output_nodes.append(rng.choice(faculty_outputs))
+                        continue
+                    doi_count += 1
+                    sources = ['OpenAlex-uu', PURE_SOURCE] if rng.random() < in_pure else ['OpenAlex-uu']
+                    category = 'journal article' if rng.random() < 0.6 else rng.choice(categories)
+                    output = node(f"10.9999/mock.{doi_count}", 'doi', category, sources)
+                    faculty_outputs.append(output)
+                    output_nodes.append(output)
+                for _ in range(datasets):
+                    doi_count += 1
+                    output_nodes.append(node(f"10.9999/mockdata.{doi_count}", 'doi', 'data set', ['DataCite-uu']))
+                self.neighbors[root['_key']] = person_nodes + output_nodes
+            self.personroots[faculty['_key']] = roots
+
+        for nodes in self.neighbors.values():
+            for item in nodes:
+                if item['name'] == 'doi':
+                    self.nodes_by_category.setdefault(item['category'], {})[item['_key']] = item
+
+    def search_organizations(self, value):
+        return [faculty for faculty in self.faculties if value.lower() in faculty['value'].lower()]
+
+    def get_personroots(self, key):
+        return self.personroots.get(key, [])
+
+    def get_neighbors(self, key, categories):
+        nodes = self.neighbors.get(key, [])
+        if categories:
+            nodes = [item for item in nodes if item['category'] in categories]
+        return nodes
+
+    def enrich_organization(self, key, categories, source_system):
+        found = {}
+        for root in self.get_personroots(key):
+            for item in self.get_neighbors(root['_key'], categories):
+                if item['name'] == 'doi' and not self._in_source(item, source_system):
+                    found[item['_key']] = item
+        return list(found.values())
+
+    def enrich_person(self, key, source_system):
+        return [item for item in self.get_neighbors(key, ['person']) if not self._in_source(item, source_system)]
+
+    def advanced_search(self, category):
+        return list(self.nodes_by_category.get(category, {}).values())
+
+    @staticmethod
+    def _in_source(item, source_system):
+        return source_system.lower() == PURE_SOURCE_SYSTEM and PURE_SOURCE in item['_source']
+
+
+class MockRicgraphServer(ThreadingHTTPServer):
+    """HTTP server that answers Ricgraph API requests from a MockGraph, with latency."""
+
+    daemon_threads = True
+
+    def __init__(self, address, graph, latency=0.05, jitter=0.02, seed=1):
+        super().__init__(address, MockRicgraphHandler)
+        self.graph = graph
+        self.latency = latency
+        self.jitter = jitter
+        self.rng = random.Random(seed)
+        self.requests = {}
+        self._lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/api/"
+
+    def count(self, endpoint):
+        with self._lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+            delay = self.latency + self.rng.uniform(0, self.jitter)
+        return delay
+
+
+class MockRicgraphHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        endpoint = url.path.strip('/')
+        if endpoint.startswith('api/'):
+            endpoint = endpoint[len('api/'):]
+        params = parse_qs(url.query)
+        time.sleep(self.server.count(endpoint))
+
+        def param(name, default=''):
+            return params.get(name, [default])[0]
+
+        graph = self.server.graph
+        limit = int(param('max_nr_items', '0') or 0)
+        categories = params.get('category_want', [])
+        if endpoint == 'organization/search':
+            results = graph.search_organizations(param('value'))
+        elif endpoint == 'get_all_personroot_nodes':
+            results = graph.get_personroots(param('key'))
+        elif endpoint == 'get_all_neighbor_nodes':
+            results = graph.get_neighbors(param('key'), categories)
+        elif endpoint == 'organization/enrich':
+            results = graph.enrich_organization(param('key'), categories, param('source_system'))
+        elif endpoint == 'person/enrich':
+            results = graph.enrich_person(param('key'), param('source_system'))
+        elif endpoint == 'advanced_search':
+            results = graph.advanced_search(param('category'))
+        else:
+            self.send_error(404, f"Unknown endpoint {endpoint}")
+            return
+
+        if limit > 0:
+            results = results[:limit]
+        body = json.dumps({'meta': {'count': len(results)}, 'results': results}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start(host='127.0.0.1', port=0, latency=0.05, jitter=0.02, **graph_options):
+    """
+    Starts a mock Ricgraph server in a background thread.
+
+    Parameters:
+    host (str): The address to listen on.
+    port (int): The port to listen on, 0 picks a free port.
+    latency (float): Seconds added to every response.
+    jitter (float): Up to this many extra seconds are added at random.
+    graph_options: Passed to MockGraph (faculties, persons, outputs, datasets, shared, in_pure, seed).
+
+    Returns:
+    MockRicgraphServer: The running server, use server.base_url and server.shutdown().
+    """
+    server = MockRicgraphServer((host, port), MockGraph(**graph_options), latency, jitter,
+                                graph_options.get('seed', 1))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# ########################################################################
+# MAIN
+# ########################################################################
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a local mock of the Ricgraph REST API')
+    parser.add_argument('--port', type=int, default=3030, help='Port to listen on')
+    parser.add_argument('--faculties', type=int, default=3, help='Number of faculties')
+    parser.add_argument('--persons', type=int, default=50, help='Number of person-roots per faculty')
+    parser.add_argument('--outputs', type=int, default=20, help='Number of research outputs per person-root')
+    parser.add_argument('--datasets', type=int, default=2, help='Number of datasets per person-root')
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0.02, help='Maximum random extra seconds per response')
+    parser.add_argument('--seed', type=int, default=1, help='Seed for the generated graph')
+
+    args = parser.parse_args()
+    server = MockRicgraphServer(('127.0.0.1', args.port),
+                                MockGraph(args.faculties, args.persons, args.outputs, args.datasets, seed=args.seed),
+                                args.latency, args.jitter, args.seed)
+    print(f"Mock Ricgraph running on {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    for endpoint, count in sorted(server.requests.items()):
+        print(f"{endpoint}: {count} requests")
@@ -0,0 +1,398 @@
+# ########################################################################
+# Script: pure_client.py
+#
+# Description:
+# This script provides the client that all modules use to talk to the Pure
+# API. It is meant to be imported as a module and should not be executed
+# standalone.
+#
+# Functions include:
+# - An asyncio event loop in a background thread that admits the requests
+#   with a concurrency limit and a token-bucket rate limiter.
+# - Blocking wrappers (get, post, put, search) that return a requests.Response,
+#   so they can be called from the existing synchronous code and from many
+#   threads at the same time.
+# - map(), which runs a function over many items in parallel, for loops whose
+#   body does one or more Pure calls.
+# - fetch_pages(), which fetches all pages of a listing or a search, the pages
+#   after the first one in parallel.
+# - search_all(), which searches an endpoint for many values at once with
+#   pipe-separated searchStrings.
+# - A rate controller that reacts to 429 and 503 answers of Pure: all requests
+#   pause for the Retry-After of the answer, the rate is halved, and it grows
+#   back to RateLimit while Pure answers normally. Throttled requests are
+#   tried again.
+# - Counters of the number of requests, errors, throttled answers and the time
+#   spent waiting for the rate limiter and for Pure to accept requests again.
+#
+# Important:
+# All modules share the module level `client`, so the limits in the
+# [PURE-API] section of config.ini (MaxConcurrency, RateLimit, MinRateLimit)
+# hold for the whole run. The requests themselves are sent with a pooled
+# requests.Session in the worker threads of the event loop.
+#
+# Dependencies:
+# - asyncio, requests, urllib3, concurrent.futures, email.utils, logging, etc.
+#
+# Author: David Grote Beverborg
+# Created: 2024
+#
+# License:
+# MIT License
+#
+# Copyright (c) 2024 David Grote Beverborg
+# ########################################################################
+
+
+import asyncio
+import functools
+import logging
+import threading
+import time
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from config import (PURE_BASE_URL, PURE_HEADERS, PURE_MAX_CONCURRENCY, PURE_RATE_LIMIT, PURE_TIMEOUT,
+                    PURE_MIN_RATE_LIMIT, PURE_THROTTLE_RETRIES)
+from logging_config import setup_logging
+
+logger = setup_logging('btp', level=logging.INFO)
+
+# answers of Pure that mean: slow down
+THROTTLE_STATUS = (429, 503)
+# seconds to pause after a throttled answer without Retry-After, doubled for every retry
+DEFAULT_RETRY_AFTER = 2
+MAX_RETRY_AFTER = 300
+
+
+def retry_after_seconds(response, attempt=0):
+    """
+    Reads how long Pure wants us to wait from the Retry-After header of a response.
+
+    Parameters:
+    response (requests.Response): A 429 or 503 answer.
+    attempt (int): The number of times the request was throttled before.
+
+    Returns:
+    float: The seconds to wait, at most MAX_RETRY_AFTER.
+    """
+    value = response.headers.get('Retry-After', '').strip()
+    seconds = None
+    if value:
+        try:
+            seconds = float(value)
+        except ValueError:
+            try:
+                seconds = parsedate_to_datetime(value).timestamp() - time.time()
+            except (TypeError, ValueError, IndexError, OverflowError):
+                seconds = None
+    if seconds is None:
+        seconds = DEFAULT_RETRY_AFTER * 2 ** attempt
+    return min(MAX_RETRY_AFTER, max(0.0, seconds))
+
+
+class TokenBucket:
+    """
+    Token bucket for an asyncio event loop: allows `rate` acquisitions per second
+    on average, with bursts of at most `capacity`.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        """Wait until a token is available and take it, returns the seconds waited."""
+        waited = 0.0
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return waited
+            delay = (1 - self.tokens) / self.rate
+            waited += delay
+            await asyncio.sleep(delay)
+
+
+class RateController:
+    """
+    Shared admission control for all requests to Pure, lives on the event loop.
+
+    A throttled answer pauses every request until its Retry-After has passed and
+    halves the rate, down to min_rate. Throttled answers that arrive while requests are
+    already paused belong to the same burst and only extend the pause, so the rate is
+    halved once per throttle event. Every normal answer adds a small step to
+    the rate again, up to max_rate (additive increase, multiplicative decrease).
+    Without a rate limit (max_rate 0) only the pause applies.
+    """
+
+    def __init__(self, max_rate, min_rate=PURE_MIN_RATE_LIMIT):
+        self.max_rate = max_rate
+        self.min_rate = min(max(0.1, min_rate), max_rate) if max_rate > 0 else 0
+        self.rate = max_rate
+        self.bucket = TokenBucket(max_rate) if max_rate > 0 else None
+        self.paused_until = 0.0
+        self.stats = {'throttled': 0, 'throttled_seconds': 0.0, 'rate_limited_seconds': 0.0,
+                      'slowest_rate': max_rate}
+
+    async def acquire(self):
+        """Wait until requests are no longer paused and the rate allows another one."""
+        while True:
+            pause = self.paused_until - time.monotonic()
+            if pause <= 0:
+                break
+            await asyncio.sleep(pause)
+        if self.bucket is not None:
+            self.stats['rate_limited_seconds'] += await self.bucket.acquire()
+
+    def throttled(self, retry_after):
+        """Pause all requests for retry_after seconds and slow down."""
+        self.stats['throttled'] += 1
+        now = time.monotonic()
+        # requests that were in flight when the pause started do not slow us down again
+        decrease = now >= self.paused_until
+        until = now + retry_after
+        if until > self.paused_until:
+            # count the wall-clock time of the pause once, not once per waiting request
+            self.stats['throttled_seconds'] += until - max(now, self.paused_until)
+            self.paused_until = until
+        if self.bucket is not None and decrease:
+            self._set_rate(max(self.min_rate, self.rate / 2))
+            # no burst of saved up tokens when the pause ends
+            self.bucket.tokens = 0
+            self.stats['slowest_rate'] = min(self.stats['slowest_rate'], self.rate)
+        logger.debug(f"pure throttled, pausing {retry_after:.1f}s, rate now {self.rate:.1f}/s")
+
+    def healthy(self):
+        """Speed up a little after a normal answer."""
+        if self.bucket is not None and self.rate < self.max_rate:
+            self._set_rate(min(self.max_rate, self.rate + self.max_rate / 20))
+
+    def _set_rate(self, rate):
+        self.rate = rate
+        self.bucket.rate = rate
+        self.bucket.capacity = max(1.0, rate)
+        self.bucket.tokens = min(self.bucket.tokens, self.bucket.capacity)
+
+
+class PureClient:
+    """
+    Client for the Pure API with bounded concurrency and rate limiting.
+
+    Requests are coroutines on an event loop that runs in a background thread.
+    A semaphore limits how many requests are in flight and a RateController how many
+    are started per second; requests that Pure throttles (429, 503) are tried again
+    up to throttle_retries times. The blocking wrappers can be called from any thread
+    (but not from the event loop itself). Paths are relative to PURE_BASE_URL,
+    absolute urls are used as they are.
+    """
+
+    def __init__(self, base_url=PURE_BASE_URL, headers=PURE_HEADERS, max_concurrency=PURE_MAX_CONCURRENCY,
+                 rate_limit=PURE_RATE_LIMIT, timeout=PURE_TIMEOUT, min_rate_limit=PURE_MIN_RATE_LIMIT,
+                 throttle_retries=PURE_THROTTLE_RETRIES):
+        self.base_url = base_url
+        self.headers = headers
+        self.max_concurrency = max_concurrency
+        self.rate_limit = rate_limit
+        self.timeout = timeout
+        self.min_rate_limit = min_rate_limit
+        self.throttle_retries = throttle_retries
+        self.session = requests.Session()
+        # 429 and 503 are left to the RateController, so all requests slow down together
+        retry_strategy = Retry(
+            total=5,
+            status_forcelist=[500, 502, 504],
+            respect_retry_after_header=False,
+            allowed_methods=["HEAD", "GET", "OPTIONS", "PUT", "POST"],
+            backoff_factor=1
+        )
+        adapter = HTTPAdapter(pool_connections=max_concurrency, pool_maxsize=max_concurrency,
+                              max_retries=retry_strategy)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        # for requests that create records (retry=False): when Pure answers 5xx it may already have
+        # created it, so only requests that never reached Pure (connection errors) are sent again
+        self.create_session = requests.Session()
+        create_retry = Retry(total=5, connect=5, read=0, status=0, other=0, backoff_factor=1)
+        create_adapter = HTTPAdapter(pool_connections=max_concurrency, pool_maxsize=max_concurrency,
+                                     max_retries=create_retry)
+        self.create_session.mount("http://", create_adapter)
+        self.create_session.mount("https://", create_adapter)
+        self.stats = {'requests': 0, 'errors': 0, 'seconds': 0.0}
+        self.controller = None
+        self._loop = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_loop(self):
+        with self._start_lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency,
+                                                    thread_name_prefix='pure-client')
+                threading.Thread(target=loop.run_forever, daemon=True, name='pure-client-loop').start()
+                # the semaphore and controller belong to the loop, so create them on it
+                asyncio.run_coroutine_threadsafe(self._setup(), loop).result()
+                self._loop = loop
+        return self._loop
+
+    async def _setup(self):
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.controller = RateController(self.rate_limit, self.min_rate_limit)
+
+    def url(self, path):
+        path = path.strip()
+        return path if path.startswith(('http://', 'https://')) else self.base_url + path
+
+    async def arequest(self, method, path, retry=True, **kwargs):
+        """
+        Send a request when the concurrency and rate limits allow it, returns the requests.Response.
+
+        With retry=False (for requests that create a record) an error answer of Pure is not
+        retried, only a throttled one (429, 503), which Pure did not handle.
+        """
+        kwargs.setdefault('headers', self.headers)
+        kwargs.setdefault('timeout', self.timeout)
+        session = self.session if retry else self.create_session
+        send = functools.partial(session.request, method, self.url(path), **kwargs)
+        async with self._semaphore:
+            for attempt in range(self.throttle_retries + 1):
+                await self.controller.acquire()
+                start = time.perf_counter()
+                failed = True
+                try:
+                    response = await asyncio.get_running_loop().run_in_executor(self._executor, send)
+                    failed = response.status_code >= 400
+                finally:
+                    self.stats['requests'] += 1
+                    self.stats['seconds'] += time.perf_counter() - start
+                    if failed:
+                        self.stats['errors'] += 1
+                if response.status_code not in THROTTLE_STATUS:
+                    self.controller.healthy()
+                    return response
+                self.controller.throttled(retry_after_seconds(response, attempt))
+            logger.warning(f"pure kept throttling {method} {path} after {self.throttle_retries} retries")
+            return response
+
+    def request(self, method, path, **kwargs):
+        """Blocking version of arequest, raises requests.RequestException like requests does."""
+        return asyncio.run_coroutine_threadsafe(self.arequest(method, path, **kwargs), self._ensure_loop()).result()
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def put(self, path, **kwargs):
+        return self.request('PUT', path, **kwargs)
+
+    def search(self, endpoint, search_string, **kwargs):
+        """POST a searchString to the search of an endpoint, e.g. search('persons', orcid)."""
+        return self.post(endpoint.strip('/') + '/search/', json={"searchString": search_string}, **kwargs)
+
+    def fetch_pages(self, path, page_size=500, search=None, max_pages=None, **kwargs):
+        """
+        Fetches all items of a listing (GET) or a search (POST) of Pure, page_size at a time.
+
+        The first page gives the count, the pages after it are fetched in parallel.
+
+        Parameters:
+        path (str): The endpoint, e.g. 'persons' or 'research-outputs/search'.
+        page_size (int): The number of items per request.
+        search (dict, optional): The body of a search, without size and offset. Without
+                                 it the listing of the endpoint is fetched.
+        max_pages (int, optional): Fetch at most this many pages, the rest of the items is left out.
+        **kwargs: Passed on to the requests, e.g. headers or timeout.
+
+        Returns:
+        tuple: The items and the count that Pure reported.
+
+        Raises:
+        requests.RequestException, ValueError: When one of the pages cannot be fetched.
+        """
+        def fetch(offset):
+            if search is None:
+                response = self.get(path, params={'size': page_size, 'offset': offset}, **kwargs)
+            else:
+                response = self.post(path, json={**search, 'size': page_size, 'offset': offset}, **kwargs)
+            response.raise_for_status()
+            return response.json()
+
+        first = fetch(0)
+        count = first.get('count', 0)
+        pages = [first.get('items', [])]
+        end = count if max_pages is None else min(count, max_pages * page_size)
+        pages.extend(page.get('items', []) for page in self.map(fetch, range(page_size, end, page_size)))
+        return [item for page in pages for item in page], count
+
+    def search_all(self, endpoint, values, batch_size=50, page_size=100, max_pages=None):
+        """
+        Searches an endpoint for many values, with pipe-separated searchStrings of batch_size values.
+
+        The batches run in parallel and every batch is paged until all its items are fetched,
+        or until max_pages pages are fetched.
+
+        Parameters:
+        endpoint (str): The endpoint, e.g. 'persons'.
+        values (iterable): The values to search for (ids, names), duplicates are searched once.
+        batch_size (int): The number of values per search.
+        page_size (int): The number of items per page.
+        max_pages (int, optional): The maximum number of pages per batch, by default all pages.
+
+        Returns:
+        tuple: The items found (every uuid once) and the values of the batches that failed.
+        """
+        values = list(dict.fromkeys(value for value in values if value))
+        batches = [values[i:i + batch_size] for i in range(0, len(values), batch_size)]
+
+        def fetch(batch):
+            try:
+                items, _ = self.fetch_pages(endpoint.strip('/') + '/search/', page_size,
+                                            {'searchString': '|'.join(batch)}, max_pages)
+                return items, []
+            except (requests.RequestException, ValueError) as e:
+                logger.error(f"Error searching {endpoint} for a batch of {len(batch)} values: {e}")
+                return [], batch
+
+        found = {}
+        failed = []
+        for items, failed_batch in self.map(fetch, batches):
+            for item in items:
+                found[item.get('uuid') or id(item)] = item
+            failed.extend(failed_batch)
+        return list(found.values()), failed
+
+    def map(self, func, items, workers=None):
+        """
+        Runs func over the items in parallel, as many at a time as the concurrency limit.
+
+        Parameters:
+        func (callable): A function that makes its Pure calls through this client.
+        items (iterable): The arguments for func.
+        workers (int, optional): Run fewer at a time than the concurrency limit.
+
+        Returns:
+        list: The results of func, in the order of the items.
+        """
+        with ThreadPoolExecutor(max_workers=min(workers or self.max_concurrency, self.max_concurrency)) as executor:
+            return list(executor.map(func, items))
+
+    def log_stats(self):
+        """Log the number of requests and errors, the time spent on them and how long Pure throttled us."""
+        controller = self.controller.stats if self.controller else {}
+        logger.info(f"pure: {self.stats['requests']} requests, {self.stats['errors']} errors, "
+                    f"{self.stats['seconds']:.1f}s in requests, "
+                    f"{controller.get('rate_limited_seconds', 0):.1f}s waiting for the rate limit")
+        if controller.get('throttled'):
+            logger.info(f"pure: throttled {controller['throttled']} times, requests paused for "
+                        f"{controller['throttled_seconds']:.1f}s, lowest rate {controller['slowest_rate']:.1f}/s")
+
+
+client = PureClient()
@@ -30,20 +30,28 @@
 import pandas as pd
 import json
 import requests
+import pure_client
 import configparser
 import os
 import logging
 import pure_persons
+from cache_utils import LookupCache, BloomFilter, MISSING
 import yoda_utils
 import datacite_utils
 import logging.handlers
 from pathlib import Path
 from datetime import datetime
-from config import PURE_BASE_URL, DEFAULTS, ORCID_ID_URI, PURE_HEADERS, RIC_BASE_URL, OPENALEX_HEADERS, OPENALEX_BASE_URL, PURE_HEADERS, TYPE_URI
+from config import PURE_BASE_URL, DEFAULTS, ORCID_ID_URI, RIC_BASE_URL, OPENALEX_HEADERS, OPENALEX_BASE_URL, TYPE_URI
+from config import PURE_LOOKUP_TTL, PURE_LOOKUP_MAX_BYTES, DATASET_BLOOM_MAX_AGE, CACHE_DIR
 from logging_config import setup_logging
 
 logger = setup_logging('btp', level=logging.INFO)
 
+# publisher name -> publisher uuid (the default publisher if Pure has none with the name), kept between runs
+publisher_lookups = LookupCache('publishers', PURE_LOOKUP_TTL, PURE_LOOKUP_MAX_BYTES)
+# the DOIs of all datasets in pure, see sync_dataset_bloom
+DATASET_BLOOM = os.path.join(CACHE_DIR, 'pure_datasets.bloom')
+
 def get_headers(api_key):
     """Constructs the header required for API requests."""
     return {
@@ -87,7 +95,7 @@ def format_doi(doi):
 def request_dataset_by_uuid(uuid):
     """Request dataset details by UUID."""
     api_url = f"{PURE_BASE_URL}data-sets/{uuid}"
-    response = requests.get(api_url, headers=PURE_HEADERS)
+    response = pure_client.client.get(api_url)
     if response.status_code == 200:
         return response.json()
     else:
@@ -99,7 +107,7 @@ def search_dataset_by_string(search_string):
     data = {"searchString": search_string}
     json_data = json.dumps(data)
     api_url = f"{PURE_BASE_URL}data-sets/search/"
-    response = requests.post(api_url, headers=PURE_HEADERS, data=json_data)
+    response = pure_client.client.post(api_url, data=json_data)
     if response.status_code == 200:
         return response.json().get('items', [])
     else:
@@ -117,6 +125,106 @@ def find_dataset(uuid, search_string):
         return [item['uuid'] for item in items if 'uuid' in item]
 
 
+def dataset_doi_key(doi):
+    """The form in which dataset DOIs are compared: lower case, without the doi.org prefix."""
+    return doi.split('doi.org/')[-1].strip().lower() if isinstance(doi, str) else ''
+
+
+def dataset_dois(item):
+    """Return the doi_keys of a dataset as returned by the Pure API."""
+    dois = [(item.get('doi') or {}).get('doi')]
+    dois += [version.get('doi') for version in item.get('electronicVersions', [])]
+    return {dataset_doi_key(doi) for doi in dois if dataset_doi_key(doi)}
+
+
+def sync_dataset_bloom(path=DATASET_BLOOM, page_size=500, error_rate=0.001):
+    """
+    Builds the bloom filter of the DOIs of all datasets in Pure, used by datasets_in_pure.
+
+    Parameters:
+    path (str): The file the filter is saved in.
+    page_size (int): The number of datasets per request, the pages after the first one are fetched in parallel.
+    error_rate (float): The chance that a DOI that is not in Pure is found in the filter.
+
+    Returns:
+    BloomFilter: The filter.
+    """
+    items, count = pure_client.client.fetch_pages('data-sets', page_size)
+    dois = {doi for item in items for doi in dataset_dois(item)}
+    bloom = BloomFilter(len(dois), error_rate)
+    for doi in dois:
+        bloom.add(doi)
+    bloom.save(path)
+    logger.info(f"Saved the {len(dois)} DOIs of {count} datasets in Pure to {path}")
+    return bloom
+
+
+def load_dataset_bloom(path=DATASET_BLOOM, max_age_hours=DATASET_BLOOM_MAX_AGE):
+    """Return the bloom filter of sync_dataset_bloom if it is younger than max_age_hours, or None."""
+    if max_age_hours <= 0:
+        return None
+    bloom = BloomFilter.load(path)
+    if bloom is None:
+        return None
+    if bloom.age_hours() >= max_age_hours:
+        logger.info(f"The dataset bloom filter {path} is older than {max_age_hours} hours, searching Pure instead")
+        return None
+    return bloom
+
+
+def add_to_dataset_bloom(dois, path=DATASET_BLOOM):
+    """
+    Adds the DOIs of datasets that were just created in Pure to the saved bloom filter,
+    so until the next sync datasets_in_pure still searches them instead of proposing them again.
+    """
+    bloom = BloomFilter.load(path)
+    keys = [key for key in map(dataset_doi_key, dois) if key]
+    if bloom is None or not keys:
+        return
+    for key in keys:
+        bloom.add(key)
+    bloom.save(path)
+    logger.debug(f"Added {len(keys)} created datasets to the bloom filter {path}")
+
+
+def datasets_in_pure(dois, batch_size=50, bloom=None):
+    """
+    Checks for all DOIs at once which datasets are already in Pure.
+
+    The DOIs are searched in data-sets/search in batches of pipe-separated searchStrings,
+    a DOI is in Pure when it is one of the dataset_dois of the datasets found. With a bloom
+    filter (load_dataset_bloom) the DOIs that are certainly not in Pure are not searched;
+    the others still are, so a false positive of the filter cannot skip a dataset.
+    The DOIs of failed batches are checked one by one with find_dataset.
+
+    Parameters:
+    dois (iterable): The DOIs, e.g. the doi column.
+    batch_size (int): The number of DOIs per search.
+    bloom (BloomFilter): The DOIs of all datasets in Pure (and those created since, see
+                         add_to_dataset_bloom), or None.
+
+    Returns:
+    set: The DOIs (as given) that are in Pure.
+    """
+    dois = list(dict.fromkeys(doi for doi in dois if dataset_doi_key(doi)))
+    todo = [doi for doi in dois if bloom is None or dataset_doi_key(doi) in bloom]
+    items, failed = pure_client.client.search_all('data-sets', [format_doi(doi) for doi in todo], batch_size)
+    failed = {dataset_doi_key(doi) for doi in failed}
+    found_dois = {doi for item in items for doi in dataset_dois(item)}
+    in_pure = set()
+    for doi in todo:
+        key = dataset_doi_key(doi)
+        if key in failed:
+            found = bool(find_dataset(None, doi))
+        else:
+            found = key in found_dois
+        if found:
+            in_pure.add(doi)
+    logger.info(f"{len(in_pure)} of {len(dois)} dataset DOIs already in Pure, "
+                f"{len(dois) - len(todo)} skipped by the bloom filter, {len(todo)} searched")
+    return in_pure
+
+
 def extract_orcid_id(orcid):
     # Check if the ORCID is in URL format
     if orcid and orcid.startswith('https://orcid.org/'):
@@ -134,6 +242,11 @@ def create_external_person(first_name, last_name, orcid):
     :param first_name, last_name:  first and last names.
     :return: UUID of the newly created external person.
     """
+    # created earlier in this run for another dataset
+    existing_uuid = pure_persons.external_persons.created(extract_orcid_id(orcid) if orcid else None)
+    if existing_uuid:
+        return existing_uuid
+
     api_url = PURE_BASE_URL + 'external-persons/'
     data = {"name": {"firstName": first_name, "lastName": last_name}}
 
@@ -157,9 +270,10 @@ def create_external_person(first_name, last_name, orcid):
     json_data = json.dumps(data)
 
     try:
-        response = requests.put(api_url, headers=PURE_HEADERS, data=json_data)
+        response = pure_client.client.put(api_url, data=json_data, retry=False)
         if response.status_code in [200, 201]:
             external_person = response.json()
+            pure_persons.external_persons.register(external_person.get('uuid'), orcid)
             return external_person.get('uuid')
         else:
             logger.error(f"Error creating external person: {response.status_code} - {response.text}")
@@ -167,15 +281,17 @@ def create_external_person(first_name, last_name, orcid):
         logger.error(f"An error occurred while creating external person: {e}")
 
     return None
-def get_contributors_details(contributors, ref_date):
+def get_contributors_details(contributors, ref_date, resolver=None):
     persons = {}
     found_internal_person = False
+    # a ContributorResolver answers from the persons it resolved for the whole DataFrame
+    find_person = resolver.find_person if resolver else pure_persons.find_person
 
     # First pass: Check for internal persons and mark if any are found
     for contributor in contributors:
         contributor['name'] = contributor['first_name'] + ' ' + contributor['last_name']
         contributor_id = contributor['name']
-        person_details = pure_persons.find_person(contributor, contributor['person_ids'], ref_date, contributor['type'])
+        person_details = find_person(contributor, contributor['person_ids'], ref_date, contributor['type'])
 
         if person_details:
             person_details['type'] = contributor['type']
@@ -339,37 +455,83 @@ def format_organizations_from_contributors(contributors):
         managing_org = default_uuid
     return formatted_organizations, managing_org
 
-def find_publisher(publisher):
+def _search_publisher(publisher):
+    """Searches the publisher in Pure, returns its uuid (or the default) and whether the answer can be cached."""
     data = {"searchString": publisher}
-    publisher_id =  None
     json_data = json.dumps(data)
     api_url = PURE_BASE_URL + 'publishers/search/'
     try:
-        response = requests.post(api_url, headers=PURE_HEADERS, data=json_data)
+        response = pure_client.client.post(api_url, data=json_data)
 
         if response.status_code == 200:
-            data = response.json()
-            items = data.get('items', [])
-            if items:
-                for item in items:
-                    uuid = item.get('uuid')
-                    name = item.get('name')
-                    if name == publisher:
-                        publisher_uuid = uuid
-                        return publisher_uuid
-                if not publisher_id:
-                    publisher_uuid = DEFAULTS['publisher']
-            else:
-                publisher_uuid = DEFAULTS['publisher']
-            return publisher_uuid
-
+            items = response.json().get('items', [])
+            return _match_publisher(publisher, items), True
         else:
     #         default publisher
-            publisher_uuid = DEFAULTS['publisher']
-            return publisher_uuid
+            return DEFAULTS['publisher'], False
 
     except requests.RequestException as e:
         logging.error(f"An error occurred while searching for publisher: {publisher}: {e}")
+        return None, False
+
+
+def _match_publisher(publisher, items):
+    for item in items:
+        if item.get('name') == publisher:
+            return item.get('uuid')
+    return DEFAULTS['publisher']
+
+
+def resolve_publishers(publishers, batch_size=20, page_factor=5):
+    """
+    Looks up every distinct publisher name once, so find_publisher does not need a request per dataset.
+
+    The names that are not in the publisher cache are searched in batches of pipe-separated
+    searchStrings. Common words in publisher names match many publishers, so only the first
+    page of batch_size * page_factor items of a batch is fetched. The names without an exact
+    match on that page, and the names that contain a pipe, are searched one by one as in
+    find_publisher. As there, a publisher needs a Pure publisher with exactly its name,
+    otherwise the default publisher of config.ini is used; both are cached.
+
+    Parameters:
+    publishers (iterable): The publisher names, e.g. the publisher column.
+    batch_size (int): The number of names per search.
+    page_factor (int): The number of items per batch is batch_size * page_factor.
+    """
+    publishers = list(dict.fromkeys(publisher for publisher in publishers if isinstance(publisher, str) and publisher))
+    todo = [publisher for publisher in publishers if publisher_lookups.get(publisher) is MISSING]
+    batched = [publisher for publisher in todo if '|' not in publisher]
+    items, failed = pure_client.client.search_all('publishers', batched, batch_size,
+                                                  page_size=batch_size * page_factor, max_pages=1)
+    failed = set(failed)
+    uuids = {}
+    for item in items:
+        uuids.setdefault(item.get('name'), item.get('uuid'))
+    single = [publisher for publisher in todo if '|' in publisher]
+    for publisher in batched:
+        if publisher in failed:
+            continue
+        if publisher in uuids:
+            publisher_lookups.remember(publisher, uuids[publisher])
+        else:
+            single.append(publisher)
+    for publisher, (publisher_uuid, cacheable) in zip(single, pure_client.client.map(_search_publisher, single)):
+        if cacheable:
+            publisher_lookups.remember(publisher, publisher_uuid)
+        else:
+            failed.add(publisher)
+    logger.info(f"{len(publishers)} distinct publishers, {len(publishers) - len(todo)} from the publisher cache, "
+                f"{len(todo) - len(failed)} looked up in Pure, {len(single)} of them one by one")
+
+
+def find_publisher(publisher):
+    publisher_uuid = publisher_lookups.get(publisher) if isinstance(publisher, str) else MISSING
+    if publisher_uuid is not MISSING:
+        return publisher_uuid
+    publisher_uuid, cacheable = _search_publisher(publisher)
+    if cacheable:
+        publisher_lookups.remember(publisher, publisher_uuid)
+    return publisher_uuid
 def format_description(description):
 
     description_object = {
@@ -414,7 +576,7 @@ def create_dataset(dataset_json):
     url = PURE_BASE_URL + 'data-sets'
     json_data = json.dumps(dataset_json)
 
-    response = requests.put(url, headers=PURE_HEADERS, data=json_data)
+    response = pure_client.client.put(url, data=json_data, retry=False)
     if response.status_code in [200, 201]:
         data = response.json()
         logger.info(f"created dataset: {response.status_code} - {data['uuid']}")
@@ -0,0 +1,228 @@
+# ########################################################################
+# Script: pure_person_index.py
+#
+# Description:
+# This script keeps a local index of all persons in Pure, so contributors can
+# be matched to Pure persons without a persons/search request per contributor.
+# It can be imported, or executed standalone to (re)build the index.
+#
+# Functions include:
+# - Syncing: paging through all persons of Pure and storing them in a SQLite
+#   file, with their names, identifiers and staffOrganizationAssociations.
+# - Looking up persons by UUID, ORCID, Scopus ID, OpenAlex ID (or any other
+#   identifier), normalized full name and known-as names.
+# - fresh_index(), which returns the index only when it was synced less than
+#   PersonIndexMaxAge hours ago. pure_persons.find_person uses it when it does.
+#
+# Important:
+# The index is stored in the [CACHE] directory of config.ini. Run
+#   python pure_person_index.py
+# to build it, e.g. once a day before the import scripts. Without an index, or
+# with an index that is too old, find_person searches Pure as before.
+#
+# Dependencies:
+# - sqlite3, json, pure_client, argparse, logging, etc.
+#
+# Author: David Grote Beverborg
+# Created: 2024
+#
+# License:
+# MIT License
+#
+# Copyright (c) 2024 David Grote Beverborg
+# ########################################################################
+
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import pure_client
+from config import CACHE_DIR, ID_URI, PERSON_INDEX_MAX_AGE
+from logging_config import setup_logging
+
+logger = setup_logging('btp', level=logging.INFO)
+
+DEFAULT_INDEX = os.path.join(CACHE_DIR, 'pure_persons.sqlite')
+KNOWN_AS_URI = "/dk/atira/pure/person/names/knownas"
+# the parts of a Pure person that are kept in the index
+PERSON_FIELDS = ('uuid', 'name', 'names', 'orcid', 'identifiers', 'staffOrganizationAssociations')
+ID_KINDS = ('orcid', 'scopus', 'openalex', 'id')
+NAME_KINDS = ('name', 'knownas')
+
+
+def normalize_name(name):
+    return ' '.join(str(name).lower().split()) if name else ''
+
+
+def id_key(id_value):
+    """The form in which identifiers are compared: lower case, without the OpenAlex url."""
+    return str(id_value).replace("https://openalex.org/", "").strip().lower()
+
+
+def _id_kind(uri):
+    if uri in (ID_URI.get('SCOPUS'), ID_URI.get('SCOPUS_AUTHOR_ID')):
+        return 'scopus'
+    if uri == ID_URI.get('OPENALEX'):
+        return 'openalex'
+    return 'id'
+
+
+def person_keys(item):
+    """
+    Returns the keys a Pure person can be found by.
+
+    Parameters:
+    item (dict): A person as returned by the Pure API.
+
+    Returns:
+    set: (kind, key) tuples, kind is one of ID_KINDS or NAME_KINDS.
+    """
+    keys = set()
+    if item.get('orcid'):
+        keys.add(('orcid', id_key(item['orcid'].split('/')[-1])))
+    for identifier in item.get('identifiers', []):
+        value = identifier.get('id') or identifier.get('value')
+        if value:
+            keys.add((_id_kind(identifier.get('type', {}).get('uri')), id_key(value)))
+    name = item.get('name', {})
+    keys.add(('name', normalize_name(f"{name.get('firstName', '')} {name.get('lastName', '')}")))
+    for entry in item.get('names', []):
+        name = entry.get('name', {})
+        kind = 'knownas' if entry.get('type', {}).get('uri') == KNOWN_AS_URI else 'name'
+        keys.add((kind, normalize_name(f"{name.get('firstName', '')} {name.get('lastName', '')}")))
+    return {(kind, key) for kind, key in keys if key}
+
+
+def fetch_all_persons(page_size=500):
+    """
+    Pages through all persons in Pure, the pages after the first one in parallel.
+
+    Parameters:
+    page_size (int): The number of persons per request.
+
+    Returns:
+    list: All persons, with only the PERSON_FIELDS.
+    """
+    items, count = pure_client.client.fetch_pages('persons', page_size)
+    persons = [{field: item[field] for field in PERSON_FIELDS if field in item} for item in items]
+    logger.info(f"Fetched {len(persons)} of {count} persons from Pure")
+    return persons
+
+
+class PersonIndex:
+    """
+    The persons of Pure in a SQLite file, with a table of the keys they can be found by.
+    """
+
+    def __init__(self, path=DEFAULT_INDEX):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS persons (uuid TEXT PRIMARY KEY, data TEXT)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS person_keys (kind TEXT, key TEXT, uuid TEXT)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS person_keys_key ON person_keys (key, kind)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+        self._conn.commit()
+
+    def synced(self):
+        """Return the time of the last sync, or None if the index was never synced."""
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE name = 'synced'").fetchone()
+        return float(row[0]) if row else None
+
+    def is_fresh(self, max_age_hours=PERSON_INDEX_MAX_AGE):
+        synced = self.synced()
+        return synced is not None and max_age_hours > 0 and time.time() - synced < max_age_hours * 3600
+
+    def replace(self, persons):
+        """Replace the content of the index by the persons, in one transaction."""
+        person_rows = [(item['uuid'], json.dumps(item)) for item in persons if item.get('uuid')]
+        key_rows = [(kind, key, item['uuid']) for item in persons if item.get('uuid')
+                    for kind, key in person_keys(item)]
+        with self._lock:
+            with self._conn:
+                self._conn.execute("DELETE FROM persons")
+                self._conn.execute("DELETE FROM person_keys")
+                self._conn.executemany("INSERT OR REPLACE INTO persons VALUES (?, ?)", person_rows)
+                self._conn.executemany("INSERT INTO person_keys VALUES (?, ?, ?)", key_rows)
+                self._conn.execute("INSERT OR REPLACE INTO meta VALUES ('synced', ?)", (str(time.time()),))
+        return len(person_rows)
+
+    def sync(self, page_size=500):
+        """
+        Rebuilds the index from all persons in Pure.
+
+        Returns:
+        int: The number of persons in the index.
+        """
+        start = time.perf_counter()
+        count = self.replace(fetch_all_persons(page_size))
+        logger.info(f"Indexed {count} Pure persons in {self.path} in {time.perf_counter() - start:.1f}s")
+        return count
+
+    def get(self, uuid):
+        """Return the person with the UUID, or None."""
+        with self._lock:
+            row = self._conn.execute("SELECT data FROM persons WHERE uuid = ?", (uuid,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _find(self, key, kinds):
+        sql = (f"SELECT DISTINCT p.data FROM person_keys k JOIN persons p ON p.uuid = k.uuid "
+               f"WHERE k.key = ? AND k.kind IN ({', '.join('?' * len(kinds))})")
+        with self._lock:
+            rows = self._conn.execute(sql, [key, *kinds]).fetchall()
+        return [json.loads(data) for data, in rows]
+
+    def find_by_id(self, id_value):
+        """Return the persons with the identifier (ORCID, Scopus ID, OpenAlex ID, ...)."""
+        return self._find(id_key(id_value), ID_KINDS) if id_value else []
+
+    def find_by_name(self, name):
+        """Return the persons with the full name or known-as name."""
+        name = normalize_name(name)
+        return self._find(name, NAME_KINDS) if name else []
+
+
+_fresh_index = None
+_checked = False
+_check_lock = threading.Lock()
+
+
+def fresh_index(path=DEFAULT_INDEX):
+    """
+    Returns the person index if it exists and is fresh, once checked per run.
+
+    Returns:
+    PersonIndex: The index, or None when find_person has to search Pure.
+    """
+    global _fresh_index, _checked
+    with _check_lock:
+        if not _checked:
+            _checked = True
+            if PERSON_INDEX_MAX_AGE > 0 and os.path.exists(path):
+                index = PersonIndex(path)
+                if index.is_fresh():
+                    _fresh_index = index
+                    logger.info(f"Matching persons with the Pure person index {path}")
+                else:
+                    logger.info(f"The Pure person index {path} is older than {PERSON_INDEX_MAX_AGE} hours, "
+                                f"searching Pure instead")
+    return _fresh_index
+
+
+# ########################################################################
+# MAIN
+# ########################################################################
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sync the local index of Pure persons')
+    parser.add_argument('--db', type=str, default=DEFAULT_INDEX, help='SQLite file of the index')
+    parser.add_argument('--page-size', type=int, default=500, help='Number of persons per request')
+
+    args = parser.parse_args()
+    PersonIndex(args.db).sync(args.page_size)
+    pure_client.client.log_stats()
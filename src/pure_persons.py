@@ -12,22 +12,25 @@
 import pandas as pd
 import json
 import requests
+import pure_client
+import pure_person_index
 from datetime import datetime, time
+import threading
+from cache_utils import LookupCache, MISSING
 import configparser
 import os
 import logging
-from config import PURE_BASE_URL, PURE_API_KEY, PURE_HEADERS, OPENALEXEX_ID_URI, ORCID_ID_URI, OPENALEX_BASE_URL
+from config import PURE_BASE_URL, OPENALEXEX_ID_URI, ORCID_ID_URI, OPENALEX_BASE_URL, ROR_ID_URI
+from config import PURE_LOOKUP_TTL, PURE_LOOKUP_MAX_BYTES
 from logging_config import setup_logging
 from dateutil import parser
 from pathlib import Path
 
 logger = setup_logging('btp', level=logging.INFO)
 
-headers = {
-    "Content-Type": "application/json",
-    "accept": "application/json",
-    "api-key": PURE_API_KEY
-}
+# ROR id -> {'uuid': ..., 'hits': ...} of the external organizations with the ROR, kept between runs;
+# uuid is None when Pure has no or more than one organization with the ROR
+external_org_lookups = LookupCache('external_orgs', PURE_LOOKUP_TTL, PURE_LOOKUP_MAX_BYTES)
 
 def parse_date(date_string):
 
@@ -107,6 +110,8 @@ def find_person(contributor, person_ids, date, type):
     - apikey (str): API key for authentication with the API.
       (Note that the header of the api-call contain the apikey that is loaded in the top of this script)
 
+    When the local person index (pure_person_index) is fresh, the person is looked up
+    there with the same rules instead of searched in Pure.
 
     Returns:
     - dict: A dictionary containing detailed information about the person if a unique match is found.
@@ -121,13 +126,22 @@ def find_person(contributor, person_ids, date, type):
         ref_date = parse_date(date)
 
 
+    index = pure_person_index.fresh_index()
+    if index is not None:
+        if person_ids and 'uuid' in person_ids:
+            item = index.get(person_ids['uuid'])
+            if item:
+                logger.debug(f"Person found in the index with UUID: {person_ids['uuid']}")
+                return construct_person_detail(item, ref_date)
+        return match_person(contributor, person_ids, ref_date, type, index.find_by_id, index.find_by_name)
+
     person_detail = None
     if person_ids and 'uuid' in person_ids:
 
         uuid = person_ids['uuid']
         api_url = PURE_BASE_URL + 'persons/' + uuid
 
-        response = requests.get(api_url, headers=headers)
+        response = pure_client.client.get(api_url)
         if response.status_code == 200:
             data = response.json()
             person_detail = construct_person_detail(data, ref_date)
@@ -143,7 +157,7 @@ def find_person(contributor, person_ids, date, type):
                     json_data = json.dumps(data)
                     api_url = PURE_BASE_URL + 'persons/search/'
                     try:
-                        response = requests.post(api_url, headers=headers, data=json_data)
+                        response = pure_client.client.post(api_url, data=json_data)
                         if response.status_code == 200:
                             data = response.json()
                             items = data.get('items', [])
@@ -167,7 +181,7 @@ def find_person(contributor, person_ids, date, type):
         json_data = json.dumps(data)
         api_url = PURE_BASE_URL + 'persons/search/'
         try:
-            response = requests.post(api_url, headers=headers, data=json_data)
+            response = pure_client.client.post(api_url, data=json_data)
             if response.status_code == 200:
                 data = response.json()
                 items = data.get('items', [])
@@ -207,6 +221,161 @@ def find_person(contributor, person_ids, date, type):
     return person_detail
 
 
+normalize_name = pure_person_index.normalize_name
+
+
+def normalize_person_id(id_type, id_value):
+    """Returns the value of an identifier as it is searched for in Pure (ORCID without url)."""
+    if id_type.lower() == 'orcid':
+        return extract_orcid(id_value)
+    return str(id_value)
+
+
+def contributor_name(contributor):
+    return contributor.get('name') or f"{contributor.get('first_name', '')} {contributor.get('last_name', '')}"
+
+
+def match_person(contributor, person_ids, ref_date, type, find_by_id, find_by_name):
+    """
+    Applies the rules of find_person to persons that are already known, instead of searching Pure.
+
+    An identifier has to match exactly one person, then the name has to match exactly one
+    person; for several persons with the name the known-as name decides.
+
+    Parameters:
+    - contributor (dict): The contributor, with name or first_name and last_name.
+    - person_ids (dict): The identifiers of the contributor.
+    - ref_date (datetime): Only associations active on this date are included, None for all.
+    - type: Stored as 'type' in the person detail.
+    - find_by_id (callable): Returns the persons with an identifier.
+    - find_by_name (callable): Returns the persons with a name.
+
+    Returns:
+    - dict: The person detail, or None.
+    """
+    for id_type, id_value in (person_ids or {}).items():
+        if not id_value or id_type.lower() == 'uuid':
+            continue
+        matches = find_by_id(normalize_person_id(id_type, id_value))
+        if len(matches) == 1:
+            person_detail = construct_person_detail(matches[0], ref_date)
+            person_detail['type'] = type
+            return person_detail
+
+    matches = find_by_name(contributor_name(contributor))
+    if len(matches) == 1:
+        person_detail = construct_person_detail(matches[0], ref_date)
+        person_detail['type'] = type
+        return person_detail
+    person_detail = None
+    for item in matches:
+        for name_entry in item.get('names', []):
+            if name_entry.get('type', {}).get('uri') == pure_person_index.KNOWN_AS_URI:
+                if contributor.get('first_name') == name_entry['name'].get('firstName', "N/A") and \
+                        contributor.get('last_name') == name_entry['name'].get('lastName', "N/A"):
+                    person_detail = construct_person_detail(item, ref_date)
+    return person_detail
+
+
+class ContributorResolver:
+    """
+    Resolves the contributors of many research outputs or datasets to Pure persons at once.
+
+    resolve() collects every distinct identifier (ORCID, OpenAlex id, ...) and name of
+    the contributors and searches them in batches of pipe-separated searchStrings.
+    find_person() then answers from memory with the same rules as find_person: an
+    identifier or name has to match exactly one person, for several persons with the
+    name the known-as name decides. Names are only searched for contributors that no
+    identifier resolved; common name parts match many persons, so only the first page of
+    batch_size * page_factor persons of a name batch is fetched. Contributors with a Pure
+    uuid, whose batch failed, or whose name has no exact match in its batch (e.g. a middle
+    initial or diacritics) are looked up with find_person as before. When the person
+    index is fresh, resolve() does nothing and find_person answers from the index.
+    """
+
+    def __init__(self, ids_key='ids', batch_size=50, page_factor=5):
+        self.ids_key = ids_key
+        self.batch_size = batch_size
+        self.page_factor = page_factor
+        self.by_id = {}
+        self.by_name = {}
+        self.failed = set()
+
+    def resolve(self, contributor_lists):
+        """
+        Searches all identifiers and names of the contributors in Pure.
+
+        Parameters:
+        contributor_lists (iterable): Per research output or dataset the list of contributors.
+        """
+        if pure_person_index.fresh_index() is not None:
+            return
+        contributors = [contributor for contributors in contributor_lists if isinstance(contributors, list)
+                        for contributor in contributors]
+        ids = {}
+        for contributor in contributors:
+            for id_type, id_value in (contributor.get(self.ids_key) or {}).items():
+                if id_value and id_type.lower() != 'uuid':
+                    value = normalize_person_id(id_type, id_value)
+                    ids[pure_person_index.id_key(value)] = value
+        items, failed = pure_client.client.search_all('persons', ids.values(), self.batch_size)
+        self.failed.update(pure_person_index.id_key(value) for value in failed)
+        self.by_id = {key: [] for key in ids}
+        for item in items:
+            keys = {key for kind, key in pure_person_index.person_keys(item) if kind in pure_person_index.ID_KINDS}
+            for key in keys & self.by_id.keys():
+                self.by_id[key].append(item)
+
+        names = {}
+        for contributor in contributors:
+            if self._resolved_by_id(contributor.get(self.ids_key)) is None:
+                name = contributor_name(contributor)
+                if normalize_name(name):
+                    names[normalize_name(name)] = name
+        items, failed = pure_client.client.search_all('persons', names.values(), self.batch_size,
+                                                      page_size=self.batch_size * self.page_factor, max_pages=1)
+        self.failed.update(normalize_name(name) for name in failed)
+        by_name = {key: [] for key in names}
+        for item in items:
+            keys = {key for kind, key in pure_person_index.person_keys(item) if kind in pure_person_index.NAME_KINDS}
+            for key in keys & by_name.keys():
+                by_name[key].append(item)
+        # names without an exact match are left out, so find_person searches them in Pure
+        self.by_name = {key: matches for key, matches in by_name.items() if matches}
+
+        found_ids = sum(1 for matches in self.by_id.values() if len(matches) == 1)
+        logger.info(f"Resolved {found_ids} of {len(ids)} contributor ids and {len(self.by_name)} of {len(names)} "
+                    f"names in Pure for {len(contributors)} contributors")
+
+    def _resolved_by_id(self, person_ids):
+        for id_type, id_value in (person_ids or {}).items():
+            if not id_value or id_type.lower() == 'uuid':
+                continue
+            matches = self.by_id.get(pure_person_index.id_key(normalize_person_id(id_type, id_value)), [])
+            if len(matches) == 1:
+                return matches[0]
+        return None
+
+    def _needs_lookup(self, contributor, person_ids):
+        """True if the contributor was not (or not successfully) part of resolve()."""
+        if person_ids and 'uuid' in person_ids:
+            return True
+        keys = {pure_person_index.id_key(normalize_person_id(id_type, id_value)) for id_type, id_value in (person_ids or {}).items()
+                if id_value}
+        if keys & self.failed or any(key not in self.by_id for key in keys):
+            return True
+        if self._resolved_by_id(person_ids) is None:
+            name = normalize_name(contributor_name(contributor))
+            return name in self.failed or (bool(name) and name not in self.by_name)
+        return False
+
+    def find_person(self, contributor, person_ids, date, type):
+        """Same as find_person, from the resolved persons."""
+        if pure_person_index.fresh_index() is not None or self._needs_lookup(contributor, person_ids):
+            return find_person(contributor, person_ids, date, type)
+        return match_person(contributor, person_ids, parse_date(date) if date else None, type,
+                            lambda id_value: self.by_id.get(pure_person_index.id_key(id_value), []),
+                            lambda name: self.by_name.get(normalize_name(name), []))
 
 
 def get_active_associations(person_details, ref_date_str):
@@ -246,6 +415,74 @@ def get_active_associations(person_details, ref_date_str):
     person_details['associationsUUIDs'] = active_associations
     return person_details
 
+class ExternalPersonRegistry:
+    """
+    Remembers for the whole run which external person belongs to an identifier.
+
+    The answer of a search is remembered as is, the tuple of uuids of all external persons
+    it found (empty for not found), so every ORCID or OpenAlex id is searched in Pure at
+    most once per run. The callers decide what a match is, e.g. pure_persons only takes
+    a single hit and pure_researchoutputs the first one, so they can share the registry.
+    External persons created in this run are registered under their ids, apart from the
+    search answers, so later research outputs of the same co-author reuse them instead
+    of creating them again. Failed searches are not remembered.
+    """
+
+    def __init__(self):
+        self._uuids = {}
+        self._created = {}
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'searches': 0, 'created': 0, 'reused': 0}
+
+    @staticmethod
+    def key(id_type, id_value):
+        return id_type.lower(), pure_person_index.id_key(normalize_person_id(id_type, id_value))
+
+    def get(self, id_type, id_value):
+        """Return the remembered tuple of uuids (empty for not found), or MISSING."""
+        with self._lock:
+            uuid = self._uuids.get(self.key(id_type, id_value), MISSING)
+            if uuid is not MISSING:
+                self.stats['hits'] += 1
+            return uuid
+
+    def remember(self, id_type, id_value, items):
+        """Remember the uuids of the external persons that a search for the id found."""
+        uuids = tuple(item['uuid'] for item in items if item.get('uuid'))
+        with self._lock:
+            self.stats['searches'] += 1
+            self._uuids[self.key(id_type, id_value)] = uuids
+
+    def created(self, orcid=None, openalex=None):
+        """Return the uuid of an external person with one of the ids that this run created, or None."""
+        for id_type, id_value in (('orcid', orcid), ('openalex', openalex)):
+            if id_value:
+                with self._lock:
+                    uuid = self._created.get(self.key(id_type, id_value))
+                    if uuid:
+                        self.stats['reused'] += 1
+                        return uuid
+        return None
+
+    def register(self, uuid, orcid=None, openalex=None):
+        """Remember a newly created external person under its ids."""
+        if not uuid:
+            return
+        with self._lock:
+            self.stats['created'] += 1
+            for id_type, id_value in (('orcid', orcid), ('openalex', openalex)):
+                if id_value:
+                    self._created[self.key(id_type, id_value)] = uuid
+
+    def log_stats(self):
+        logger.info(f"external persons: {self.stats['searches']} ids searched, {self.stats['hits']} answered "
+                    f"from memory, {self.stats['created']} created, {self.stats['reused']} creations avoided")
+
+
+# shared by all modules, for the whole run
+external_persons = ExternalPersonRegistry()
+
+
 def find_external_person(person_ids):
     orcid = None
     openalex = None
@@ -260,11 +497,17 @@ def find_external_person(person_ids):
             id_value = id_value.replace("https://openalex.org/", "")
             openalex = id_value
 
+        remembered = external_persons.get(id_type, id_value)
+        if remembered is not MISSING:
+            if len(remembered) == 1:
+                first_uuid = remembered[0]
+            continue
+
         data = {"searchString": id_value}
         json_data = json.dumps(data)
         api_url = PURE_BASE_URL + 'external-persons/search/'
         try:
-            response = requests.post(api_url, headers=PURE_HEADERS, data=json_data)
+            response = pure_client.client.post(api_url, data=json_data)
             if response.status_code == 200:
                 data = response.json()
                 items = data.get('items', [])
@@ -279,6 +522,7 @@ def find_external_person(person_ids):
 
                     else:
                         logger.debug(f"Multiple or no persons found for {id_type}, {id_value}")
+                external_persons.remember(id_type, id_value, items)
             else:
                 logger.error(f"Error searching for {id_type}: {response.status_code} - {response.text}")
         except requests.RequestException as e:
@@ -293,6 +537,11 @@ def create_external_person(first_name, last_name, orcid, openalex):
     :param first_name, last_name:  first and last names.
     :return: UUID of the newly created external person.
     """
+    # created earlier in this run for another research output
+    existing_uuid = external_persons.created(orcid, openalex)
+    if existing_uuid:
+        return existing_uuid
+
     api_url = PURE_BASE_URL + 'external-persons/'
 
 
@@ -330,10 +579,11 @@ def create_external_person(first_name, last_name, orcid, openalex):
     json_data = json.dumps(data)
 
     try:
-        response = requests.put(api_url, headers=PURE_HEADERS, data=json_data)
+        response = pure_client.client.put(api_url, data=json_data, retry=False)
 
         if response.status_code in [200, 201]:
             external_person = response.json()
+            external_persons.register(external_person.get('uuid'), orcid, openalex)
             return external_person.get('uuid')
         else:
             logger.error(f"Error creating external person: {response.status_code} - {response.text}")
@@ -342,6 +592,76 @@ def create_external_person(first_name, last_name, orcid, openalex):
 
     return None
 
+def ror_key(ror):
+    """The form in which RORs are compared: the lower case id, without https://ror.org/."""
+    return ror.strip().rstrip('/').split('/')[-1].lower() if isinstance(ror, str) else ''
+
+
+def ror_url(ror):
+    """The form in which RORs are searched in Pure, which stores the full https://ror.org/ url."""
+    key = ror_key(ror)
+    return f'https://ror.org/{key}' if key else ''
+
+
+def external_org_rors(item):
+    """The RORs (as ror_key) in the ROR identifiers of an external organization record of Pure."""
+    return {ror_key(identifier.get('id')) for identifier in item.get('identifiers', [])
+            if identifier.get('type', {}).get('uri') == ROR_ID_URI} - {''}
+
+
+def _remember_external_org(ror, uuid, hits):
+    external_org_lookups.remember(ror, {'uuid': uuid, 'hits': hits})
+
+
+def _known_external_org(ror):
+    entry = external_org_lookups.get(ror)
+    return entry if entry is MISSING else entry['uuid']
+
+
+def forget_external_org(ror):
+    """
+    Drops the cached lookup of a ROR, e.g. after the ROR was added to an external organization
+    or organizations with the ROR were merged, so the next lookup searches Pure again.
+    """
+    key = ror_key(ror)
+    if key:
+        external_org_lookups.forget(key)
+
+
+def prefetch_external_orgs(rors, batch_size=50):
+    """
+    Looks up the external organizations of all RORs at once, so find_extenal_orgs does not
+    need a request per affiliation.
+
+    The RORs that are not in the external organization cache are searched, as full
+    https://ror.org/ urls like in find_extenal_orgs, in batches of pipe-separated
+    searchStrings. As in find_extenal_orgs an organization is only used when
+    it is the only one with the ROR as ROR identifier; RORs without or with more than one
+    organization are remembered as None, RORs of failed batches are not remembered.
+
+    Parameters:
+    rors (iterable): The RORs, e.g. the affiliations['ROR'] of the contributors.
+    batch_size (int): The number of RORs per search.
+    """
+    rors = list(dict.fromkeys(key for key in map(ror_key, rors) if key))
+    todo = [ror for ror in rors if _known_external_org(ror) is MISSING]
+    items, failed = pure_client.client.search_all('external-organizations', map(ror_url, todo), batch_size)
+    failed = set(map(ror_key, failed))
+    uuids = {}
+    for item in items:
+        for ror in external_org_rors(item):
+            uuids.setdefault(ror, []).append(item['uuid'])
+    ambiguous = 0
+    for ror in todo:
+        if ror in failed:
+            continue
+        matches = uuids.get(ror, [])
+        ambiguous += len(matches) > 1
+        _remember_external_org(ror, matches[0] if len(matches) == 1 else None, len(matches))
+    logger.info(f"{len(rors)} distinct RORs, {len(rors) - len(todo)} from the external organization cache, "
+                f"{len(todo) - len(failed)} looked up in Pure ({ambiguous} with more than one organization)")
+
+
 def find_extenal_orgs(affiliations):
     # 'affiliations': {'OpenAlex': 'https://openalex.org/I193662353', 'ROR': 'https://ror.org/04pp8hn57'}}
 
@@ -349,27 +669,33 @@ def find_extenal_orgs(affiliations):
 
     first_uuid = None
     if ror:
-        data = {"searchString": ror}
+        first_uuid = _known_external_org(ror_key(ror))
+        if first_uuid is not MISSING:
+            return first_uuid
+        first_uuid = None
+        data = {"searchString": ror_url(ror)}
         json_data = json.dumps(data)
         api_url = PURE_BASE_URL + 'external-organizations/search/'
         try:
-            response = requests.post(api_url, headers=PURE_HEADERS, data=json_data)
+            response = pure_client.client.post(api_url, data=json_data)
             if response.status_code == 200:
                 data = response.json()
-                items = data.get('items', [])
+                # the search also finds organizations that mention the ROR elsewhere in their record
+                items = [item for item in data.get('items', []) if ror_key(ror) in external_org_rors(item)]
 
                 if items:
                     if len(items) == 1:
 
                         # Extract the UUID of the first item in the "items" list
-                        first_uuid = data['items'][0]['uuid']
+                        first_uuid = items[0]['uuid']
                         logger.debug(f"Person found with {ror}")
 
                     else:
                         logger.debug(f"Multiple or no orgs found for {ror}")
+                _remember_external_org(ror_key(ror), first_uuid, len(items))
             else:
                 logger.debug(f"Error searching for {ror}")
         except requests.RequestException as e:
             logger.debug(f"An error occurred while searching for {ror}: {e}")
 
-    return first_uuid
\ No newline at end of file
+    return first_uuid
@@ -33,22 +33,32 @@
 import pandas as pd
 import json
 import requests
+import pure_client
 from datetime import datetime
 import configparser
 import os
 import logging
 import pure_persons
+import harvest_state
+from cache_utils import LookupCache, MISSING
 from logging_config import setup_logging
 import logging.handlers
 from dateutil import parser
-from config import PURE_BASE_URL, PURE_API_KEY, OPENALEXEX_ID_URI, ORCID_ID_URI, OPENALEX_HEADERS, OPENALEX_BASE_URL, PURE_HEADERS
-import time
+from config import PURE_BASE_URL, PURE_API_KEY, OPENALEXEX_ID_URI, ORCID_ID_URI, OPENALEX_HEADERS, OPENALEX_BASE_URL
+from config import PURE_LOOKUP_TTL, PURE_LOOKUP_MAX_BYTES
 import sys
+import threading
 logger = setup_logging('btp', level=logging.INFO)
+
+# ISSN -> journal uuid (None if Pure has no journal with the ISSN), kept between runs
+journal_lookups = LookupCache('journals', PURE_LOOKUP_TTL, PURE_LOOKUP_MAX_BYTES)
+# create_research_output runs in parallel, the error file is written by one thread at a time
+_error_file_lock = threading.Lock()
+
+
 def get_researchoutput(uuid):
-    headers = PURE_HEADERS
     api_url = PURE_BASE_URL + 'research-outputs/' + uuid
-    response = requests.get(api_url, headers=headers)
+    response = pure_client.client.get(api_url)
     if response.status_code == 200:
         data = response.json()
         return data
@@ -62,6 +72,11 @@ def create_external_person(first_name, last_name, orcid, openalex):
     :param first_name, last_name:  first and last names.
     :return: UUID of the newly created external person.
     """
+    # created earlier in this run for another research output
+    existing_uuid = pure_persons.external_persons.created(orcid, openalex)
+    if existing_uuid:
+        return existing_uuid
+
     api_url = PURE_BASE_URL + 'external-persons/'
     url = "https://staging.research-portal.uu.nl/ws/api/external-persons"
 
@@ -99,10 +114,11 @@ def create_external_person(first_name, last_name, orcid, openalex):
     json_data = json.dumps(data)
 
     try:
-        response = requests.put(api_url, headers=PURE_HEADERS, data=json_data)
+        response = pure_client.client.put(api_url, data=json_data, retry=False)
 
         if response.status_code in [200, 201]:
             external_person = response.json()
+            pure_persons.external_persons.register(external_person.get('uuid'), orcid, openalex)
             return external_person.get('uuid')
         else:
             logger.error(f"Error creating external person: {response.status_code} - {response.text}")
@@ -131,19 +147,27 @@ def find_external_person(person_ids):
         elif id_type.lower() == 'openalex' and openalex:
             id_value = openalex
 
+        remembered = pure_persons.external_persons.get(id_type, id_value)
+        if remembered is not MISSING:
+            if remembered:
+                first_uuid = remembered[0]
+                break
+            continue
+
         data = {"searchString": id_value}
         api_url = PURE_BASE_URL + 'external-persons/search/'
 
         logger.debug(f"Searching for {id_type}: {id_value} with payload: {data}")
 
         try:
-            response = requests.post(api_url, headers=PURE_HEADERS, json=data)  # Using json=data
+            response = pure_client.client.post(api_url, json=data)  # Using json=data
             logger.debug(f"Response status code: {response.status_code}")
 
             if response.status_code == 200:
                 response_data = response.json()
                 items = response_data.get('items', [])
 
+                pure_persons.external_persons.remember(id_type, id_value, items)
                 if items:
                     first_uuid = items[0].get('uuid')
                     logger.debug(f"Person found with {id_type}: {id_value}, UUID: {first_uuid}")
@@ -165,44 +189,27 @@ def find_external_person(person_ids):
 
 def find_extenal_orgs(affiliations):
     # 'affiliations': {'OpenAlex': 'https://openalex.org/I193662353', 'ROR': 'https://ror.org/04pp8hn57'}}
-    ror = affiliations.get('ROR')
+    return pure_persons.find_extenal_orgs(affiliations)
 
-    first_uuid = None
-    if ror:
-        data = {"searchString": ror}
-        json_data = json.dumps(data)
-        api_url = PURE_BASE_URL + 'external-organizations/search/'
-        try:
-            response = requests.post(api_url, headers=PURE_HEADERS, data=json_data)
-            if response.status_code == 200:
-                data = response.json()
-                items = data.get('items', [])
-
-                if items:
-                    if len(items) == 1:
-
-                        # Extract the UUID of the first item in the "items" list
-                        first_uuid = data['items'][0]['uuid']
-                        logger.debug(f"Person found with {ror}")
-
-                    else:
-                        logger.debug(f"Multiple or no orgs found for {ror}")
-            else:
-                logger.error(f"Error searching for {ror}")
-        except requests.RequestException as e:
-            logger.error(f"An error occurred while searching for {ror}: {e}")
 
-    return first_uuid
+def affiliation_rors(contributor_lists):
+    """Return the RORs of the affiliations of the contributors, for pure_persons.prefetch_external_orgs."""
+    return [contributor['affiliations'].get('ROR')
+            for contributors in contributor_lists if isinstance(contributors, list)
+            for contributor in contributors
+            if isinstance(contributor, dict) and isinstance(contributor.get('affiliations'), dict)]
 
 
-def get_contributors_details(contributors, ref_date):
+def get_contributors_details(contributors, ref_date, resolver=None):
     persons = {}
     found_internal_person = False
+    # a ContributorResolver answers from the persons it resolved for the whole DataFrame
+    find_person = resolver.find_person if resolver else pure_persons.find_person
 
     # First pass: Check for internal persons and mark if any are found
     for contributor in contributors:
         contributor_id = contributor['name']
-        person_details = pure_persons.find_person(contributor, contributor['ids'], ref_date, None)
+        person_details = find_person(contributor, contributor['ids'], ref_date, None)
         if person_details:
             persons[contributor_id] = person_details
             found_internal_person = True
@@ -262,27 +269,66 @@ def parse_keywords(keywords):
 
     return data
 
-def get_journal_uuid(issn):
-    # url = "https://staging.research-portal.uu.nl/ws/api/journals/search/"
-    url = PURE_BASE_URL + '/journals/search/'
-    data = {"searchString": issn}
-    json_data = json.dumps(data)
-    headers = PURE_HEADERS
-    response = requests.post(url, headers=headers, data=json_data)
-    data = response.json()
-    items = data.get('items', [])
+def is_issn(issn):
+    return bool(issn) and isinstance(issn, str) and issn != 'No ISSN'
 
-    if items:
-        for item in items:
 
-            journal_uuid = item['uuid']
+def issn_key(issn):
+    """The form in which ISSNs are compared: upper case, without hyphen and spaces."""
+    return issn.replace('-', '').replace(' ', '').upper() if isinstance(issn, str) else ''
 
-        if not journal_uuid:
-            journal_uuid = None
-    else:
-        journal_uuid = None
+
+def journal_issns(item):
+    """The ISSNs (as issn_key) in the issns of a journal record of Pure."""
+    return {issn_key(entry.get('issn') if isinstance(entry, dict) else entry)
+            for entry in item.get('issns', [])} - {''}
 
 
+def match_journal(issn, items):
+    """Returns the uuid of the only journal in items that has the ISSN as one of its issns, or None."""
+    matches = [item['uuid'] for item in items if issn_key(issn) in journal_issns(item)]
+    return matches[0] if len(matches) == 1 else None
+
+
+def prefetch_journals(issns, batch_size=50):
+    """
+    Looks up the journals of all ISSNs at once, so get_journal_uuid does not need a request per row.
+
+    The ISSNs that are not in the journal cache are searched in batches of pipe-separated
+    searchStrings. As in get_journal_uuid a journal belongs to an ISSN when the ISSN is one
+    of its issns and it is the only such journal. ISSNs without a journal are remembered as
+    None, ISSNs of failed batches are not remembered.
+
+    Parameters:
+    issns (iterable): The ISSNs, e.g. the journal_issn column.
+    batch_size (int): The number of ISSNs per search.
+    """
+    issns = list(dict.fromkeys(issn for issn in issns if is_issn(issn)))
+    todo = [issn for issn in issns if journal_lookups.get(issn) is MISSING]
+    items, failed = pure_client.client.search_all('journals', todo, batch_size)
+    failed = set(failed)
+    for issn in todo:
+        if issn in failed:
+            continue
+        journal_lookups.remember(issn, match_journal(issn, items))
+    logger.info(f"{len(issns)} distinct ISSNs, {len(issns) - len(todo)} from the journal cache, "
+                f"{len(todo) - len(failed)} looked up in Pure")
+
+
+def get_journal_uuid(issn):
+    journal_uuid = journal_lookups.get(issn)
+    if journal_uuid is not MISSING:
+        return journal_uuid
+    # url = "https://staging.research-portal.uu.nl/ws/api/journals/search/"
+    url = PURE_BASE_URL + '/journals/search/'
+    data = {"searchString": issn}
+    json_data = json.dumps(data)
+    response = pure_client.client.post(url, data=json_data)
+    if response.status_code != 200:
+        return None
+    # the search also finds journals that only mention the ISSN, e.g. as a related title
+    journal_uuid = match_journal(issn, response.json().get('items', []))
+    journal_lookups.remember(issn, journal_uuid)
     return journal_uuid
 
 
@@ -488,26 +534,28 @@ def format_contributors(contributors_data):
 
 
 def create_research_output(research_output_json):
+    """
+    Creates a research output in Pure. Can be called from several threads at once.
+
+    Returns:
+    bool: True if Pure created it. The JSON of a research output Pure rejected is
+          appended to research_output.jsonerror.
+    """
     url = " https://staging.research-portal.uu.nl/ws/api/research-outputs"
     json_data = json.dumps(research_output_json)
-    # Open a file for writing
-    with open('test123.json', 'w') as file:
-        json.dump(json_data, file, indent=4)
     # Make the put request
-    headers = PURE_HEADERS
-    response = requests.put(url, headers=headers, data=json_data)
+    response = pure_client.client.put(url, data=json_data, retry=False)
     if response.status_code in [200, 201]:
         logger.info(f"created researchoutput: {response.status_code} ")
-    else:
-        output_file = "research_output.jsonerror"
-
-        # Write the dictionary to a JSON file
-        with open(output_file, 'w') as json_file:
-            json.dump(research_output_json, json_file, indent=4)
-        logger.error(f"Error creating research output: {response.status_code} - {response.text}")
+        return True
 
-
-    return 'test'
+    output_file = "research_output.jsonerror"
+    # one line per rejected research output, written by one thread at a time
+    with _error_file_lock:
+        with open(output_file, 'a') as json_file:
+            json_file.write(json.dumps(research_output_json) + '\n')
+    logger.error(f"Error creating research output: {response.status_code} - {response.text}")
+    return False
 
 
 def get_supervisors(supervisors, ref_date):
@@ -624,14 +672,13 @@ def format_rest(row):
 def check_research_in_pure(doi):
 
     exists_in_pure =  False
-    headers = PURE_HEADERS
     doi = doi.split("org/")[-1]
     data = {"searchString": doi}
 
     json_data = json.dumps(data)
     api_url = PURE_BASE_URL + 'research-outputs/search/'
 
-    response = requests.post(api_url, headers=headers, data=json_data)
+    response = pure_client.client.post(api_url, data=json_data)
 
     if response.status_code == 200:
         data = response.json()
@@ -650,30 +697,74 @@ def check_research_in_pure(doi):
     return exists_in_pure
 
 
-def df_to_pure(df):
+def doi_key(doi):
+    """The form in which DOIs are compared: lower case, without the https://doi.org/ prefix."""
+    return doi.split("org/")[-1].strip().lower() if isinstance(doi, str) else ''
+
+
+def dois_in_pure(dois, batch_size=50):
+    """
+    Checks for all DOIs at once which research outputs are already in Pure.
+
+    The DOIs are searched in batches of pipe-separated searchStrings and, as in
+    check_research_in_pure, a DOI is in Pure when it is the doi of an electronic
+    version of one of the research outputs found.
+
+    Parameters:
+    dois (iterable): The DOIs, e.g. the doi column.
+    batch_size (int): The number of DOIs per search.
+
+    Returns:
+    tuple: The set of doi_key()s in Pure, and the set of DOIs of failed batches,
+           which still have to be checked with check_research_in_pure.
+    """
+    dois = list(dict.fromkeys(doi for doi in dois if doi_key(doi)))
+    searches = list(dict.fromkeys(doi.split("org/")[-1] for doi in dois))
+    items, failed = pure_client.client.search_all('research-outputs', searches, batch_size)
+    in_pure = {doi_key(version['doi']) for item in items
+               for version in item.get('electronicVersions', []) if version.get('doi')}
+    failed = {doi_key(doi) for doi in failed}
+    unchecked = {doi for doi in dois if doi_key(doi) in failed}
+    wanted = {doi_key(doi) for doi in dois}
+    logger.info(f"{len(wanted & in_pure)} of {len(dois)} DOIs already in Pure, {len(unchecked)} could not be checked")
+    return wanted & in_pure, unchecked
+
+
+def df_to_pure(df, state=None):
     # Initialize a list to collect all research output JSONs
     research_output_collection = []
     success = 0
     error = 0
     inpure = 0
+    # outcome per DOI, stored in the harvest state (if given) for --since-last-run
+    outcomes = {harvest_state.IMPORTED: [], harvest_state.IN_PURE: [], harvest_state.REJECTED: []}
 
     # Initialize a list to hold rows for the "to be updated" DataFrame
     to_be_updated_rows = []
     logger.info('Formatting the output in Pure needed JSON format. This is a slow process, you might want to get some coffee...')
+    # resolve the contributors of all rows in batches, so the rows only need lookups in memory
+    resolver = pure_persons.ContributorResolver('ids')
+    if not df.empty:
+        resolver.resolve(df['contributors'])
+        prefetch_journals(df.loc[df['type'] == 'article', 'journal_issn'])
+        pure_persons.prefetch_external_orgs(affiliation_rors(df['contributors']))
+    # check which DOIs are already in Pure in batches, the rows only look them up in the set
+    in_pure, unchecked = dois_in_pure(df['doi']) if not df.empty else (set(), set())
     for index, row in df.iterrows():
         if index % 25 == 0:  # Print progress every 5 iterations
             print(f"Processing: {index}", flush=True)
-            time.sleep(0.1)  # Simulate work
 
         try:
             logger.debug('Processing research output: %s', row['title'])
 
             # Check if the research output exists in Pure
-            exists_in_pure = check_research_in_pure(row['doi'])
+            exists_in_pure = doi_key(row['doi']) in in_pure
+            if row['doi'] in unchecked:
+                exists_in_pure = check_research_in_pure(row['doi'])
 
             if not exists_in_pure:
                 # Get contributor details
-                contributors_details = get_contributors_details(row['contributors'], row['publication_date'])
+                contributors_details = get_contributors_details(row['contributors'], row['publication_date'], resolver)
                 if contributors_details:
                     # Format and enrich row data
                     row['parsed_contributors'] = format_contributors(contributors_details)
@@ -700,19 +791,28 @@ def df_to_pure(df):
                         })
 
                         success += 1
+                        outcomes[harvest_state.IMPORTED].append(row['doi'])
                     else:
                         logger.debug(f"Validation failed for research output {row['research_output_id']}.")
                         error += 1
+                        outcomes[harvest_state.REJECTED].append(row['doi'])
                 else:
                     logger.debug(
                         f"Skipped research output {row['research_output_id']} due to missing contributor details.")
                     error += 1
+                    outcomes[harvest_state.REJECTED].append(row['doi'])
             else:
                 inpure += 1
+                outcomes[harvest_state.IN_PURE].append(row['doi'])
                 logger.debug(f"already in pure {row['doi']}.")
         except Exception as e:
             logger.debug(f"Error processing row {index}: {e}")
             error += 1
+            outcomes[harvest_state.REJECTED].append(row['doi'])
+
+    if state is not None:
+        for outcome, dois in outcomes.items():
+            state.record_many(dois, outcome)
 
     # Save the collected research outputs to a JSON file
     output_dir = 'output/research_output'
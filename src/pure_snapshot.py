@@ -0,0 +1,237 @@
+# ########################################################################
+# Script: pure_snapshot.py
+#
+# Description:
+# This script keeps a local snapshot of the research outputs in Pure, so the
+# enrichment scripts can look up the research outputs of the harvested DOIs
+# without searching Pure for them on every run. It can be imported, or executed
+# standalone to build or refresh the snapshot.
+#
+# Functions include:
+# - A full sync, paging through all research outputs of Pure.
+# - A delta sync, fetching only the research outputs modified since the last
+#   sync (with an overlap of SYNC_OVERLAP seconds).
+# - Looking up research outputs by UUID and by normalized DOI (the DOIs of the
+#   electronic versions and additional links, as get_ro_from_pure matches them).
+# - current_snapshot(), which delta-syncs the snapshot and returns it for the
+#   enrichment scripts, or None when they have to search Pure.
+#
+# Important:
+# The snapshot is stored in the [CACHE] directory of config.ini. Run
+#   python pure_snapshot.py --full
+# once to build it; later runs of the enrichment scripts keep it up to date.
+# A delta sync does not see research outputs that were deleted from Pure, run
+# a full sync now and then to remove them.
+#
+# Dependencies:
+# - sqlite3, json, pure_client, ricgraph_utils, argparse, logging, etc.
+#
+# Author: David Grote Beverborg
+# Created: 2024
+#
+# License:
+# MIT License
+#
+# Copyright (c) 2024 David Grote Beverborg
+# ########################################################################
+
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+import requests
+import pure_client
+from ricgraph_utils import normalize_doi
+from config import CACHE_DIR, RESEARCH_OUTPUT_SNAPSHOT_MAX_AGE
+from logging_config import setup_logging
+
+logger = setup_logging('btp', level=logging.INFO)
+
+DEFAULT_SNAPSHOT = os.path.join(CACHE_DIR, 'pure_researchoutputs.sqlite')
+# the parts of a research output that the enrichment scripts use
+RESEARCH_OUTPUT_FIELDS = ('uuid', 'title', 'type', 'contributors', 'externalOrganizations',
+                          'electronicVersions', 'additionalLinks', 'modifiedDate')
+# seconds that a delta sync looks back before the start of the previous sync, for clock differences
+SYNC_OVERLAP = 3600
+
+
+def research_output_dois(item):
+    """Return the normalized DOIs of a research output: those of its electronic versions and additional links."""
+    dois = [version['doi'] for version in item.get('electronicVersions', []) if version.get('doi')]
+    dois += [link['url'] for link in item.get('additionalLinks', []) if link.get('url')]
+    return {normalize_doi(doi) for doi in dois}
+
+
+def _research_output_fields(items):
+    return [{field: item[field] for field in RESEARCH_OUTPUT_FIELDS if field in item} for item in items]
+
+
+def fetch_all_researchoutputs(page_size=500):
+    """
+    Pages through all research outputs in Pure, the pages after the first one in parallel.
+
+    Returns:
+    list: All research outputs, with only the RESEARCH_OUTPUT_FIELDS.
+    """
+    items, count = pure_client.client.fetch_pages('research-outputs', page_size)
+    items = _research_output_fields(items)
+    logger.info(f"Fetched {len(items)} of {count} research outputs from Pure")
+    return items
+
+
+def fetch_modified_researchoutputs(modified_after, page_size=500):
+    """
+    Fetches the research outputs that were modified after a moment.
+
+    Parameters:
+    modified_after (str): ISO 8601 date and time, in UTC.
+    page_size (int): The number of research outputs per request.
+
+    Returns:
+    list: The research outputs, with only the RESEARCH_OUTPUT_FIELDS.
+    """
+    items, _ = pure_client.client.fetch_pages('research-outputs/search', page_size, {'modifiedAfter': modified_after})
+    items = _research_output_fields(items)
+    logger.info(f"Fetched {len(items)} research outputs modified since {modified_after} from Pure")
+    return items
+
+
+class ResearchOutputSnapshot:
+    """
+    The research outputs of Pure in a SQLite file, with a table of their DOIs.
+    """
+
+    def __init__(self, path=DEFAULT_SNAPSHOT):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS research_outputs (uuid TEXT PRIMARY KEY, data TEXT)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS research_output_dois (doi TEXT, uuid TEXT)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS research_output_dois_doi ON research_output_dois (doi)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS research_output_dois_uuid ON research_output_dois (uuid)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+        self._conn.commit()
+
+    def synced(self):
+        """Return the start time of the last sync, or None if the snapshot was never synced."""
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE name = 'synced'").fetchone()
+        return float(row[0]) if row else None
+
+    def is_fresh(self, max_age_hours=RESEARCH_OUTPUT_SNAPSHOT_MAX_AGE):
+        synced = self.synced()
+        return synced is not None and max_age_hours > 0 and time.time() - synced < max_age_hours * 3600
+
+    def store(self, items, started, full=False):
+        """
+        Stores the research outputs in one transaction, replacing the earlier versions.
+
+        Parameters:
+        items (list): The research outputs.
+        started (float): The time the sync started, the next delta sync starts from there.
+        full (bool): The items are all research outputs in Pure, the others are removed.
+
+        Returns:
+        int: The number of research outputs stored.
+        """
+        items = [item for item in items if item.get('uuid')]
+        rows = [(item['uuid'], json.dumps(item)) for item in items]
+        doi_rows = [(doi, item['uuid']) for item in items for doi in research_output_dois(item)]
+        with self._lock:
+            with self._conn:
+                if full:
+                    self._conn.execute("DELETE FROM research_outputs")
+                    self._conn.execute("DELETE FROM research_output_dois")
+                else:
+                    self._conn.executemany("DELETE FROM research_output_dois WHERE uuid = ?",
+                                           [(uuid,) for uuid, _ in rows])
+                self._conn.executemany("INSERT OR REPLACE INTO research_outputs VALUES (?, ?)", rows)
+                self._conn.executemany("INSERT INTO research_output_dois VALUES (?, ?)", doi_rows)
+                self._conn.execute("INSERT OR REPLACE INTO meta VALUES ('synced', ?)", (str(started),))
+        return len(rows)
+
+    def sync(self, full=False, page_size=500):
+        """
+        Brings the snapshot up to date: a full sync the first time (or when asked),
+        otherwise a delta sync of the research outputs modified since the last sync.
+
+        Returns:
+        int: The number of research outputs fetched.
+        """
+        started = time.time()
+        start = time.perf_counter()
+        synced = self.synced()
+        full = full or synced is None
+        if full:
+            items = fetch_all_researchoutputs(page_size)
+        else:
+            modified_after = datetime.fromtimestamp(synced - SYNC_OVERLAP, timezone.utc)
+            items = fetch_modified_researchoutputs(modified_after.strftime('%Y-%m-%dT%H:%M:%SZ'), page_size)
+        count = self.store(items, started, full)
+        logger.info(f"{'Full' if full else 'Delta'} sync of {count} research outputs into {self.path} "
+                    f"in {time.perf_counter() - start:.1f}s")
+        return count
+
+    def get(self, uuid):
+        """Return the research output with the UUID, or None."""
+        with self._lock:
+            row = self._conn.execute("SELECT data FROM research_outputs WHERE uuid = ?", (uuid,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def find_by_doi(self, doi):
+        """Return the research outputs with the DOI."""
+        sql = ("SELECT DISTINCT r.data FROM research_output_dois d JOIN research_outputs r ON r.uuid = d.uuid "
+               "WHERE d.doi = ?")
+        with self._lock:
+            rows = self._conn.execute(sql, (normalize_doi(doi),)).fetchall()
+        return [json.loads(data) for data, in rows]
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM research_outputs").fetchone()[0]
+
+
+def current_snapshot(path=DEFAULT_SNAPSHOT):
+    """
+    Delta-syncs the snapshot and returns it, for the enrichment scripts.
+
+    Returns:
+    ResearchOutputSnapshot: The snapshot, or None when there is none (or it is switched
+    off, or it cannot be synced and is older than ResearchOutputSnapshotMaxAge hours)
+    and the research outputs have to be searched in Pure.
+    """
+    if RESEARCH_OUTPUT_SNAPSHOT_MAX_AGE <= 0 or not os.path.exists(path):
+        return None
+    snapshot = ResearchOutputSnapshot(path)
+    if snapshot.synced() is None:
+        return None
+    try:
+        snapshot.sync()
+    except requests.RequestException as e:
+        logger.warning(f"Could not sync the research output snapshot {path}: {e}")
+        if not snapshot.is_fresh():
+            logger.info(f"The research output snapshot {path} is older than {RESEARCH_OUTPUT_SNAPSHOT_MAX_AGE} "
+                        f"hours, searching Pure instead")
+            return None
+    logger.info(f"Looking up research outputs in the snapshot {path} ({len(snapshot)} research outputs)")
+    return snapshot
+
+
+# ########################################################################
+# MAIN
+# ########################################################################
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sync the local snapshot of Pure research outputs')
+    parser.add_argument('--db', type=str, default=DEFAULT_SNAPSHOT, help='SQLite file of the snapshot')
+    parser.add_argument('--full', action='store_true', help='Fetch all research outputs instead of the modified ones')
+    parser.add_argument('--page-size', type=int, default=500, help='Number of research outputs per request')
+
+    args = parser.parse_args()
+    ResearchOutputSnapshot(args.db).sync(args.full, args.page_size)
+    pure_client.client.log_stats()
@@ -0,0 +1,237 @@
+# ########################################################################
+# Script: ricgraph_dump.py
+#
+# Description:
+# This script loads an export of Ricgraph into a local SQLite table and answers
+# the Ricgraph API requests of the harvest from that table, so a run over all
+# faculties does not need thousands of REST calls. It can be imported, or
+# executed standalone to ingest an export file.
+#
+# Functions include:
+# - Ingesting a CSV or JSON export with one row per faculty, person-root and
+#   neighbor node (columns: faculty, personroot, category, name, value, source).
+# - A RicgraphDump that has the same interface as the RicgraphClient and answers
+#   organization/search, get_all_personroot_nodes, get_all_neighbor_nodes,
+#   organization/enrich, person/enrich and advanced_search from the table.
+# - use_dump(), which replaces the shared ricgraph_utils.client by a RicgraphDump.
+#
+# Important:
+# The faculty column holds the faculty name (or its key ending in
+# |organization_name) and the personroot column the person-root value (or its
+# key). Person ids such as ORCID have category 'person'. The source column lists
+# the source systems of the node, separated by ';' (or a list in JSON).
+# The answers are only as recent as the export.
+#
+# Dependencies:
+# - sqlite3, csv, json, ricgraph_utils, argparse, logging, etc.
+#
+# Author: David Grote Beverborg
+# Created: 2024
+#
+# License:
+# MIT License
+#
+# Copyright (c) 2024 David Grote Beverborg
+# ########################################################################
+
+import argparse
+import csv
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import ricgraph_utils
+from config import CACHE_DIR
+from logging_config import setup_logging
+
+logger = setup_logging('btp', level=logging.INFO)
+
+DEFAULT_DUMP = os.path.join(CACHE_DIR, 'ricgraph_dump.sqlite')
+COLUMNS = ('faculty', 'personroot', 'category', 'name', 'value', 'source')
+
+
+def _key(value, name):
+    return value if '|' in value else f"{value}|{name}"
+
+
+def _sources(source):
+    if isinstance(source, list):
+        return ';'.join(source)
+    return source or ''
+
+
+def read_export(path):
+    """
+    Reads the rows of a Ricgraph export.
+
+    Parameters:
+    path (str): A .csv file, or a .json file with a list of rows (or {"results": [...]}).
+
+    Returns:
+    generator: The rows as tuples in the order of COLUMNS.
+    """
+    if path.lower().endswith('.json'):
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        yield from _export_rows(data.get('results', []) if isinstance(data, dict) else data)
+    else:
+        with open(path, newline='', encoding='utf-8') as f:
+            yield from _export_rows(csv.DictReader(f))
+
+
+def _export_rows(rows):
+    for row in rows:
+        yield (
+            _key(row['faculty'], 'organization_name'),
+            _key(row['personroot'], 'person-root'),
+            row['category'],
+            row['name'],
+            row['value'],
+            _sources(row.get('source')),
+        )
+
+
+def ingest(path, db_path=DEFAULT_DUMP):
+    """
+    Loads a Ricgraph export into the dump table, replacing what was there.
+
+    Parameters:
+    path (str): The CSV or JSON export.
+    db_path (str): The SQLite file of the dump.
+
+    Returns:
+    int: The number of rows loaded.
+    """
+    os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+    conn = sqlite3.connect(db_path)
+    conn.execute("DROP TABLE IF EXISTS nodes")
+    conn.execute("CREATE TABLE nodes (faculty TEXT, personroot TEXT, category TEXT, name TEXT, value TEXT, source TEXT)")
+    count = 0
+    rows = read_export(path)
+    while True:
+        batch = [row for _, row in zip(range(10000), rows)]
+        if not batch:
+            break
+        conn.executemany("INSERT INTO nodes VALUES (?, ?, ?, ?, ?, ?)", batch)
+        count += len(batch)
+    conn.execute("CREATE INDEX nodes_faculty ON nodes (faculty, category)")
+    conn.execute("CREATE INDEX nodes_personroot ON nodes (personroot, category)")
+    conn.execute("CREATE INDEX nodes_category ON nodes (category)")
+    conn.commit()
+    conn.close()
+    logger.info(f"Loaded {count} rows from {path} into {db_path}")
+    return count
+
+
+class RicgraphDump(ricgraph_utils.RicgraphClient):
+    """
+    Answers the Ricgraph API requests of the harvest from an ingested export.
+
+    Has the same methods as RicgraphClient, so it can take the place of the shared
+    ricgraph_utils.client. Requests to endpoints that are not in the dump raise a
+    ValueError, which the harvest functions handle like a failed request.
+    """
+
+    def __init__(self, db_path=DEFAULT_DUMP):
+        if not os.path.exists(db_path):
+            raise FileNotFoundError(f"The Ricgraph dump {db_path} does not exist, ingest an export first.")
+        super().__init__(base_url='dump:', cache_ttl=0)
+        self.db_path = db_path
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._lock = threading.Lock()
+
+    def get(self, endpoint, params=None, use_cache=True):
+        """Answer a Ricgraph request from the dump and return the 'results'."""
+        params = params or {}
+        start = time.perf_counter()
+        failed = True
+        try:
+            results = self._answer(endpoint, params)
+            failed = False
+        finally:
+            self._record(endpoint, time.perf_counter() - start, failed)
+        limit = int(params.get('max_nr_items') or 0)
+        return results[:limit] if limit > 0 else results
+
+    def _answer(self, endpoint, params):
+        categories = params.get('category_want')
+        if isinstance(categories, str):
+            categories = [categories]
+        if endpoint == 'organization/search':
+            rows = self._query("SELECT DISTINCT faculty FROM nodes WHERE faculty LIKE ?", [f"%{params['value']}%"])
+            return [self._node(faculty, 'organization', '') for faculty, in rows]
+        if endpoint == 'get_all_personroot_nodes':
+            rows = self._query("SELECT DISTINCT personroot FROM nodes WHERE faculty = ?", [params['key']])
+            return [self._node(personroot, 'person', '') for personroot, in rows]
+        if endpoint == 'get_all_neighbor_nodes':
+            return self._nodes("personroot = ?", [params['key']], categories)
+        if endpoint == 'organization/enrich':
+            nodes = self._nodes("faculty = ?", [params['key']], categories)
+            return [node for node in nodes if not self._in_source(node, params['source_system'])]
+        if endpoint == 'person/enrich':
+            nodes = self._nodes("personroot = ?", [params['key']], ['person'])
+            return [node for node in nodes if not self._in_source(node, params['source_system'])]
+        if endpoint == 'advanced_search':
+            return self._nodes("1 = 1", [], [params['category']])
+        raise ValueError(f"{endpoint} cannot be answered from the Ricgraph dump")
+
+    def _query(self, sql, args):
+        with self._lock:
+            return self._conn.execute(sql, args).fetchall()
+
+    def _nodes(self, where, args, categories):
+        sql = f"SELECT category, name, value, source FROM nodes WHERE {where}"
+        if categories:
+            sql += f" AND category IN ({', '.join('?' * len(categories))})"
+            args = args + list(categories)
+        nodes = {}
+        for category, name, value, source in self._query(sql, args):
+            node = nodes.setdefault(f"{value}|{name}", self._node(f"{value}|{name}", category, ''))
+            node['_source'] = sorted(set(node['_source']) | set(filter(None, source.split(';'))))
+        return list(nodes.values())
+
+    @staticmethod
+    def _node(key, category, source):
+        value, _, name = key.rpartition('|')
+        return {'_key': key, 'name': name, 'value': value, 'category': category,
+                '_source': list(filter(None, source.split(';')))}
+
+    @staticmethod
+    def _in_source(node, source_system):
+        if source_system.lower() == ricgraph_utils.PURE_SOURCE_SYSTEM:
+            return ricgraph_utils.PURE_SOURCE in node['_source']
+        return any(source.lower() == source_system.lower() for source in node['_source'])
+
+
+def use_dump(path=DEFAULT_DUMP):
+    """
+    Makes all scripts answer their Ricgraph requests from a dump instead of the API.
+
+    Parameters:
+    path (str): An ingested .sqlite dump, or a CSV or JSON export that is ingested first.
+
+    Returns:
+    RicgraphDump: The dump that is now ricgraph_utils.client.
+    """
+    if not path.lower().endswith('.sqlite'):
+        db_path = DEFAULT_DUMP
+        ingest(path, db_path)
+        path = db_path
+    ricgraph_utils.client = RicgraphDump(path)
+    logger.info(f"Answering Ricgraph requests from the dump {path}")
+    return ricgraph_utils.client
+
+
+# ########################################################################
+# MAIN
+# ########################################################################
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load a Ricgraph export into the local dump')
+    parser.add_argument('export', type=str, help='CSV or JSON export of Ricgraph')
+    parser.add_argument('--db', type=str, default=DEFAULT_DUMP, help='SQLite file to load the export into')
+
+    args = parser.parse_args()
+    ingest(args.export, args.db)
@@ -0,0 +1,513 @@
+# ########################################################################
+# Script: ricgraph_utils.py
+#
+# Description:
+# This script provides **main functions** for talking to the Ricgraph REST API
+# and harvesting research outputs from it. It is meant to be imported as a
+# module by the enrichment and import scripts and should not be executed
+# standalone.
+#
+# Functions include:
+# - A RicgraphClient with a pooled keep-alive session, one retry and timeout
+#   policy, and latency counters per endpoint.
+# - An on-disk cache of the responses, so pipelines that run on the same day
+#   read their harvest from the cache instead of going back to Ricgraph.
+# - Fetching faculties, person-roots, person ids, research outputs and datasets.
+# - Fetching the neighbor nodes of many person-roots concurrently, with a
+#   bounded number of workers and the failures collected per person-root.
+#   Several categories (rescat in config.ini) are fetched in one combined request,
+#   or, when CombinedCategories is switched off, with one request per category,
+#   all at the same time.
+# - A generator that yields the harvested DOIs while the harvest is running.
+# - A harvest strategy switch: one organization/enrich request per faculty
+#   (bulk) or the walk over all person-roots (personroot), see HarvestStrategy.
+# - A DoiCollector that keeps every normalized DOI once, with the faculties and
+#   person-roots it was found for and the number of duplicates.
+#
+# Important:
+# This script is a utility module and is intended to be used by other scripts.
+# All scripts share the module level `client`, so they all use the same
+# connection pool and the base url from RIC_BASE_URL in config.ini.
+# Set `client.refresh = True` (the --refresh option of the scripts) to ignore
+# the cached responses and fetch everything from Ricgraph again.
+#
+# Dependencies:
+# - requests, urllib3, concurrent.futures, logging, etc.
+#
+# Author: David Grote Beverborg
+# Created: 2024
+#
+# License:
+# MIT License
+#
+# Copyright (c) 2024 David Grote Beverborg
+# ########################################################################
+
+
+import hashlib
+import json
+import logging
+import threading
+import time
+import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from cache_utils import PersistentCache, MISSING
+from config import (RIC_BASE_URL, RIC_MAX_WORKERS, RIC_TIMEOUT, FACULTY_PREFIX, RIC_CACHE_TTL, RIC_CACHE_MAX_BYTES,
+                    RIC_HARVEST_STRATEGY, RESEARCH_CATEGORIES, RIC_COMBINED_CATEGORIES)
+from logging_config import setup_logging
+
+logger = setup_logging('btp', level=logging.INFO)
+
+# the name of Pure as source system in organization/enrich, and as it appears in the _source of a node
+PURE_SOURCE_SYSTEM = 'uu pure'
+PURE_SOURCE = 'Pure-uu'
+HARVEST_STRATEGIES = ('auto', 'bulk', 'personroot')
+
+
+class RicgraphClient:
+    """
+    Client for the Ricgraph REST API.
+
+    All requests go through one requests.Session, so connections to Ricgraph are
+    kept alive and reused by all threads. Every request gets the same retry and
+    timeout policy, and the number of calls, errors and the time spent are
+    counted per endpoint.
+
+    Successful responses are kept in an on-disk cache keyed by base url, endpoint
+    and parameters for RicgraphTTL seconds. With refresh set, cached responses are
+    ignored (but still replaced by the fresh ones).
+    """
+
+    def __init__(self, base_url=RIC_BASE_URL, timeout=RIC_TIMEOUT, pool_size=RIC_MAX_WORKERS,
+                 cache_ttl=RIC_CACHE_TTL, cache_max_bytes=RIC_CACHE_MAX_BYTES):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.refresh = False
+        self.cache = PersistentCache('ricgraph', cache_ttl, cache_max_bytes) if cache_ttl > 0 else None
+        self.session = requests.Session()
+        retry_strategy = Retry(
+            total=5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=["HEAD", "GET", "OPTIONS"],
+            backoff_factor=1
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry_strategy)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.stats = {}
+        self._stats_lock = threading.Lock()
+
+    def get(self, endpoint, params=None, use_cache=True):
+        """Send a GET request to a Ricgraph endpoint and return the 'results', raises on errors."""
+        use_cache = use_cache and self.cache is not None
+        # the base url is part of the key, so answers of a mock Ricgraph never reach runs against the real one
+        cache_key = self.base_url + endpoint + '?' + json.dumps(params or {}, sort_keys=True)
+        if use_cache and not self.refresh:
+            results = self.cache.get(cache_key)
+            if results is not MISSING:
+                self._record_cache_hit(endpoint)
+                return results
+
+        start = time.perf_counter()
+        failed = True
+        try:
+            response = self.session.get(self.base_url + endpoint, params=params, timeout=self.timeout)
+            response.raise_for_status()
+            results = response.json().get("results", [])
+            failed = False
+        finally:
+            self._record(endpoint, time.perf_counter() - start, failed)
+
+        if use_cache:
+            self.cache.set(cache_key, results)
+        return results
+
+    def _stat(self, endpoint):
+        return self.stats.setdefault(endpoint, {'requests': 0, 'errors': 0, 'cache_hits': 0,
+                                                'seconds': 0.0, 'max_seconds': 0.0})
+
+    def _record(self, endpoint, seconds, failed):
+        with self._stats_lock:
+            stat = self._stat(endpoint)
+            stat['requests'] += 1
+            stat['seconds'] += seconds
+            stat['max_seconds'] = max(stat['max_seconds'], seconds)
+            if failed:
+                stat['errors'] += 1
+
+    def _record_cache_hit(self, endpoint):
+        with self._stats_lock:
+            self._stat(endpoint)['cache_hits'] += 1
+
+    def log_stats(self):
+        """Log the number of requests, errors, cache hits and the latency per endpoint."""
+        for endpoint, stat in sorted(self.stats.items()):
+            average = stat['seconds'] / stat['requests'] if stat['requests'] else 0
+            logger.info(f"ricgraph {endpoint}: {stat['requests']} requests, {stat['errors']} errors, "
+                        f"{stat['cache_hits']} from cache, avg {average:.3f}s, max {stat['max_seconds']:.3f}s, "
+                        f"total {stat['seconds']:.1f}s")
+
+    def search_organizations(self, value):
+        return self.get('organization/search', {'value': value})
+
+    def get_personroots(self, faculty_key, max_nr_items='0'):
+        return self.get('get_all_personroot_nodes', {'key': faculty_key, 'max_nr_items': max_nr_items})
+
+    def get_neighbor_nodes(self, key, category_want, max_nr_items=None):
+        # category_want can be a list, it is then sent as a repeated parameter
+        params = {'key': key, 'category_want': category_want}
+        if max_nr_items is not None:
+            params['max_nr_items'] = max_nr_items
+        return self.get('get_all_neighbor_nodes', params)
+
+    def enrich_organization(self, faculty_key, category_want, source_system, max_nr_items='0'):
+        params = {
+            'key': faculty_key,
+            'category_want': category_want,
+            'source_system': source_system,
+            'max_nr_items': max_nr_items,
+        }
+        return self.get('organization/enrich', params)
+
+    def enrich_person(self, personroot_key, source_system, max_nr_items='0'):
+        return self.get('person/enrich', {'key': personroot_key, 'source_system': source_system,
+                                          'max_nr_items': max_nr_items})
+
+    def advanced_search(self, category, max_nr_items='0'):
+        return self.get('advanced_search', {'category': category, 'max_nr_items': max_nr_items})
+
+
+client = RicgraphClient()
+
+
+def normalize_doi(doi):
+    """Return the DOI without surrounding whitespace and resolver prefix, in lower case."""
+    doi = doi.strip()
+    for prefix in ('https://doi.org/', 'http://doi.org/', 'https://dx.doi.org/', 'http://dx.doi.org/', 'doi:'):
+        if doi.lower().startswith(prefix):
+            doi = doi[len(prefix):]
+            break
+    return doi.lower()
+
+
+def source_fingerprint(sources):
+    """Return a hash of the _source list of a Ricgraph node."""
+    return hashlib.sha1(json.dumps(sorted(sources or ())).encode()).hexdigest()
+
+
+class DoiCollector:
+    """
+    Insertion-ordered collection of harvested DOIs.
+
+    Every DOI is normalized and stored once. For each DOI the faculties and
+    person-roots it was harvested for and the source systems Ricgraph has it from
+    are recorded, and every DOI that was already collected is counted as a
+    duplicate. Can be filled from several threads.
+    """
+
+    def __init__(self, name='DOIs'):
+        self.name = name
+        self.provenance = {}
+        self.duplicates = 0
+        self._lock = threading.Lock()
+
+    def add(self, doi, faculty=None, personroot=None, sources=None):
+        """Add a DOI, returns the normalized DOI if it is new and None if it was collected before."""
+        doi = normalize_doi(doi)
+        with self._lock:
+            source = self.provenance.get(doi)
+            new = source is None
+            if new:
+                source = self.provenance[doi] = {'faculties': set(), 'personroots': set(), 'sources': set()}
+            else:
+                self.duplicates += 1
+            if faculty is not None:
+                source['faculties'].add(faculty)
+            if personroot is not None:
+                source['personroots'].add(personroot)
+            if sources:
+                source['sources'].update(sources)
+        return doi if new else None
+
+    def dois(self):
+        """Return the collected DOIs in the order they were first added."""
+        return list(self.provenance)
+
+    def faculties(self, doi):
+        return self.provenance.get(normalize_doi(doi), {}).get('faculties', set())
+
+    def personroots(self, doi):
+        return self.provenance.get(normalize_doi(doi), {}).get('personroots', set())
+
+    def fingerprint(self, doi):
+        """Return a hash of the source systems of a DOI, it changes when Ricgraph finds the DOI in another source."""
+        return source_fingerprint(self.provenance.get(normalize_doi(doi), {}).get('sources', ()))
+
+    def __len__(self):
+        return len(self.provenance)
+
+    def __iter__(self):
+        return iter(self.dois())
+
+    def __contains__(self, doi):
+        return normalize_doi(doi) in self.provenance
+
+    def log_report(self):
+        """Log the number of unique DOIs and duplicates, in total and per faculty."""
+        logger.info(f"{self.name}: {len(self)} unique, {self.duplicates} duplicates skipped")
+        per_faculty = {}
+        shared = 0
+        for source in self.provenance.values():
+            for faculty in source['faculties']:
+                per_faculty[faculty] = per_faculty.get(faculty, 0) + 1
+            if len(source['faculties']) > 1:
+                shared += 1
+        for faculty, count in per_faculty.items():
+            logger.debug(f"{self.name}: {count} from {faculty}")
+        if shared:
+            logger.info(f"{self.name}: {shared} found for more than one faculty")
+
+
+def select_faculties(faculty_choice):
+    """Return the faculty keys for faculty_choice, or all faculties if the choice is 'all'."""
+    if faculty_choice.lower() == 'all':
+        return [item['_key'] for item in client.search_organizations(FACULTY_PREFIX)]
+    return [faculty_choice]
+
+
+def fetch_personroots(faculty_key, max_nr_items='0'):
+    """Fetch person-root nodes for a given faculty."""
+    try:
+        return client.get_personroots(faculty_key, max_nr_items)
+    except (requests.RequestException, ValueError) as e:
+        logger.error(f"Error fetching person-roots for faculty {faculty_key}: {e}")
+        return []
+
+
+def fetch_person_ids(persoonroot_key):
+    """Fetch the person id nodes (ORCID, SCOPUS, ...) of a person-root."""
+    try:
+        return client.get_neighbor_nodes(persoonroot_key, 'person')
+    except (requests.RequestException, ValueError) as e:
+        logger.error(f"Error fetching person IDs for person-root {persoonroot_key}: {e}")
+        return []
+
+
+def select_researchoutputs(persoonroot_key, categories=RESEARCH_CATEGORIES):
+    """Fetch the research output nodes of the given categories for a person-root."""
+    nodes_per_personroot, failures = harvest_neighbor_nodes([{'_key': persoonroot_key}], categories)
+    return nodes_per_personroot.get(persoonroot_key, [])
+
+
+def select_datasets(persoonroot_key):
+    """Fetch the dataset nodes for a person-root."""
+    try:
+        return client.get_neighbor_nodes(persoonroot_key, 'data set')
+    except (requests.RequestException, ValueError) as e:
+        logger.error(f"Error fetching datasets for person-root {persoonroot_key}: {e}")
+        return []
+
+
+def category_requests(category, combined=RIC_COMBINED_CATEGORIES):
+    """
+    Returns the category_want values to request for one or more categories.
+
+    Parameters:
+    category (str or list): One category, or a list of categories.
+    combined (bool): Whether Ricgraph accepts several categories in one request.
+
+    Returns:
+    list: One category_want value per request to send.
+    """
+    if isinstance(category, str):
+        return [category]
+    categories = list(category)
+    if combined and len(categories) > 1:
+        return [categories]
+    return categories
+
+
+def node_doi(node):
+    """Return the DOI of a research output node, or None if the node is identified by something else."""
+    value, _, name = node["_key"].partition("|")
+    return value if name in ('doi', '') else None
+
+
+def _category_label(category):
+    return category if isinstance(category, str) else ', '.join(category)
+
+
+def _submit_neighbor_requests(executor, keys, category):
+    # one future per person-root and category_want value, mapped to the person-root key
+    return {executor.submit(client.get_neighbor_nodes, key, category_want): key
+            for key in keys for category_want in category_requests(category)}
+
+
+def harvest_neighbor_nodes(personroots, category, max_workers=RIC_MAX_WORKERS):
+    """
+    Fetches the neighbor nodes of one or more categories for many person-roots concurrently.
+
+    Parameters:
+    personroots (list): Person-root nodes as returned by get_all_personroot_nodes.
+    category (str or list): The Ricgraph category to fetch, e.g. 'journal article',
+                            or a list of categories such as RESEARCH_CATEGORIES.
+    max_workers (int): The maximum number of requests that run at the same time.
+
+    Returns:
+    tuple: A dict with the neighbor nodes per person-root key (in the order of
+           personroots) and a dict with the error per person-root key that failed.
+           As in iter_researchoutput_dois, a person-root of which only some of the
+           category requests failed keeps the nodes of the others, and is in both.
+    """
+    keys = [personroot['_key'] for personroot in personroots if personroot['_key'] is not None]
+    results = {}
+    failures = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = _submit_neighbor_requests(executor, set(keys), category)
+        for future in as_completed(futures):
+            key = futures[future]
+            try:
+                results.setdefault(key, []).extend(future.result())
+            except (requests.RequestException, ValueError) as e:
+                failures[key] = str(e)
+
+    if failures:
+        logger.error(f"Fetching {_category_label(category)} failed for {len(failures)} of {len(set(keys))} person-roots")
+        for key, error in failures.items():
+            logger.debug(f"Error fetching {_category_label(category)} for person-root {key}: {error}")
+
+    # return the results in the same order as the person-roots were given
+    ordered_results = {key: results[key] for key in keys if key in results}
+    return ordered_results, failures
+
+
+def iter_researchoutput_dois(faculties, category='journal article', max_workers=RIC_MAX_WORKERS, failures=None):
+    """
+    Generator that yields the DOIs of the research outputs of all person-roots of
+    the faculties, as soon as the request for a person-root has finished.
+
+    Parameters:
+    faculties (list): The faculty keys to harvest.
+    category (str or list): The Ricgraph category, or list of categories, to fetch.
+    max_workers (int): The maximum number of requests that run at the same time.
+    failures (dict, optional): If given, the error per failed person-root key is added to it.
+
+    Yields:
+    tuple: The DOI, the faculty key, the person-root key and the _source of the node,
+           in the order the person-root requests finish (DOIs can repeat, use a DoiCollector).
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for faculty in faculties:
+            logger.info(f"Processing faculty: {faculty}")
+            personroots = fetch_personroots(faculty)
+            keys = {personroot['_key'] for personroot in personroots if personroot['_key'] is not None}
+            futures = _submit_neighbor_requests(executor, keys, category)
+            failed = set()
+            for future in as_completed(futures):
+                key = futures[future]
+                try:
+                    outputs = future.result()
+                except (requests.RequestException, ValueError) as e:
+                    failed.add(key)
+                    if failures is not None:
+                        failures[key] = str(e)
+                    logger.debug(f"Error fetching {_category_label(category)} for person-root {key}: {e}")
+                    continue
+                for output in outputs:
+                    doi = node_doi(output)
+                    if doi:
+                        yield doi, faculty, key, output.get("_source")
+            if failed:
+                logger.error(f"Fetching {_category_label(category)} failed for {len(failed)} of {len(keys)} "
+                             f"person-roots of {faculty}")
+
+
+def collect_researchoutput_dois(personroots, collector, faculty=None, category='journal article',
+                                in_pure=None, max_workers=RIC_MAX_WORKERS):
+    """
+    Harvests the DOIs of the research outputs of a list of person-roots into a collector.
+
+    Parameters:
+    personroots (list): Person-root nodes as returned by get_all_personroot_nodes.
+    collector (DoiCollector): The collector the DOIs are added to, in person-root order.
+    faculty (str, optional): The faculty key the person-roots belong to, kept as provenance.
+    category (str or list): The Ricgraph category, or list of categories, to fetch.
+    in_pure (DoiCollector, optional): If given, the DOIs that Ricgraph already has from
+                                      Pure are added to this collector instead of collector.
+    max_workers (int): The maximum number of requests that run at the same time.
+
+    Returns:
+    dict: The error per person-root key that failed.
+    """
+    nodes_per_personroot, failures = harvest_neighbor_nodes(personroots, category, max_workers)
+    for key, outputs in nodes_per_personroot.items():
+        for output in outputs:
+            doi = node_doi(output)
+            if not doi:
+                continue
+            target = in_pure if in_pure is not None and PURE_SOURCE in output["_source"] else collector
+            target.add(doi, faculty, key, output.get("_source"))
+    return failures
+
+
+# set when organization/enrich is found to be missing, so the other faculties go straight to the walk
+_bulk_unavailable = False
+
+
+def collect_faculty_dois(faculty, collector, category='journal article', not_in_pure=False, in_pure=None,
+                         strategy=RIC_HARVEST_STRATEGY, max_workers=RIC_MAX_WORKERS):
+    """
+    Harvests the DOIs of the research outputs of a faculty with the harvest strategy.
+
+    organization/enrich returns, in one request, the outputs of a faculty that are not
+    yet in Pure, so it can only replace the person-root walk when the pipeline asks
+    for those (not_in_pure). Otherwise the person-roots are always walked.
+
+    Parameters:
+    faculty (str): The faculty key.
+    collector (DoiCollector): The collector the DOIs are added to.
+    category (str or list): The Ricgraph category, or list of categories, to fetch.
+    not_in_pure (bool): Only collect the outputs that Ricgraph does not have from Pure.
+    in_pure (DoiCollector, optional): With not_in_pure, the walk adds the outputs that
+                                      are in Pure to this collector. The bulk request
+                                      does not return them.
+    strategy (str): 'bulk', 'personroot' or 'auto' (bulk with fallback to personroot).
+    max_workers (int): The maximum number of requests that run at the same time.
+
+    Returns:
+    dict: The error per faculty or person-root key that failed.
+    """
+    global _bulk_unavailable
+    if strategy not in HARVEST_STRATEGIES:
+        raise ValueError(f"Unknown harvest strategy {strategy!r}, use one of {', '.join(HARVEST_STRATEGIES)}")
+
+    use_bulk = not_in_pure and (strategy == 'bulk' or (strategy == 'auto' and not _bulk_unavailable))
+    if use_bulk:
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                results = executor.map(lambda category_want: client.enrich_organization(faculty, category_want,
+                                                                                         PURE_SOURCE_SYSTEM),
+                                       category_requests(category))
+                outputs = [output for result in results for output in result]
+        except (requests.RequestException, ValueError) as e:
+            if strategy == 'bulk':
+                logger.error(f"Error fetching {_category_label(category)} for faculty {faculty} "
+                             f"with organization/enrich: {e}")
+                return {faculty: str(e)}
+            if isinstance(e, requests.HTTPError) and e.response is not None and e.response.status_code == 404:
+                _bulk_unavailable = True
+            logger.warning(f"organization/enrich is not available for faculty {faculty}, "
+                           f"walking its person-roots instead: {e}")
+        else:
+            for output in outputs:
+                collector.add(output["value"], faculty, sources=output.get("_source"))
+            return {}
+
+    personroots = fetch_personroots(faculty)
+    if not_in_pure and in_pure is None:
+        in_pure = DoiCollector('skipped, already in pure')
+    return collect_researchoutput_dois(personroots, collector, faculty, category,
+                                       in_pure if not_in_pure else None, max_workers)
@@ -38,12 +38,15 @@
 import logging
 import requests
 import datacite_utils
-import time
 import pure_datasets as puda
+import pure_persons
+import pure_client
 import pandas as pd
 import os
 import argparse
-from config import RIC_BASE_URL
+import ricgraph_utils
+import ricgraph_dump
+import harvest_state
 from logging_config import setup_logging
 
 logger = setup_logging('dataset', level=logging.INFO)
@@ -62,77 +65,45 @@ def print_faculty_list(faculty_list):
         print(f"{idx}. {faculty['value']}")
     print("all. All Faculties")
 
-def fetch_personroots(faculty_key):
-    """Fetch person-root nodes for a given faculty."""
-    try:
-        params = {'key': faculty_key, 'max_nr_items': '9999'}
-        response = requests.get('http://127.0.0.1:3030/api/get_all_personroot_nodes', params=params)
-
-        return response.json().get("results", [])
-    except requests.RequestException as e:
-        logger.error(f"Error fetching person-roots for faculty {faculty_key}: {e}")
-        return []
-
 def select_faculties(faculty_choice):
     # Set logging level to INFO for this script
     logger = setup_logging('dataset', level=logging.INFO)
     logger.info("Script to update datasets in pure from ricgraph has started")
-    params = {
-        'value': 'uu faculty',
-    }
-    response = requests.get('http://127.0.0.1:3030/api/organization/search', params=params)
-    data = response.json()
-
-    if faculty_choice.lower() == 'all':
-        selected_faculties = [item['_key'] for item in data["results"]]
-    else:
-        selected_faculties = [faculty_choice]
+    return ricgraph_utils.select_faculties(faculty_choice)
 
-    return selected_faculties
-
-def select_persons_datasets(faculties, faculty_choice):
-    persons = []
+def select_persons_datasets(faculties, faculty_choice, state=None, since_last_run=False):
+    data = ricgraph_utils.DoiCollector('datasets')
     if faculty_choice == 'all':
 
-        params = {
-            'category': 'data set',
-            'max_nr_items': '0',
-        }
-        data = []
-        response = requests.get('http://127.0.0.1:3030/api/advanced_search', params=params)
-        datasets = response.json().get("results", [])
+        try:
+            datasets = ricgraph_utils.client.advanced_search('data set')
+        except (requests.RequestException, ValueError) as e:
+            logger.error(f"Error fetching datasets from ricgraph: {e}")
+            datasets = []
         for set in datasets:
             doi = set["_key"].split("|")[0]
-            data.append(doi)
+            data.add(doi, sources=set.get("_source"))
     else:
         for faculty in faculties:
             logger.info(f"Processing faculty: {faculty}")
-
-            personroots = fetch_personroots(faculty)
-            data = []
-            for persoonroot in personroots:
-                if not persoonroot['_key'] == None:
-                    persoonroot_key = persoonroot['_key']
-                    datasets = select_datasets(persoonroot_key)
-                    for set in datasets:
-                        doi = set["_key"].split("|")[0]
-                        data.append(doi)
+            # every dataset of the person-roots, also those that Ricgraph already has from Pure:
+            # datasets_in_pure decides what is imported. organization/enrich (HarvestStrategy)
+            # is not used, it would only return the datasets that are not in Pure
+            personroots = ricgraph_utils.fetch_personroots(faculty, '9999')
+            datasets, _ = ricgraph_utils.harvest_neighbor_nodes(personroots, 'data set')
+            for persoonroot_key, sets in datasets.items():
+                for set in sets:
+                    doi = set["_key"].split("|")[0]
+                    data.add(doi, faculty, persoonroot_key, set.get("_source"))
+    data.log_report()
     logger.info("datasets found in ricgraph: " + str(len(data)))
-    return data
+    if state is not None and since_last_run:
+        return state.pending(data)
+    if state is not None:
+        state.remember(data)
+    return data.dois()
 
 
-def select_datasets(persoonroot_key):
-
-    """Fetch IDs for a given person-ro    ot."""
-    try:
-        params = {'key': persoonroot_key, 'category_want': 'data set'}
-        url = RIC_BASE_URL + 'get_all_neighbor_nodes'
-        response = requests.get(url, params=params)
-
-        return response.json().get("results", [])
-    except requests.RequestException as e:
-        logger.error(f"Error fetching person IDs for person-root {persoonroot_key}: {e}")
-        return []
 def test_or_not(datasets):
     number_of_datasets = len(datasets)
     print(f"{number_of_datasets} are not in pure but are in ricgraph")
@@ -141,25 +112,33 @@ def test_or_not(datasets):
     return choice
 
 
-def df_to_pure(df, created, ignored, no_internal):
+def df_to_pure(df, created, ignored, no_internal, state=None):
     dataset_collection = []
     to_be_updated_rows = []
     logger.info(
         'Formatting the output in Pure needed JSON format. This is a slow process, you might want to get some coffee...')
+    # resolve the creators of all datasets in batches, so the rows only need lookups in memory
+    resolver = pure_persons.ContributorResolver('person_ids')
+    if not df.empty:
+        resolver.resolve(df['persons'])
+        puda.resolve_publishers(df['publisher'])
+    # check which datasets are already in Pure in batches, the rows only look them up in the set
+    in_pure = puda.datasets_in_pure(df['doi'], bloom=puda.load_dataset_bloom()) if not df.empty else set()
     for _, row in df.iterrows():
 
         if _ % 10 == 0:  # Print progress every 5 iterations
 
             logger.info(f"Processing: {_}")
             # print(f"Processing: {_}", flush=True)
-            time.sleep(0.1)  # Simulate work
 
-        already_in_pure = puda.find_dataset(None, row['doi'])
+        already_in_pure = row['doi'] in in_pure
         if already_in_pure:
             logger.debug(f"dataset with doi: {row['doi']}, already in pure")
             ignored += 1
+            outcome = harvest_state.IN_PURE
         else:
-            contributors_details = puda.get_contributors_details(row['persons'], row['created'])
+            outcome = harvest_state.REJECTED
+            contributors_details = puda.get_contributors_details(row['persons'], row['created'], resolver)
 
             if contributors_details is not None:
                 row['parsed_contributors'] = puda.format_contributors(contributors_details)
@@ -177,6 +156,7 @@ def df_to_pure(df, created, ignored, no_internal):
                         'title': row['title']
                     })
                     created += 1
+                    outcome = harvest_state.IMPORTED
 
                     # uuid_ds = puda.create_dataset(dataset_json)
                     # if not uuid_ds == 'error':
@@ -187,6 +167,8 @@ def df_to_pure(df, created, ignored, no_internal):
 
             else:
                 no_internal += 1
+        if state is not None:
+            state.record(row['doi'], outcome)
 
     output_dir = 'output/datasets'
     os.makedirs(output_dir, exist_ok=True)  # Ensure the output directory exists
@@ -211,10 +193,13 @@ def df_to_pure(df, created, ignored, no_internal):
     return created, ignored, no_internal
 
 
-def main(faculty_choice):
+def main(faculty_choice, since_last_run=False, sync_bloom=False):
     print("test")
+    if sync_bloom:
+        puda.sync_dataset_bloom()
     faculties = select_faculties(faculty_choice)
-    datasets = select_persons_datasets(faculties, faculty_choice)
+    state = harvest_state.HarvestState('datasets')
+    datasets = select_persons_datasets(faculties, faculty_choice, state, since_last_run)
 
     df = datacite_utils.get_df_from_datacite(datasets)
 
@@ -222,11 +207,16 @@ def main(faculty_choice):
     created = 0
     ignored = 0
     no_internal = 0
-    created, ignored, no_internal = df_to_pure(df, created, ignored, no_internal)
+    created, ignored, no_internal = df_to_pure(df, created, ignored, no_internal, state)
+    # what DataCite did not return could not be imported
+    state.record_unrecorded(datasets, harvest_state.REJECTED)
 
     logger.info(f"Process completed. datasets that can be imported: {created}")
     logger.info(f"Process completed. datasets that are already in pure: {ignored}")
     logger.info(f"Process completed. datasets that have no internal persons: {no_internal}")
+    ricgraph_utils.client.log_stats()
+    pure_client.client.log_stats()
+    pure_persons.external_persons.log_stats()
     logger.info("Script part 1 to import datasets in pure from ricgraph has ended")
     logger.info("Please look at the update file and uncheck items you do not want to be imported, then proceed to import them in pure via *Apply Update to Pure*")
 
@@ -240,7 +230,17 @@ if __name__ == '__main__':
                         default='all',
                         help='Faculty choice or "all"')
     parser.add_argument('test_choice', type=str, nargs='?', default='no', help='Run in test mode ("yes" or "no")')
+    parser.add_argument('--refresh', action='store_true', help='Ignore cached Ricgraph responses and fetch them again')
+    parser.add_argument('--dump', type=str, metavar='FILE',
+                        help='Answer the Ricgraph requests from a Ricgraph export (CSV, JSON or ingested .sqlite)')
+    parser.add_argument('--since-last-run', action='store_true',
+                        help='Only process the DOIs that are new or changed since the last run')
+    parser.add_argument('--sync-bloom', action='store_true',
+                        help='Rebuild the bloom filter of the dataset DOIs in Pure before the run')
 
     args = parser.parse_args()
+    ricgraph_utils.client.refresh = args.refresh
+    if args.dump:
+        ricgraph_dump.use_dump(args.dump)
 
-    main(args.faculty_choice)
+    main(args.faculty_choice, args.since_last_run, args.sync_bloom)
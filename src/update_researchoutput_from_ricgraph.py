@@ -31,11 +31,15 @@
 import logging
 import argparse
 import openalex_utils
-import requests
+import ricgraph_utils
+import ricgraph_dump
+import harvest_state
 import os
 import pure_researchoutputs as pure
+import pure_persons
+import pure_client
 from logging_config import setup_logging
-from config import PURE_BASE_URL, PURE_API_KEY, PURE_HEADERS, RIC_BASE_URL, OPENALEX_HEADERS, OPENALEX_BASE_URL
+from config import PURE_BASE_URL, PURE_API_KEY, PURE_HEADERS, OPENALEX_HEADERS, OPENALEX_BASE_URL
 import enrich_pure_external_persons as oa
 from datetime import datetime
 datetimetoday = datetime.now().strftime('%Y%m%d')
@@ -55,101 +59,35 @@ def print_faculty_list(faculty_list):
         print(f"{idx}. {faculty['value']}")
     print("all. All Faculties")
 
-def fetch_personroots(faculty_key):
-    """Fetch person-root nodes for a given faculty."""
-    try:
-        params = {'key': faculty_key, 'max_nr_items': '0'}
-        url = RIC_BASE_URL + 'get_all_personroot_nodes'
-        response = requests.get(url, params=params)
-        response.raise_for_status()
-        return response.json().get("results", [])
-    except requests.RequestException as e:
-        logging.error(f"Error fetching person-roots for faculty {faculty_key}: {e}")
-        return []
-
 def select_faculties(faculty_choice):
 
     logger.info("Script to update researchoutput in pure from ricgraph has started")
-    params = {
-        'value': 'uu faculty',
-    }
-    url = RIC_BASE_URL + 'organization/search'
-    response = requests.get(url, params=params)
-    data = response.json()
-
-    if faculty_choice.lower() == 'all':
-        selected_faculties = [item['_key'] for item in data["results"]]
-    else:
-        selected_faculties = [faculty_choice]
-
-    return selected_faculties
-
+    return ricgraph_utils.select_faculties(faculty_choice)
 
 
-def select_persons_researchoutput(selected_faculties):
-    persons = []
 
-    new_data = []
-    duplicates = []
-    all_data = []
+def select_persons_researchoutput(selected_faculties, state=None, since_last_run=False):
+    new_data = ricgraph_utils.DoiCollector('research outputs not in pure')
+    duplicates = ricgraph_utils.DoiCollector('research outputs in pure')
     for faculty in selected_faculties:
 
         logger.info(f"Processing faculty: {faculty}")
+        ricgraph_utils.collect_faculty_dois(faculty, new_data, 'journal article', not_in_pure=True,
+                                            in_pure=duplicates)
 
-        import requests
-
-        params = {
-            'key': faculty,
-            'category_want': 'journal article',
-            'source_system': 'uu pure',
-            'max_nr_items': '0',
-        }
-
-        response = requests.get('http://127.0.0.1:3030/api/organization/enrich', params=params)
-
-        outputs =  response.json().get("results", [])
-        for output in outputs:
-            doi = output["value"]
-            all_data.append(doi)
-            new_data.append(doi)
-            # if 'Pure-uu' not in output["_source"]:
-            #     new_data.append(doi)
-            # else:
-            #     duplicates.append(doi)
-
-
-        personroots = fetch_personroots(faculty)
-
-        for personroot in personroots:
-            if not personroot['_key'] == None:
-                personroot_key = personroot['_key']
-                outputs = select_researchoutputs(personroot_key)
-                for output in outputs:
-                    doi = output["_key"].split("|")[0]
-                    all_data.append(doi)
-                    if 'Pure-uu' not in output["_source"]:
-                        new_data.append(doi)
-                    else:
-                        duplicates.append(doi)
-
-    all_data = list(set(all_data))
+    all_data = new_data.dois() + [doi for doi in duplicates.dois() if doi not in new_data]
 
+    new_data.log_report()
     logger.info(f"research output selected in ricgraph, not in pure:  {len(new_data)}")
-    return new_data, duplicates, all_data
-
-def select_researchoutputs(persoonroot_key):
-    """Fetch person IDs for a given person-ro    ot."""
-    try:
-        params = {'key': persoonroot_key, 'category_want': 'journal article'}
-        url = RIC_BASE_URL + 'get_all_neighbor_nodes'
-        response = requests.get(url, params=params)
-
-        return response.json().get("results", [])
-
-    except requests.RequestException as e:
-        logging.error(f"Error fetching person IDs for person-root {persoonroot_key}: {e}")
-        return []
-
+    researchoutputs = new_data.dois()
+    if state is not None:
+        state.remember(duplicates)
+        state.record_many(duplicates.dois(), harvest_state.IN_PURE)
+        if since_last_run:
+            researchoutputs = state.pending(new_data)
+        else:
+            state.remember(new_data)
+    return researchoutputs, duplicates.dois(), all_data
 
 def test_or_not(researchoutputs, duplicates, all_data):
     number_of_researchoutput = len(researchoutputs)
@@ -161,26 +99,34 @@ def test_or_not(researchoutputs, duplicates, all_data):
     return choice
 
 
-def back_to_pure(all_openalex_data):
+def back_to_pure(all_openalex_data, state=None):
     if all_openalex_data:
         df, errors = openalex_utils.transform_openalex_to_df(all_openalex_data)
 
         if 'journal_issn' in df.columns:
+            if state is not None:
+                state.record_many(df.loc[df['journal_issn'].isna(), 'doi'], harvest_state.REJECTED)
             df = df.dropna(subset=['journal_issn'])
         num_rows = df.shape[0]
 
-        pure.df_to_pure(df)
+        pure.df_to_pure(df, state)
 
 
 
-def main(faculty_choice):
+def main(faculty_choice, since_last_run=False):
 
     faculties = select_faculties(faculty_choice)
-    researchoutputs, duplicates, all_data = select_persons_researchoutput(faculties)
+    state = harvest_state.HarvestState('researchoutputs')
+    researchoutputs, duplicates, all_data = select_persons_researchoutput(faculties, state, since_last_run)
 
     if researchoutputs:
         all_openalex_data = oa.fetch_openalex_works(researchoutputs)
-        back_to_pure(all_openalex_data)
+        back_to_pure(all_openalex_data, state)
+        # what OpenAlex did not return could not be imported
+        state.record_unrecorded(researchoutputs, harvest_state.REJECTED)
+    ricgraph_utils.client.log_stats()
+    pure_client.client.log_stats()
+    pure_persons.external_persons.log_stats()
     logger.info("Script part 1 to import research output in pure from ricgraph has ended")
     logger.info("Please look at the update file and uncheck items you do not want to be imported, then proceed to import them in pure via *Apply Update to Pure*")
 
@@ -195,6 +141,14 @@ if __name__ == '__main__':
                         # default='uu faculty: faculteit diergeneeskunde|organization_name',
                         help='Faculty choice or "all"')
     parser.add_argument('test_choice', type=str, nargs='?', default='yes', help='Run in test mode ("yes" or "no")')
+    parser.add_argument('--refresh', action='store_true', help='Ignore cached Ricgraph responses and fetch them again')
+    parser.add_argument('--dump', type=str, metavar='FILE',
+                        help='Answer the Ricgraph requests from a Ricgraph export (CSV, JSON or ingested .sqlite)')
+    parser.add_argument('--since-last-run', action='store_true',
+                        help='Only process the DOIs that are new or changed since the last run')
 
     args = parser.parse_args()
-    main(args.faculty_choice)
+    ricgraph_utils.client.refresh = args.refresh
+    if args.dump:
+        ricgraph_dump.use_dump(args.dump)
+    main(args.faculty_choice, args.since_last_run)
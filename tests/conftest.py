@@ -0,0 +1,23 @@
+import configparser
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SRC = os.path.join(ROOT, 'src')
+
+# The modules in src read src/config.ini when they are imported. The tests use the
+# defaults of configbase.ini instead, with the caches, the state and the logs in a
+# temporary directory, so a test run does not touch the files of a real installation.
+_workdir = tempfile.mkdtemp(prefix='btp-tests-')
+_config = configparser.ConfigParser()
+_config.read(os.path.join(SRC, 'configbase.ini'))
+_config['CACHE']['Directory'] = os.path.join(_workdir, 'cache')
+_config['STATE']['Directory'] = os.path.join(_workdir, 'state')
+_config_path = os.path.join(_workdir, 'config.ini')
+with open(_config_path, 'w') as f:
+    _config.write(f)
+os.environ['BTP_CONFIG'] = _config_path
+os.chdir(_workdir)
+
+sys.path.insert(0, SRC)
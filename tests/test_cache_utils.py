@@ -0,0 +1,59 @@
+import random
+
+from cache_utils import BloomFilter
+
+
+def dois(count, seed):
+    rng = random.Random(seed)
+    return [f'10.{rng.randrange(1000, 99999)}/{rng.getrandbits(64):x}' for _ in range(count)]
+
+
+def test_bloom_filter_has_no_false_negatives():
+    added = dois(5000, seed=1)
+    bloom = BloomFilter(len(added))
+    for doi in added:
+        bloom.add(doi)
+
+    assert all(doi in bloom for doi in added)
+    assert len(bloom) == len(added)
+
+
+def test_bloom_filter_has_no_false_negatives_beyond_its_capacity():
+    added = dois(3000, seed=2)
+    bloom = BloomFilter(100)
+    for doi in added:
+        bloom.add(doi)
+
+    assert all(doi in bloom for doi in added)
+
+
+def test_bloom_filter_false_positive_rate_is_near_error_rate():
+    bloom = BloomFilter(5000, error_rate=0.01)
+    for doi in dois(5000, seed=3):
+        bloom.add(doi)
+
+    others = dois(20000, seed=4)
+    false_positives = sum(doi in bloom for doi in others)
+    assert false_positives / len(others) < 0.03
+
+
+def test_saved_bloom_filter_keeps_its_members(tmp_path):
+    added = dois(1000, seed=5)
+    bloom = BloomFilter(len(added))
+    for doi in added:
+        bloom.add(doi)
+    path = str(tmp_path / 'datasets.bloom')
+    bloom.save(path)
+
+    loaded = BloomFilter.load(path)
+    assert all(doi in loaded for doi in added)
+    assert len(loaded) == len(added)
+    assert loaded.created == bloom.created
+
+
+def test_loading_a_missing_or_damaged_bloom_filter_gives_none(tmp_path):
+    path = tmp_path / 'datasets.bloom'
+    assert BloomFilter.load(str(path)) is None
+    BloomFilter(10).save(str(path))
+    path.write_bytes(path.read_bytes()[:-1])
+    assert BloomFilter.load(str(path)) is None
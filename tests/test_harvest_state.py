@@ -0,0 +1,79 @@
+import time
+
+import pytest
+
+import harvest_state
+from harvest_state import HarvestState
+from ricgraph_utils import DoiCollector
+
+
+@pytest.fixture
+def state(tmp_path):
+    return HarvestState('research_outputs', directory=str(tmp_path), retry_rejected_days=30)
+
+
+def collector(*dois, sources=('OpenAlex-uu',)):
+    collected = DoiCollector()
+    for doi in dois:
+        collected.add(doi, sources=sources)
+    return collected
+
+
+def test_new_dois_are_pending(state):
+    assert state.pending(collector('10.1/a', '10.1/b')) == ['10.1/a', '10.1/b']
+
+
+def test_processed_and_unchanged_dois_are_skipped(state):
+    harvested = collector('10.1/a', '10.1/b')
+    state.pending(harvested)
+    state.record('10.1/a', harvest_state.IMPORTED)
+    state.record('https://doi.org/10.1/B', harvest_state.IN_PURE)
+
+    assert state.pending(collector('10.1/a', '10.1/b', '10.1/c')) == ['10.1/c']
+
+
+def test_changed_sources_make_a_doi_pending_again(state):
+    state.pending(collector('10.1/a'))
+    state.record('10.1/a', harvest_state.IMPORTED)
+
+    assert state.pending(collector('10.1/a', sources=('OpenAlex-uu', 'Pure-uu'))) == ['10.1/a']
+
+
+def test_rejected_dois_are_retried_after_retry_rejected_days(state):
+    state.pending(collector('10.1/a', '10.1/b'))
+    state.record_many(['10.1/a', '10.1/b'], harvest_state.REJECTED)
+    assert state.pending(collector('10.1/a', '10.1/b')) == []
+
+    long_ago = time.time() - 31 * 86400
+    state._conn.execute("UPDATE outcomes SET updated = ? WHERE doi = ?", (long_ago, '10.1/a'))
+    state._conn.commit()
+    assert state.pending(collector('10.1/a', '10.1/b')) == ['10.1/a']
+
+
+def test_other_outcomes_are_not_retried_after_retry_rejected_days(state):
+    state.pending(collector('10.1/a'))
+    state.record('10.1/a', harvest_state.ENRICHED)
+    long_ago = time.time() - 31 * 86400
+    state._conn.execute("UPDATE outcomes SET updated = ?", (long_ago,))
+    state._conn.commit()
+
+    assert state.pending(collector('10.1/a')) == []
+
+
+def test_record_unrecorded_only_records_dois_without_an_outcome(state):
+    state.pending(collector('10.1/a', '10.1/b'))
+    state.record('10.1/a', harvest_state.IMPORTED)
+    state.record_unrecorded(['10.1/a', '10.1/b'], harvest_state.REJECTED)
+
+    assert state.get('10.1/a')[0] == harvest_state.IMPORTED
+    assert state.get('10.1/b')[0] == harvest_state.REJECTED
+
+
+def test_state_is_kept_per_pipeline_and_between_runs(state, tmp_path):
+    state.pending(collector('10.1/a'))
+    state.record('10.1/a', harvest_state.IMPORTED)
+
+    next_run = HarvestState('research_outputs', directory=str(tmp_path))
+    other_pipeline = HarvestState('datasets', directory=str(tmp_path))
+    assert next_run.pending(collector('10.1/a')) == []
+    assert other_pipeline.pending(collector('10.1/a')) == ['10.1/a']
@@ -0,0 +1,145 @@
+import asyncio
+import json as jsonlib
+import time
+
+import requests
+
+import pure_client
+from pure_client import PureClient, RateController, TokenBucket
+
+
+def make_response(status_code, retry_after=None):
+    response = requests.Response()
+    response.status_code = status_code
+    if retry_after is not None:
+        response.headers['Retry-After'] = str(retry_after)
+    response._content = b'{}'
+    return response
+
+
+def test_throttled_halves_the_rate_and_pauses():
+    controller = RateController(40, min_rate=1)
+    controller.throttled(0.5)
+    assert controller.rate == 20
+    assert controller.paused_until > time.monotonic()
+    assert controller.bucket.tokens == 0
+
+
+def test_throttles_of_one_burst_halve_the_rate_once():
+    controller = RateController(50, min_rate=1)
+    for _ in range(4):
+        controller.throttled(1)
+    assert controller.rate == 25
+    assert controller.stats['throttled'] == 4
+
+
+def test_throttle_after_the_pause_halves_again():
+    controller = RateController(40, min_rate=1)
+    controller.throttled(0)
+    controller.paused_until = time.monotonic() - 1
+    controller.throttled(0)
+    assert controller.rate == 10
+
+
+def test_rate_does_not_drop_below_min_rate():
+    controller = RateController(4, min_rate=3)
+    controller.throttled(0)
+    assert controller.rate == 3
+
+
+def test_healthy_answers_restore_the_rate():
+    controller = RateController(20, min_rate=1)
+    controller.throttled(0)
+    for _ in range(100):
+        controller.healthy()
+    assert controller.rate == 20
+
+
+def test_concurrent_throttles_halve_the_rate_once():
+    client = PureClient(base_url='http://pure.test/', max_concurrency=4, rate_limit=50, throttle_retries=2)
+    calls = []
+
+    def send(method, url, **kwargs):
+        calls.append(url)
+        # all four requests are in flight when Pure starts to throttle
+        time.sleep(0.05)
+        return make_response(429, retry_after=0.2) if len(calls) <= 4 else make_response(200)
+
+    client.session.request = send
+    responses = client.map(lambda _: client.get('persons'), range(4))
+
+    assert [response.status_code for response in responses] == [200] * 4
+    assert client.controller.stats['throttled'] == 4
+    assert client.controller.stats['slowest_rate'] == 25
+
+
+def test_retry_after_seconds():
+    assert pure_client.retry_after_seconds(make_response(429, retry_after=7)) == 7
+    assert pure_client.retry_after_seconds(make_response(429), attempt=2) == pure_client.DEFAULT_RETRY_AFTER * 4
+    assert pure_client.retry_after_seconds(make_response(429, retry_after=10 ** 6)) == pure_client.MAX_RETRY_AFTER
+
+
+def test_token_bucket_allows_a_burst_and_then_the_rate():
+    async def acquire_all(bucket, count):
+        return [await bucket.acquire() for _ in range(count)]
+
+    bucket = TokenBucket(20, capacity=5)
+    start = time.monotonic()
+    waits = asyncio.run(acquire_all(bucket, 15))
+    elapsed = time.monotonic() - start
+
+    assert waits[:5] == [0.0] * 5
+    assert all(wait > 0 for wait in waits[5:])
+    # the 10 acquisitions after the burst take 10 / 20 seconds
+    assert 0.45 <= elapsed < 1.0
+
+
+class FakeSearchClient(PureClient):
+    """Answers searches from a list of persons, like Pure's full-text search."""
+
+    def __init__(self, persons, failing=()):
+        super().__init__(base_url='http://pure.test/', max_concurrency=4, rate_limit=0)
+        self.persons = persons
+        self.failing = set(failing)
+        self.searches = []
+
+    def post(self, path, json=None, **kwargs):
+        self.searches.append(json)
+        values = json['searchString'].split('|')
+        if self.failing & set(values):
+            raise requests.ConnectionError('pure is down')
+        hits = [person for person in self.persons if person['name'] in values]
+        page = hits[json['offset']:json['offset'] + json['size']]
+        response = make_response(200)
+        response._content = jsonlib.dumps({'count': len(hits), 'items': page}).encode()
+        return response
+
+
+def test_search_all_searches_batches_and_pages():
+    persons = [{'uuid': str(i), 'name': f'name {i % 10}'} for i in range(100)]
+    client = FakeSearchClient(persons)
+    items, failed = client.search_all('persons', [f'name {i}' for i in range(10)] + ['name 0'],
+                                      batch_size=4, page_size=7)
+
+    assert failed == []
+    assert sorted(item['uuid'] for item in items) == sorted(person['uuid'] for person in persons)
+    batches = {search['searchString'] for search in client.searches}
+    assert batches == {'name 0|name 1|name 2|name 3', 'name 4|name 5|name 6|name 7', 'name 8|name 9'}
+
+
+def test_search_all_stops_after_max_pages():
+    persons = [{'uuid': str(i), 'name': 'common'} for i in range(50)]
+    client = FakeSearchClient(persons)
+    items, failed = client.search_all('persons', ['common'], page_size=10, max_pages=2)
+
+    assert len(items) == 20
+    assert len(client.searches) == 2
+
+
+def test_search_all_reports_the_values_of_failed_batches():
+    persons = [{'uuid': str(i), 'name': f'name {i}'} for i in range(6)]
+    client = FakeSearchClient(persons, failing={'name 4'})
+    items, failed = client.search_all('persons', [f'name {i}' for i in range(6)], batch_size=3)
+
+    assert sorted(failed) == ['name 3', 'name 4', 'name 5']
+    assert sorted(item['uuid'] for item in items) == ['0', '1', '2']
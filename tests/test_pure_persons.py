@@ -0,0 +1,120 @@
+import json as jsonlib
+import unicodedata
+
+import pytest
+import requests
+
+import pure_client
+import pure_persons
+
+
+def person(uuid, first_name, last_name, orcid=None):
+    return {'uuid': uuid, 'name': {'firstName': first_name, 'lastName': last_name}, 'orcid': orcid,
+            'staffOrganizationAssociations': []}
+
+
+PERSONS = [
+    person('p-vries', 'Jan', 'de Vries', orcid='https://orcid.org/0000-0001-0000-0001'),
+    person('p-smith', 'John', 'Smith'),
+    person('p-garcia', 'José', 'García'),
+    person('p-jansen-1', 'Piet', 'Jansen'),
+    person('p-jansen-2', 'Piet', 'Jansen'),
+]
+
+
+def tokens(text):
+    text = unicodedata.normalize('NFKD', text).encode('ascii', 'ignore').decode().lower()
+    return {word for word in text.replace('.', ' ').split() if len(word) > 1}
+
+
+def full_text_match(term, item):
+    # like the search of Pure: every word of the term, without accents and initials, occurs in the person
+    words = tokens(f"{item['name']['firstName']} {item['name']['lastName']} {item.get('orcid') or ''}")
+    words |= {(item.get('orcid') or '').split('/')[-1]}
+    return bool(tokens(term)) and tokens(term) <= words
+
+
+class FakePure:
+    def __init__(self, persons):
+        self.persons = persons
+        self.searches = []
+
+    def post(self, path, data=None, json=None, **kwargs):
+        body = json if json is not None else jsonlib.loads(data)
+        self.searches.append(body)
+        terms = body['searchString'].split('|')
+        hits = [item for item in self.persons if any(full_text_match(term, item) for term in terms)]
+        if 'size' in body:
+            page = hits[body['offset']:body['offset'] + body['size']]
+        else:
+            page = hits
+        response = requests.Response()
+        response.status_code = 200
+        response._content = jsonlib.dumps({'count': len(hits), 'items': page}).encode()
+        return response
+
+
+@pytest.fixture
+def pure(monkeypatch):
+    fake = FakePure(PERSONS)
+    monkeypatch.setattr(pure_client.client, 'post', fake.post)
+    monkeypatch.setattr(pure_persons.pure_person_index, 'fresh_index', lambda: None)
+    return fake
+
+
+def contributor(first_name, last_name, ids=None):
+    return {'name': f'{first_name} {last_name}', 'first_name': first_name, 'last_name': last_name, 'ids': ids or {}}
+
+
+def resolved(contributors):
+    resolver = pure_persons.ContributorResolver('ids', batch_size=10)
+    resolver.resolve([contributors])
+    return resolver
+
+
+def uuid(person_detail):
+    return person_detail['uuid'] if person_detail else None
+
+
+def test_identifier_and_exact_name_are_answered_from_the_batches(pure):
+    contributors = [contributor('Jan', 'Vries', {'orcid': 'https://orcid.org/0000-0001-0000-0001'}),
+                    contributor('John', 'Smith')]
+    resolver = resolved(contributors)
+    searches = len(pure.searches)
+
+    found = [resolver.find_person(c, c['ids'], None, 'author') for c in contributors]
+
+    assert [uuid(detail) for detail in found] == ['p-vries', 'p-smith']
+    assert found[0]['type'] == 'author'
+    assert len(pure.searches) == searches
+
+
+@pytest.mark.parametrize('first_name, last_name, expected', [
+    ('John A.', 'Smith', 'p-smith'),
+    ('Jose', 'Garcia', 'p-garcia'),
+    ('Nobody', 'Known', None),
+])
+def test_names_without_an_exact_match_are_searched_like_find_person(pure, first_name, last_name, expected):
+    c = contributor(first_name, last_name)
+    resolver = resolved([c])
+
+    assert uuid(resolver.find_person(c, c['ids'], None, 'author')) == expected
+    assert uuid(pure_persons.find_person(c, c['ids'], None, 'author')) == expected
+
+
+def test_several_persons_with_the_name_match_nobody(pure):
+    c = contributor('Piet', 'Jansen')
+    resolver = resolved([c])
+
+    assert resolver.find_person(c, c['ids'], None, 'author') is None
+    assert pure_persons.find_person(c, c['ids'], None, 'author') is None
+
+
+def test_name_batches_fetch_one_page(pure, monkeypatch):
+    monkeypatch.setattr(pure, 'persons', [person(f'p-{i}', 'Common', 'Name') for i in range(500)])
+    resolver = pure_persons.ContributorResolver('ids', batch_size=4, page_factor=5)
+    resolver.resolve([[contributor('Common', 'Name'), contributor('Other', 'Name')]])
+
+    name_searches = [search for search in pure.searches if 'Common Name' in search['searchString']]
+    assert len(name_searches) == 1
+    assert name_searches[0]['size'] == 20
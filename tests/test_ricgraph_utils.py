@@ -0,0 +1,65 @@
+import threading
+
+import pytest
+
+from ricgraph_utils import DoiCollector, normalize_doi, source_fingerprint
+
+
+@pytest.mark.parametrize('doi', [
+    '10.1234/ABC.def',
+    ' 10.1234/abc.def\n',
+    'https://doi.org/10.1234/abc.DEF',
+    'http://doi.org/10.1234/abc.def',
+    'https://dx.doi.org/10.1234/abc.def',
+    'HTTPS://DOI.ORG/10.1234/abc.def',
+    'doi:10.1234/abc.def',
+])
+def test_normalize_doi(doi):
+    assert normalize_doi(doi) == '10.1234/abc.def'
+
+
+def test_normalize_doi_strips_one_prefix_only():
+    assert normalize_doi('https://doi.org/doi:10.1/x') == 'doi:10.1/x'
+
+
+def test_collector_stores_every_doi_once_in_order():
+    collector = DoiCollector()
+    assert collector.add('10.1/B') == '10.1/b'
+    assert collector.add('10.1/a') == '10.1/a'
+    assert collector.add('https://doi.org/10.1/b') is None
+    assert collector.dois() == ['10.1/b', '10.1/a']
+    assert len(collector) == 2
+    assert collector.duplicates == 1
+    assert 'https://doi.org/10.1/A' in collector
+
+
+def test_collector_keeps_the_provenance_of_duplicates():
+    collector = DoiCollector()
+    collector.add('10.1/a', 'faculty 1', 'root 1', ['OpenAlex-uu'])
+    collector.add('10.1/A', 'faculty 2', 'root 2', ['Pure-uu'])
+    assert collector.faculties('10.1/a') == {'faculty 1', 'faculty 2'}
+    assert collector.personroots('10.1/a') == {'root 1', 'root 2'}
+    assert collector.fingerprint('10.1/a') == source_fingerprint(['Pure-uu', 'OpenAlex-uu'])
+    assert collector.faculties('10.1/unknown') == set()
+
+
+def test_fingerprint_changes_with_the_sources_only():
+    assert source_fingerprint(['a', 'b']) == source_fingerprint(['b', 'a'])
+    assert source_fingerprint(['a']) != source_fingerprint(['a', 'b'])
+    assert source_fingerprint(None) == source_fingerprint([])
+
+
+def test_collector_can_be_filled_from_several_threads():
+    collector = DoiCollector()
+
+    def add(offset):
+        for i in range(500):
+            collector.add(f'10.1/{(i + offset) % 600}')
+
+    threads = [threading.Thread(target=add, args=(offset,)) for offset in range(0, 400, 100)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(collector) == 600
+    assert collector.duplicates == 4 * 500 - 600